@@ -9,11 +9,7 @@ import numpy as np
 #import zhinst.utils
 #import Pyro5.api
 #import TimeTagger as TT
-# convenience import for all LabOne Q software functionality
-from laboneq.simple import *
-from laboneq.controller.util import *
 from time import sleep
-import TimeTagger
 from scipy.optimize import curve_fit
 import time
 from datetime import date, datetime
@@ -30,6 +26,13 @@ import sys
 import json
 
 from point_in_triangle import point_in_triangle
+from instrument_broker import connect_instruments
+from instruments import center_frequency
+from live_fit import LiveFitter
+from adaptive_scan import plan_adaptive, save_prescan
+from focus_tracking import SurfaceModel, probe_focus, save_probes
+from autofocus import autofocus, summary
+from scan_data import RateView, exposure_time, add_counts
         
 
 def main() -> int:
@@ -57,6 +60,13 @@ def main() -> int:
         "measurement_type": "ODMR", #choices: "PL", "ODMR", "3DPL"
         "steps_to_autozero": 1000, #Number of steps before the piezo stack performs the periodic autozero.
         "triangle": None, #Set to None if not using triangular scan. Otherwise specify the three corners
+        "use_broker": True, #Use the connections of a running instrument_broker.py if there is one
+        "simulate": False, #Use simulated instruments (only when connecting directly)
+        "live_fit": True, #Fit completed ODMR pixels in the background during the scan (saved as _live_fit.npz)
+        "adaptive": None, #Adaptive scan: measure only diamond pixels, found by a quadtree PL prescan (see adaptive_scan.py). E.g. {"coarse_step": 8, "pl_threshold": 1000, "gradient_threshold": 0.5}
+        "autofocus": None, #Find the surface at the centre of the scan before it starts and set z0 from it (see autofocus.py). E.g. {"z1": 4.52, "z2": 4.66, "peak": 0, "offset": 0.0}; peak 0 is the lowest z maximum.
+        "focus_tracking": None, #Follow the surface with short z-probes instead of the fixed ax, ay plane (PL and ODMR scans, see focus_tracking.py). E.g. {"probe_interval": 50, "probe_range": 0.01, "probe_steps": 7, "model": "thin_plate", "offset": 0.0}
+        "count_dtype": "uint32", #Type of the stored photon counts. "uint16" saturates at 65535 counts per data point (summed over sweeps).
         #Warning: triangle area is not yet taken into account in time estimation. Estimate with your own calculations!
         #Also some more metadata. Note: The program cannot check these values. Make sure to update them every time!!!
         "laser_power": 2.9, #mW
@@ -134,6 +144,13 @@ def main() -> int:
     else:
        print("Bruh, unknown measurement type. Exiting >:[")
        exit()
+    focus_tracking = settings.get("focus_tracking")
+    if(focus_tracking != None):
+       if(measurement_type == "3DPL"):
+          raise Exception("ERROR: focus tracking is not used for 3DPL scans, they measure their own z range!")
+       probe_interval = focus_tracking.get("probe_interval", 50)
+       probe_steps = focus_tracking.get("probe_steps", 7)
+       total_time += total_xypixels / probe_interval * probe_steps * (dwell_time*1e-12 + piezo_overhead_time)
     print("Estimated time: " + str(total_time/3600) + " hours")
     estimated_finish = time.time() + total_time
     local_time = time.ctime(estimated_finish)
@@ -153,139 +170,22 @@ def main() -> int:
     savePath = save_folder + scan_name + timestamp_string #Without file extension yet
     settings["savePath"] = savePath
     settings["Start time"] = str(current_time)
+    #The data are photon counts (see scan_data.py)
+    settings["data_unit"] = "counts"
+    count_dtype = settings.get("count_dtype", "uint32")
+    seconds_per_point = exposure_time(settings)
+    #Save the settings already now, so that a scan monitor (scan_monitor.py) can follow the scan.
+    #They are saved again with the end time when the scan is complete.
+    with open(savePath + ".json", 'w') as f:
+        json.dump(settings, f, indent="")
     #settings_file_path = settings["save_folder"] + "2D ODMR scan settings" + timestamp + ".json"
 
-    # Create a TimeTagger instance to control your hardware
-    tagger = TimeTagger.createTimeTagger()
-    countrate = TimeTagger.Countrate(tagger=tagger, channels=[1])   # 1 is 1
-
-
-
-    if(measurement_type == "ODMR"):
-      #Initialize AWG stuff
-      # Define the DeviceSetup from descriptor - 
-      # Additionally include information on the dataserver used to connect to the instruments 
-      server_host = "localhost" # <-- INSERT YOUR SERVER HOST HERE
-
-      descriptor = """
-      instruments:
-        SHFSG:
-          - address: DEV12120
-            uid: device_shfsg
-            interface: 1GbE
-          
-      connections:     
-        device_shfsg:
-          - iq_signal: q0/drive_line
-            ports: SGCHANNELS/0/OUTPUT
-          - iq_signal: q0/drive_line_ef
-            ports: SGCHANNELS/0/OUTPUT
-          - iq_signal: q1/drive_line
-            ports: SGCHANNELS/1/OUTPUT
-          - iq_signal: q1/drive_line_ef
-            ports: SGCHANNELS/1/OUTPUT
-          - iq_signal: q2/drive_line
-            ports: SGCHANNELS/2/OUTPUT
-          - iq_signal: q2/drive_line_ef
-            ports: SGCHANNELS/2/OUTPUT
-          - iq_signal: q3/drive_line
-            ports: SGCHANNELS/3/OUTPUT
-          - iq_signal: q3/drive_line_ef
-            ports: SGCHANNELS/3/OUTPUT
-          - iq_signal: q4/drive_line
-            ports: SGCHANNELS/4/OUTPUT
-          - iq_signal: q4/drive_line_ef
-            ports: SGCHANNELS/4/OUTPUT
-          - iq_signal: q5/drive_line
-            ports: SGCHANNELS/5/OUTPUT
-          - iq_signal: q5/drive_line_ef
-            ports: SGCHANNELS/5/OUTPUT
-      """
-
-      my_setup = DeviceSetup.from_descriptor(
-          yaml_text=descriptor,
-          server_host="localhost",
-          server_port='8004',
-          setup_name='Setup_Name',
-      )
-
-
-      # define baseline signal calibration for a list of qubits
-      def define_calibration():
-          
-          calib = Calibration()
-          
-          calib[f"/logical_signal_groups/q1/drive_line"] = \
-              SignalCalibration(
-                  oscillator = Oscillator(
-                      frequency =7e7,
-                      modulation_type=ModulationType.HARDWARE,
-                  ),
-                  local_oscillator = Oscillator(
-                      frequency=2.8e9,                             #center frequency Hz
-                  ),
-                  range = 0,                                      #Strength in dBm
-              )     
-          
-          return calib
-      define_calibration()
-      my_setup.set_calibration(define_calibration())
-      my_session = Session(device_setup=my_setup)
-      #my_session.connect(do_emulation=use_emulation)
-      my_session.connect()
-
-      channel_index = 1          #which channel am I using   #1 is 2
-      output_range= 0            #leave at 0 = limit of small amp, large amp has 7 dbm but check for large amp to make sure
-      center_frequency = 2.8e9
-      rflf_path= 1
-      osc1_frequency= 7e7
-
-      # Configurational
-      instrument_serial = my_setup.instruments[0].address
-      device = my_session.devices[instrument_serial]
-
-      gains_cw              = (0.0, 0.95, 0.95, 0.0) #unitless
-
-      # Configure RF output
-      device.sgchannels[channel_index].configure_channel(enable = True, output_range = output_range, 
-                                                      center_frequency = center_frequency, rf_path = rflf_path)
-
-
-
-      # Configure digital sine generator
-      device.sgchannels[channel_index].configure_sine_generation(enable = True, 
-                                                              osc_index = 0, osc_frequency = osc1_frequency, 
-                                                              phase = 0, gains = gains_cw)
-    
-
-
-
-    #Setup piezo-stack
-    from rtcs.devices.physikinstrumente.pi_E873_controller import Pistage_controller
-    pi_x = Pistage_controller("type=tcp;host=192.168.20.21;port=50000") #x axis
-    pi_y = Pistage_controller("type=tcp;host=192.168.20.22;port=50000") #x axis
-    pi_z = Pistage_controller("type=tcp;host=192.168.20.23;port=50000") #x axis
+    # Connect to time tagger, signal generator and piezo stack (through the broker if it runs)
+    instruments = connect_instruments(settings.get("use_broker", True), settings.get("simulate", False))
 
-    pi_x.open()
-    pi_y.open()
-    pi_z.open()
-
-    #Set velocities of piezo stack
-    pi_x.send_command("VEL 1 5")
-    pi_y.send_command("VEL 1 5")
-    pi_z.send_command("VEL 1 5")
-
-    def full_autozero():
-      pi_z.move(0)
-      pi_y.move(0)
-      pi_x.move(0)
-      time.sleep(3)
-      pi_x.autozero()
-      time.sleep(10)
-      pi_y.autozero()
-      time.sleep(10)
-      pi_z.autozero()
-      time.sleep(10)
+    pi_x = instruments.stage("x")
+    pi_y = instruments.stage("y")
+    pi_z = instruments.stage("z")
 
 
     #Prepare arrays:
@@ -293,20 +193,114 @@ def main() -> int:
     ymove = np.linspace(y1, y2, y_steps)
 
     #Initialization based on measurement type
+    #The photon counts are written directly into the memory-mapped .npy file, together with a mask of the completed
+    #pixels (_progress.npy), so that scan_monitor.py can show the scan while it runs.
     if(measurement_type == "ODMR"):
       x = np.linspace(min_freq, max_freq, num_measurements)
       osc_freq = x - center_frequency
       fit_freq = np.linspace(min_freq, max_freq, 500)
-      PL = np.zeros((x_steps, y_steps, num_measurements))
-      NORMALIZED = np.zeros((x_steps, y_steps, num_measurements))
+      PL = np.lib.format.open_memmap(savePath + ".npy", mode="w+", dtype=count_dtype, shape=(x_steps, y_steps, num_measurements))
+      live_fitter = LiveFitter((x_steps, y_steps), x * 1e-9, savePath) if settings.get("live_fit", True) else None
     elif(measurement_type == "PL"):
-      PL = np.zeros((x_steps, y_steps))
+      PL = np.lib.format.open_memmap(savePath + ".npy", mode="w+", dtype=count_dtype, shape=(x_steps, y_steps))
     elif(measurement_type == "3DPL"):
       zmove = np.linspace(z1, z2, z_steps)
-      PL = np.zeros((x_steps, y_steps, z_steps))
+      PL = np.lib.format.open_memmap(savePath + ".npy", mode="w+", dtype=count_dtype, shape=(x_steps, y_steps, z_steps))
+    progress = np.lib.format.open_memmap(savePath + "_progress.npy", mode="w+", dtype=np.uint8, shape=(x_steps, y_steps))
 
     steps_since_last_autozero = 0
 
+    def counts_at_z(z):
+        pi_z.move(z)
+        start_time = time.time()
+        while not pi_z.get_on_target_state():
+            time.sleep(0.005)
+            if(time.time() > start_time + 10):
+                print("WARNING: pi_z.get_on_target_state() timed out!")
+                break
+        return instruments.photon_counts(dwell_time)
+
+    #Autofocus at the centre of the scan. z0 is set such that the focal plane passes through the found surface (+ offset).
+    if(settings.get("autofocus") != None):
+        xc, yc = 0.5*(x1 + x2), 0.5*(y1 + y2)
+        pi_x.move(xc)
+        pi_y.move(yc)
+        print("Autofocus...")
+        focus = autofocus(counts_at_z, settings["autofocus"]["z1"], settings["autofocus"]["z2"], dwell_time*1e-12)
+        peak = settings["autofocus"].get("peak", 0)
+        if(len(focus["z"]) <= peak):
+            raise Exception("ERROR: autofocus found {} surface(s), no peak {}!".format(len(focus["z"]), peak))
+        z0 = focus["z"][peak] + settings["autofocus"].get("offset", 0.0) - ax*(xc - x0) - ay*(yc - y0)
+        settings["z0"] = z0
+        settings["autofocus_result"] = summary(focus)
+        np.savez(savePath + "_autofocus.npz", z=focus["profile_z"], rate=focus["profile_rate"])
+        print("Surface at z = {:.5f} +- {:.5f} mm, z0 set to {:.5f} mm".format(focus["z"][peak], focus["z_err"][peak], z0))
+
+    #Focus tracking: the surface model starts as the hand-entered plane, shifted by the offset between the
+    #PL maximum that the probes find and the z that is scanned
+    surface = None
+    if(focus_tracking != None):
+        focus_offset = focus_tracking.get("offset", 0.0)
+        surface = SurfaceModel(z0 - focus_offset, ax, ay, x0, y0, focus_tracking.get("model", "thin_plate"))
+        pixels_since_probe = probe_interval
+
+    def focal_z(ix, iy):
+        '''z target of pixel (ix, iy): on the tracked surface with focus tracking, otherwise on the fixed plane.'''
+        if(surface != None):
+            return surface.z(xmove[ix], ymove[iy]) + focus_offset
+        return z0 + ax*(xmove[ix] - x0) + ay*(ymove[iy] - y0)
+
+    def move_to(ix, iy, prescan=False):
+        '''Moves to pixel (ix, iy) on the focal plane (3DPL scans only move x and y, except for the prescan)
+        and waits until the stages are on target, with recovery when they get stuck. Returns the z position.'''
+        pi_x.move(xmove[ix])
+        pi_y.move(ymove[iy])
+        z = focal_z(ix, iy)
+
+        if(measurement_type != "3DPL" or prescan):
+          pi_z.move(z)
+
+        timeout = 10 #seconds
+        start_time = time.time()
+        while not pi_x.get_on_target_state() or not pi_y.get_on_target_state() or not pi_z.get_on_target_state():
+            time.sleep(0.005)
+            if(timeout != None):
+                if(time.time() > start_time + timeout):
+                    print()
+                    print("Warning: Timeout passed for wait_on_target! Giving up and moving on.")
+                    print("Real position: ({}, {}, {})".format(pi_x.get_real_position(), pi_y.get_real_position(), pi_z.get_real_position()))
+                    print("Target: ({}, {}, {})".format(pi_x.get_target_position(), pi_y.get_target_position(), pi_z.get_target_position()))
+                    #Anti stuck procedure
+
+                    #Query stuff
+                    for axis in ["x", "y", "z"]:
+                        for query, response in instruments.stage_diagnostics(axis).items():
+                            print(axis + " " + query + ": " + response)
+
+                    PL.flush()
+                    instruments.full_autozero()
+                    pi_x.move(xmove[ix])
+                    pi_y.move(ymove[iy])
+                    pi_z.move(z)
+                    time.sleep(3)
+                    print("Real position after recovery: ({}, {}, {})".format(pi_x.get_real_position(), pi_y.get_real_position(), pi_z.get_real_position()))
+                    break
+        return z
+
+    #Adaptive scan: a quadtree PL prescan decides which pixels are measured
+    measure_pixel = np.ones((x_steps, y_steps), dtype=bool)
+    adaptive = settings.get("adaptive")
+    if(adaptive != None):
+        def prescan_pl(ix, iy):
+            move_to(ix, iy, prescan=True)
+            return instruments.photon_counts(dwell_time) / (dwell_time * 1e-12)
+        print("Adaptive prescan...")
+        measure_pixel, samples = plan_adaptive(prescan_pl, x_steps, y_steps, adaptive.get("coarse_step", 8),
+                                               adaptive.get("pl_threshold", 1000), adaptive.get("gradient_threshold", 0.5))
+        save_prescan(savePath + "_prescan.npz", samples, xmove, ymove, measure_pixel)
+        print("Prescan measured {} points. {} of {} pixels are diamond and will be measured.".format(len(samples), np.sum(measure_pixel), measure_pixel.size))
+        print("Estimated time: " + str(total_time * np.mean(measure_pixel) / 3600) + " hours")
+
     # Loop for 2D Scan
     for iy in range(y_steps):
         #pi_y.move(ymove[iy])
@@ -317,6 +311,9 @@ def main() -> int:
             else:
                ix = x_steps - ix_loop - 1
 
+            if(not measure_pixel[ix, iy]):
+               continue
+
             #Triangular option
             if(triangle != None):
                #Triangle specified. Skip this iteration if not inside triangle
@@ -327,98 +324,32 @@ def main() -> int:
             
             #Periodic autozero
             if(steps_since_last_autozero >= steps_to_autozero):
-               np.save(savePath + ".npy", PL)
-               full_autozero()
+               PL.flush()
+               instruments.full_autozero()
                print("Performed a periodic autozero!")
                steps_since_last_autozero = 0
             steps_since_last_autozero += 1
 
-            pi_x.move(xmove[ix])
-            pi_y.move(ymove[iy])
-            z = z0 + ax*(xmove[ix] - x0) + ay*(ymove[iy] - y0)
+            #Focus probe around the predicted surface, every probe_interval measured pixels
+            if(surface != None):
+               if(pixels_since_probe >= probe_interval):
+                  move_to(ix, iy)
+                  z_surface = surface.z(xmove[ix], ymove[iy])
+                  z_peak = probe_focus(lambda z: counts_at_z(z) / (dwell_time * 1e-12), z_surface, focus_tracking.get("probe_range", 0.01), probe_steps)[0]
+                  if(not surface.add(xmove[ix], ymove[iy], z_peak)):
+                     print("Focus probe at x = {}, y = {} found no maximum near z = {}, keeping the model.".format(xmove[ix], ymove[iy], z_surface))
+                  pixels_since_probe = 0
+               pixels_since_probe += 1
 
-            if(measurement_type != "3DPL"):
-              pi_z.move(z)
-
-            timeout = 10 #seconds
-            start_time = time.time()
-            while not pi_x.get_on_target_state() or not pi_y.get_on_target_state() or not pi_z.get_on_target_state():
-                time.sleep(0.005)
-                if(timeout != None):
-                    if(time.time() > start_time + timeout):
-                        print()
-                        print("Warning: Timeout passed for wait_on_target! Giving up and moving on.")
-                        print("Real position: ({}, {}, {})".format(pi_x.get_real_position(), pi_y.get_real_position(), pi_z.get_real_position()))
-                        print("Target: ({}, {}, {})".format(pi_x.get_target_position(), pi_y.get_target_position(), pi_z.get_target_position()))
-                        #Anti stuck procedure
-
-                        #Query stuff
-                        pi_x.send_command("SVO?")
-                        response = pi_x._readline()
-                        print("x SVO?: " + response)
-                        pi_x.send_command("ERR?")
-                        response = pi_x._readline()
-                        print("x ERR?: " + response)
-                        pi_x.send_command("VEL?")
-                        response = pi_x._readline()
-                        print("x VEL?: " + response)
-                        pi_x.send_command("ONT?")
-                        response = pi_x._readline()
-                        print("x ONT?: " + response)
-                        pi_x._transport.write(b'\x05')
-                        response = pi_x._readline()
-                        print("x #5 (motion status): " + response)
-
-                        pi_y.send_command("SVO?")
-                        response = pi_y._readline()
-                        print("y SVO?: " + response)
-                        pi_y.send_command("ERR?")
-                        response = pi_y._readline()
-                        print("y ERR?: " + response)
-                        pi_y.send_command("VEL?")
-                        response = pi_y._readline()
-                        print("y VEL?: " + response)
-                        pi_y.send_command("ONT?")
-                        response = pi_y._readline()
-                        print("y ONT?: " + response)
-                        pi_y._transport.write(b'\x05')
-                        response = pi_y._readline()
-                        print("y #5 (motion status): " + response)
-
-                        pi_z.send_command("SVO?")
-                        response = pi_z._readline()
-                        print("z SVO?: " + response)
-                        pi_z.send_command("ERR?")
-                        response = pi_z._readline()
-                        print("z ERR?: " + response)
-                        pi_z.send_command("VEL?")
-                        response = pi_z._readline()
-                        print("z VEL?: " + response)
-                        pi_z.send_command("ONT?")
-                        response = pi_z._readline()
-                        print("z ONT?: " + response)
-                        pi_z._transport.write(b'\x05')
-                        response = pi_z._readline()
-                        print("z #5 (motion status): " + response)
-
-                        np.save(savePath + ".npy", PL)
-                        full_autozero()
-                        pi_x.move(xmove[ix])
-                        pi_y.move(ymove[iy])
-                        pi_z.move(z)
-                        time.sleep(3)
-                        print("Real position after recovery: ({}, {}, {})".format(pi_x.get_real_position(), pi_y.get_real_position(), pi_z.get_real_position()))
-                        break
+            z = move_to(ix, iy)
 
             #pi_x.wait_on_target(timeout=10)
             #pi_y.wait_on_target(timeout=10)
             #pi_z.wait_on_target(timeout=10)
 
             if(measurement_type == "PL"):
-                countrate.startFor(dwell_time)
-                countrate.waitUntilFinished()
-                rate = countrate.getData()[0]
-                PL[ix][iy] = rate
+                add_counts(PL, (ix, iy), instruments.photon_counts(dwell_time))
+                pixel_PL = PL[ix, iy] / seconds_per_point
             elif(measurement_type == "3DPL"):
                for iz in range(z_steps):
                   pi_z.move(zmove[iz])
@@ -430,48 +361,44 @@ def main() -> int:
                     time.sleep(0.005)
                     if(time.time() > start_time + timeout):
                       print("WARNING: pi_z.get_on_target_state() timed out!!!" + 10*"#\n")
-                      full_autozero()
+                      instruments.full_autozero()
                   
-                  countrate.startFor(dwell_time)
-                  countrate.waitUntilFinished()
-                  rate = countrate.getData()[0]
-                  PL[ix][iy][iz] = rate
+                  add_counts(PL, (ix, iy, iz), instruments.photon_counts(dwell_time))
+               pixel_PL = np.max(PL[ix][iy]) / seconds_per_point
             elif(measurement_type == "ODMR"):
               for im in range(num_measurements):
                   PL[ix][iy][im] = 0
-                  for s in range(num_sweeps): #Loop to do multiple sweeps
-                      osc1_frequency = osc_freq[im]
-                      # Configure digital sine generator
-                      device.sgchannels[channel_index].configure_sine_generation(enable = True,
-                                                                              osc_index = 0,
-                                                                              osc_frequency = osc1_frequency, 
-                                                                              phase = 0,
-                                                                              gains = gains_cw) # or use AWG.set_rf_frequency(x[n])
-
-                      countrate.startFor(dwell_time)
-                      countrate.waitUntilFinished()
-                      rate = countrate.getData()[0]
-                      PL[ix][iy][im] += rate / num_sweeps
-              NORMALIZED[ix][iy] = PL[ix][iy] / max(PL[ix][iy])
-
+                  for s in range(num_sweeps): #Loop to do multiple sweeps, the counts are summed
+                      instruments.set_osc_frequency(osc_freq[im])
+                      add_counts(PL, (ix, iy, im), instruments.photon_counts(dwell_time))
+              if(live_fitter != None):
+                  live_fitter.submit(ix, iy, PL[ix][iy] / seconds_per_point)
+              pixel_PL = np.mean(PL[ix][iy]) / seconds_per_point
+            progress[ix, iy] = 1
+
+            #PL of the pixel: the count rate for PL, the mean over the spectrum for ODMR and the maximum along z for 3DPL
             print("Current PL: {}, on position: x = {}, y = {}, z = {}            \r"
-                .format(rate,np.round(xmove[ix],decimals = 5),np.round(ymove[iy],decimals = 5), np.round(z, decimals = 5)))
+                .format(pixel_PL,np.round(xmove[ix],decimals = 5),np.round(ymove[iy],decimals = 5), np.round(z, decimals = 5)))
     print()
-    pi_x.close()
-    pi_y.close()
-    pi_z.close()
+    instruments.close()
 
-    np.save(savePath + ".npy", PL)#, header=file_header)
+    PL.flush()
+    progress.flush()
+    if(surface != None):
+       save_probes(savePath + "_focus.npz", surface)
 
     if(measurement_type == "PL"):
-       #Also save in txt format
-       np.savetxt(savePath + ".txt", PL)
+       #Also save in txt format, as count rates
+       np.savetxt(savePath + ".txt", RateView(PL, seconds_per_point)[:])
 
     settings["End time"] = str(datetime.now())
 
     #Save settings in json file
     with open(savePath + ".json", 'w') as f: 
         json.dump(settings, f, indent="")
+
+    if(measurement_type == "ODMR" and live_fitter != None):
+       live_fitter.finish(RateView(PL, seconds_per_point))
     
     print("Measurement complete!\nFile saved as: " + savePath + ".npy")
 
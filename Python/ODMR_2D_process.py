@@ -1,114 +1,77 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import sys
-from scipy.optimize import curve_fit
-from scipy.signal import find_peaks
+import os
 import json
 import argparse
 
 #Local modules
-#from rtcs.measurements.esr_scan import triple_dip_esr_fit as triple_fit
-#from rtcs.measurements.esr_scan import double_dip_esr_fit as double_fit
-from double_dip_fitter import fit_double_lorentzian, double_dip_func
-
-#Plot settings
-plt.rcParams.update({'font.size': 24,})
-plt.rcParams.update({'figure.autolayout': True})
-PL_color = "inferno"
-contrast_color = "plasma"
-ps_color = "viridis"
-fshift_color = "cividis"
-interpolation = "nearest"
+from double_dip_fitter import fit_double_lorentzian, double_dip_func, default_fit_settings
+from double_dip import fit_double_dip_map
+from odmr_models import models, fit_models, selected_curve
+from spatial_fit import fit_spatial
+from spectrum_statistics import pixel_maps
+from surface_detection import surface_maps
+import fit_cache
+from scan_data import load_scan, measured_pixels, measured_column, expand_measured
+from map_pyramid import build_pyramid
+from z_profile import fit_z_profiles, profile_curve
+from figure_rendering import render_all, map_spec, line_spec, PL_color, contrast_color, ps_color, fshift_color
 
 #Strain constants
 d_perp = 0.8e9 #Hz
 d_axial = 1.54e9 #Hz
 
 
-def Lorentzian(x, I, x0, gamma):
-    """Three-parameter Lorentzian.
-    I = height of peak
-    x0 = location of peak
-    gamma = half-width at half-maximum (HWHM) of the peak"""
-    return I * (gamma**2 / ( (x - x0)**2 + gamma**2) )
-
-def double_dip(x, height, distance, center, gamma, max_value):
-    """Fitting function for inverted Lorentzian.
-    max_value = value of the function outside of the peaks (around 1 in a normalized graph)
-    height = height of the peak (corresponds to contrast in a normalized graph)
-    center = middle between the two peaks. The peaks will be placed symmetrically around this point.
-    gamma = gamma parameter in the Lorentzian (half-width at half maximum of each peak).
-    distance = distance between the two peaks (thus half the distance from each peak to the specified center).
-    Note: width is de width of the peaks themselves, and distance is between the peak centers. Both peaks will be at half this distance from the center."""
-    loc1 = center - 0.5*distance
-    loc2 = center + 0.5*distance
-    peak1 = Lorentzian(x, height, loc1, gamma)
-    peak2 = Lorentzian(x, height, loc2, gamma)
-    return max_value - peak1 - peak2
-
-def fit_double_dip(x, PL_graph):
-    """Fits a double dip on a normalized PL map
-    x: Array of frequencies
-    PL_graph: The data to be fitted"""
-    popt, pcov = curve_fit(double_dip, x, PL_graph, p0=[0.1, 4e7, 2.87e9, 2e7, 1], bounds=([0, 0, 2.8e9, 0, 0.5], [1.5, 1e8, 3.0e9, 1e8, 1.5]))
-    return popt
-
-
-def plot_random_ODMR_samples(PL_normalized, settings, random_sampling_margin=0, num_random_samples=10):
-    """Takes a couple random pixels of the 2D ODMR data and plots their corresponding ODMR graphs. For testing whether ODMR is actually working."""
-    x_steps = settings["x_steps"]
-    y_steps = settings["y_steps"]
-    x = np.linspace(settings["min_freq"], settings["max_freq"], settings["num_measurements"])
-    fit_freq = np.linspace(settings["min_freq"], settings["max_freq"], 500)
-
-    ix_arr = np.random.randint(random_sampling_margin, x_steps - random_sampling_margin, num_random_samples)
-    iy_arr = np.random.randint(random_sampling_margin, y_steps - random_sampling_margin, num_random_samples)
-    for k in range(num_random_samples):
-        fit_double_dip = double_fit.fit_double_dip_esr(x, PL_normalized[ix_arr[k]][iy_arr[k]])
-        localminima = -fit_double_dip(fit_freq)
-        peakyboo, _ = find_peaks(localminima, prominence=0.003)
-        if(len(peakyboo) > 0):
-            plt.figure()
-            plt.title("x step = " + str(ix_arr[k]) + ", y step = " + str(iy_arr[k]))
-            plt.plot(x, PL_normalized[ix_arr[k]][iy_arr[k]])
-            plt.plot(fit_freq, fit_double_dip(fit_freq), "r-")
-            plt.plot(fit_freq[peakyboo], fit_double_dip(fit_freq)[peakyboo], "xb", label = "Peaks, difference = {}" 
-            .format(np.abs(max(fit_double_dip(fit_freq)[peakyboo])-min(fit_double_dip(fit_freq)[peakyboo]))))
-            plt.show()
-
-
-def plot_map(data, settings, color_label, unit_conversion_factor=1, title=None, suffix="out.png", filename_base="", cmap="Inferno"):
-    """Data[x][y]
-    color label: What comes to display on the color bar (include a unit!)
-    unit conversion factor: By which factor does the data need to be multiplied to match the label.
-    suffix: Added at the end of the file name. INCLUDE A FILE EXTENSION!"""
-
-    # Colour plot of diamond surface
-    plt.figure(figsize=(12,8))
-    #imshow is (y, x) instead of (x, y) as we have our PL data in, so transpose PL
-    pos = plt.imshow(data.T * unit_conversion_factor, cmap=cmap, interpolation = interpolation, extent = [settings["x1"], settings["x2"], settings["y1"], settings["y2"]], origin="lower")
-    if(title != None):
-        plt.title(title)
-    plt.xlabel("x (mm)", fontweight ="bold")
-    plt.ylabel("y (mm)", fontweight ="bold")
-    cb = plt.colorbar(pos)
-    cb.set_label(color_label, rotation=270, fontweight ="bold", labelpad=30)
-    plt.savefig(filename_base + suffix, dpi = 100, transparent=False)
-    plt.show()
-
-
-def main() -> int:
-    parser = argparse.ArgumentParser(description="Perform an ESR scan measurement.")
-    parser.add_argument('filename', help="Path to the file to be processed. Expects a .npy file. Settings will be taken from a .json file with exactly the same name.")
-    args = parser.parse_args()
-    filename = args.filename
+def add_processing_arguments(parser):
+    '''Adds the processing options of process_scan to an argparse parser.'''
+    parser.add_argument('--surfaces', default="threshold", choices=["threshold", "peak"], help="How the 3DPL surfaces are found: at the count rate threshold crossings, or at the fitted PL peaks (sub-step precision, see z_profile.py).")
+    parser.add_argument('--plane-fit', default="huber", choices=["lstsq", "huber", "ransac"], help="Method for fitting planes through the 3DPL surfaces.")
+    parser.add_argument('--normalization', default="max", choices=["max", "tail", "percentile"], help="How each ODMR spectrum is normalized: by its maximum, its baseline (tail average) or its 95th percentile.")
+    parser.add_argument('--method', default="lm", choices=["lm", "adam", "scipy"], help="Fit method: batched Levenberg-Marquardt (default), the Adam optimizer, or scipy's curve_fit per pixel in a process pool (the torch-free reference, see double_dip.py).")
+    parser.add_argument('--likelihood', default="mse", choices=["mse", "wls", "poisson"], help="Fit the normalized spectra with least squares (mse), or the photon counts (rate x dwell time x sweeps) with weighted least squares (wls) or the Poisson likelihood (poisson). The count fits need --method lm.")
+    parser.add_argument('--models', nargs="+", default=None, choices=list(models), help="Fit these resonance models (see odmr_models.py) with Levenberg-Marquardt and use the best one of every pixel. Default: only the symmetric double Lorentzian of --method.")
+    parser.add_argument('--criterion', default="bic", choices=["aic", "bic"], help="Information criterion for choosing between the --models.")
+    parser.add_argument('--spatial', type=int, default=None, metavar="BIN", help="Spatially seeded fit (see spatial_fit.py): fit BIN x BIN binned pixels first, seed every pixel from its binned parent and refit failed pixels from their neighbours.")
+    parser.add_argument('--tv-weight', type=float, default=0.0, help="With --spatial: weight of the total variation penalty between neighbouring pixels (0: off).")
+    parser.add_argument('--snr-threshold', type=float, default=None, help="Do not fit pixels whose ODMR dip is less deep than this many times the baseline noise (they get default values).")
+    parser.add_argument('--device', default=None, help="Torch device for the fit (cuda or cpu). Default: cuda when available.")
+    parser.add_argument('--refit', action='store_true', help="Discard the cached fit results of this scan and fit again.")
+    parser.add_argument('--no-cache', action='store_true', help="Do not read or write the fit cache.")
+    parser.add_argument('--headless', action='store_true', help="Write all figures to files in parallel on the Agg backend instead of showing them in windows.")
+    parser.add_argument('--processes', type=int, default=None, help="Number of processes for --headless rendering and the --method scipy fit. Default: one per CPU.")
+    parser.add_argument('--strain', action='store_true', help="Also make strain maps (only valid for measurements in zero field).")
+
+
+def process_scan(filename, args, num_threads=None, memory_budget=None):
+    '''Processes one scan and makes all its figures.
+    filename: path to the .npy file. Settings are taken from the .json file with the same name.
+    args: processing options, as added to a parser by add_processing_arguments.
+    num_threads: number of CPU threads for the fit (default: torch default).
+    memory_budget: host memory (bytes) for the fit batches (default: a fifth of the available memory, see
+    double_dip_fitter.auto_batch_size).
+    Returns a summary dictionary with the scan name, measurement type, shape and the mean PL,
+    and for ODMR scans the mean fit contrast and mean peak splitting (GHz) of the well-fitted pixels.'''
+    show = not args.headless
     filename_base = filename[:-4]
     settings_file = filename_base + ".json" #Remove .npy and add .json
 
 
-    PL = np.load(filename)
     with open(settings_file, 'r') as f:
         settings = json.load(f)
+    #PL is a float32 view in counts/s of the stored data, which are photon counts for new scans (see scan_data.py)
+    raw, PL, exposure = load_scan(filename, settings)
+    #Pixels that the scan skipped (adaptive scans, triangles, stopped scans) hold zeros and are not data
+    measured = measured_pixels(filename_base, PL.shape[:2]) if len(PL.shape) > 1 else None
+    summary = {
+        "scan": os.path.basename(filename_base),
+        "measurement_type": settings.get("measurement_type", "z" if len(PL.shape) == 1 else None),
+        "shape": list(PL.shape),
+        "mean_PL": None,
+        "mean_contrast": None,
+        "mean_splitting": None,
+        "thickness": None,
+    }
         
     #Temporary for making a graph. When you read this, you can remove these lines up to and including the exit statement
     #freq = np.linspace(settings["min_freq"], settings["max_freq"], settings["num_measurements"])
@@ -125,143 +88,89 @@ def main() -> int:
     #TODO integrate the following if-elif statement in the measurement_type stack underneath
     if(len(PL.shape) == 1):
         #This is a z scan. Show graph.
-        zmove = np.linspace(settings["z1"], settings["z2"], settings["z_steps"])
-        plt.figure()
-        plt.plot(zmove, PL)
-        plt.xlabel("Z (mm)")
-        plt.ylabel("I (counts/s)")
-        plt.savefig(filename_base + "_plot.png", dpi = 100, transparent=False, bbox_inches="tight")
-        plt.show()
-        return 0
+        #Autofocus z scans store their (irregular) positions
+        zmove = np.array(settings["z_positions"]) if "z_positions" in settings else np.linspace(settings["z1"], settings["z2"], settings["z_steps"])
+        #Top and back surface peaks. The results are stored with the settings of the scan.
+        peaks = fit_z_profiles(np.asarray(PL), zmove, verbose=False)
+        z_fine = np.linspace(np.min(zmove), np.max(zmove), 1000)
+        curves = [(zmove, np.asarray(PL), "o" if "z_positions" in settings else "."), (z_fine, profile_curve(z_fine, peaks), "-")]
+        specs = [line_spec(curves, "Z (mm)", "I (counts/s)", suffix="_plot.png")]
+        render_all(specs, settings, filename_base, args.processes, show)
+        for name in ["top", "back"]:
+            print("{} surface: z = {:.5f} +- {:.5f} mm, FWHM {:.2f} um".format(name.capitalize(), peaks[name], peaks[name + "_err"], 1e3*peaks[name + "_width"]))
+        print("Optical thickness: {:.2f} +- {:.2f} um".format(1e3*peaks["thickness"], 1e3*peaks["thickness_err"]))
+        settings["z_profile_fit"] = {key: (float(value) if np.isfinite(value) else None) for key, value in peaks.items()}
+        with open(settings_file, 'w') as f:
+            json.dump(settings, f, indent="")
+        summary["mean_PL"] = float(np.mean(PL))
+        summary["thickness"] = settings["z_profile_fit"]["thickness"]
+        return summary
     elif(len(PL.shape)==2):
         #2D PL map.
-        plot_map(PL, settings, "counts/s", 1, title="PL map", suffix="plot_PL.png", filename_base=filename_base, cmap=PL_color)
-        plot_map(np.log10(PL), settings, "log PL ($_{10}$log counts/s)", 1, title="PL map", suffix="plot_log_PL.png", filename_base=filename_base, cmap=PL_color)
-        return 0
+        PL = np.asarray(PL)
+        if(measured is not None):
+            PL[~measured] = np.nan
+        specs = [
+            map_spec(PL, "counts/s", 1, title="PL map", suffix="plot_PL.png", cmap=PL_color),
+            map_spec(PL, "log PL ($_{10}$log counts/s)", 1, title="PL map", suffix="plot_log_PL.png", cmap=PL_color, log=True),
+        ]
+        build_pyramid({"PL": PL}, settings, filename_base)
+        render_all(specs, settings, filename_base, args.processes, show)
+        summary["mean_PL"] = float(np.nanmean(PL))
+        return summary
     
     if(settings["measurement_type"] ==  "3DPL"):
-        #Take some random pixels and plot their graph
-        num_random_samples = 0
-        x_steps = settings["x_steps"]
-        y_steps = settings["y_steps"]
-        z_steps = settings["z_steps"]
+        PL = np.asarray(PL)
         z_arr = np.linspace(settings["z1"], settings["z2"], settings["z_steps"])
-        ix_arr = np.random.randint(0, x_steps, num_random_samples)
-        iy_arr = np.random.randint(0, y_steps, num_random_samples)
-        #First show a couple random graphs
-        for k in range(num_random_samples):
-            plt.figure()
-            plt.title("x step = " + str(ix_arr[k]) + ", y step = " + str(iy_arr[k]))
-            plt.plot(z_arr, PL[ix_arr[k]][iy_arr[k]])
-            plt.xlabel("Z (mm)")
-            plt.ylabel("I (counts/s)")
-            plt.show()
         
-        #Now compute the heightmaps
+        #Now compute the heightmaps, fit planes on top and back surface, and take the PL on those planes.
         count_threshold = 1000 #All places with more counts per second will be considered diamond.
-        top_surface = np.zeros((x_steps, y_steps))
-        back_surface = np.zeros((x_steps, y_steps))
         xmove = np.linspace(settings["x1"], settings["x2"], settings["x_steps"])
         ymove = np.linspace(settings["y1"], settings["y2"], settings["y_steps"])
-        for ix in range(x_steps):
-            for iy in range(y_steps):
-                #Loop through z values until first point above threshold
-                for iz in range(z_steps):
-                    if(PL[ix][iy][iz] > count_threshold):
-                        top_surface[ix][iy] = z_arr[iz]
-                        break
-                #Now do the same from the back
-                for iz in range(z_steps-1, -1, -1):
-                    if(PL[ix][iy][iz] > count_threshold):
-                        back_surface[ix][iy] = z_arr[iz]
-                        break
-        thickness_map = abs(top_surface - back_surface)
+        surfaces = surface_maps(PL, xmove, ymove, z_arr, count_threshold, fit_method=args.plane_fit, method=args.surfaces)
+        if(measured is not None):
+            surfaces["diamond"] &= measured
+            for name in ["top_surface", "back_surface", "thickness", "PL_top_surface", "PL_back_surface"]:
+                surfaces[name][~measured] = np.nan
+        top_surface = surfaces["top_surface"]
+        back_surface = surfaces["back_surface"]
+        thickness_map = surfaces["thickness"]
+        PL_top_surface = surfaces["PL_top_surface"]
+        PL_back_surface = surfaces["PL_back_surface"]
+        print("Top surface: z0:", surfaces["top_plane"][0], ". ax:", surfaces["top_plane"][1], ". ay:", surfaces["top_plane"][2])
+        print("Back surface: z0:", surfaces["back_plane"][0], ". ax:", surfaces["back_plane"][1], ". ay:", surfaces["back_plane"][2])
 
         #Also make a PL plot. A simple way to do this is to average through z.
         #PL_averaged = np.average(PL, axis=2)
-        
-        #Fit planes on top and back surface, so that PL can be plotted on those.
-        def plane_z(xy, z0, ax, ay):
-            """xy format [x, y].
-            Or for fitting: [[x1, x2, x3, ...], [y1, y2, y3, ...]]"""
-            return z0 + ax*xy[0] + ay*xy[1]
-        
-        xfit = np.zeros(0)
-        yfit = np.zeros(0)
-        zfit = np.zeros(0)
-        for ix in range(x_steps):
-            for iy in range(y_steps):
-                if(np.average(PL[ix][iy]) > count_threshold): #If not above threshold, ignore it. Probably background
-                    xfit = np.append(xfit, xmove[ix])
-                    yfit = np.append(yfit, ymove[iy])
-                    zfit = np.append(zfit, top_surface[ix][iy])
-        popt, pcov = curve_fit(plane_z, [xfit, yfit], zfit)
-        z0 = popt[0]
-        ax = popt[1]
-        ay = popt[2]
-        print("Top surface: z0:", z0, ". ax:", ax, ". ay:", ay)
-
-        PL_top_surface = np.zeros((x_steps, y_steps))
-        for ix in range(x_steps):
-            for iy in range(y_steps):
-                z_plane = plane_z([xmove[ix], ymove[iy]], z0, ax, ay)
-                if(z_plane > z_arr[0] and z_plane < z_arr[-1]):
-                    #Z is within measurement range. Take closest point.
-                    closest_iz = 0
-                    for iz in range(z_steps):
-                        if(abs(z_arr[iz] - z_plane) < abs(z_arr[closest_iz] - z_plane)):
-                            #Found closer index
-                            closest_iz = iz
-                    PL_top_surface[ix][iy] = PL[ix][iy][closest_iz]
-
-        #Do the same for the back surface
-        xfit = np.zeros(0)
-        yfit = np.zeros(0)
-        zfit = np.zeros(0)
-        for ix in range(x_steps):
-            for iy in range(y_steps):
-                if(np.average(PL[ix][iy]) > count_threshold): #If not above threshold, ignore it. Probably background
-                    xfit = np.append(xfit, xmove[ix])
-                    yfit = np.append(yfit, ymove[iy])
-                    zfit = np.append(zfit, back_surface[ix][iy])
-        popt, pcov = curve_fit(plane_z, [xfit, yfit], zfit)
-        z0 = popt[0]
-        ax = popt[1]
-        ay = popt[2]
-        print("Back surface: z0:", z0, ". ax:", ax, ". ay:", ay)
-
-        PL_back_surface = np.zeros((x_steps, y_steps))
-        for ix in range(x_steps):
-            for iy in range(y_steps):
-                z_plane = plane_z([xmove[ix], ymove[iy]], z0, ax, ay)
-                if(z_plane > z_arr[0] and z_plane < z_arr[-1]):
-                    #Z is within measurement range. Take closest point.
-                    closest_iz = 0
-                    for iz in range(z_steps):
-                        if(abs(z_arr[iz] - z_plane) < abs(z_arr[closest_iz] - z_plane)):
-                            #Found closer index
-                            closest_iz = iz
-                    PL_back_surface[ix][iy] = PL[ix][iy][closest_iz]
 
         #Now plot results
-        plot_map(np.clip(top_surface, a_min=z_arr[0], a_max=z_arr[-1]), settings, "z (um)", 1000, title="Top surface height map", suffix="plot_3DPL_top.png", filename_base=filename_base, cmap=PL_color)
-        plot_map(np.clip(back_surface, a_min=z_arr[0], a_max=z_arr[-1]), settings, "z (um)", 1000, title="Back surface height map", suffix="plot_3DPL_back.png", filename_base=filename_base, cmap=PL_color)
-        plot_map(thickness_map, settings, "Δz (um)", 1000, title="Observed diamond thickness", suffix="plot_3DPL_thickness.png", filename_base=filename_base, cmap=PL_color)
-        #plot_map(PL_averaged, settings, "counts/s", 1, title="PL map z-averaged", suffix="plot_3DPL_z_averaged.png", filename_base=filename_base, cmap=PL_color)
-        #plot_map(np.log10(PL_averaged), settings, "log PL ($_{10}$log counts/s)", 1, title="PL map z-averaged", suffix="plot_log_3DPL_averaged.png", filename_base=filename_base, cmap=PL_color)
-        plot_map(PL_top_surface, settings, "counts/s", 1, title="PL map fitted top surface", suffix="plot_3DPL_PL_top_surface.png", filename_base=filename_base, cmap=PL_color)
-        plot_map(np.log10(PL_top_surface), settings, "log PL ($_{10}$log counts/s)", 1, title="PL map fitted top surface", suffix="plot_log_3DPL_PL_top_surface.png", filename_base=filename_base, cmap=PL_color)
-        plot_map(PL_back_surface, settings, "counts/s", 1, title="PL map fitted back surface", suffix="plot_3DPL_PL_back_surface.png", filename_base=filename_base, cmap=PL_color)
-        plot_map(np.log10(PL_back_surface), settings, "log PL ($_{10}$log counts/s)", 1, title="PL map fitted back surface", suffix="plot_log_3DPL_PL_back_surface.png", filename_base=filename_base, cmap=PL_color)
-
-        return 0
-
-    PL_normalized = np.zeros(PL.shape)
-    for ix in range(PL.shape[0]):
-        for iy in range(PL.shape[1]):
-            PL_normalized[ix][iy] = PL[ix][iy] / max(PL[ix][iy])
-
-    #plot_random_ODMR_samples(PL_normalized, settings)
+        z_range = (z_arr[0], z_arr[-1])
+        specs = [
+            map_spec(top_surface, "z (um)", 1000, title="Top surface height map", suffix="plot_3DPL_top.png", cmap=PL_color, clip=z_range),
+            map_spec(back_surface, "z (um)", 1000, title="Back surface height map", suffix="plot_3DPL_back.png", cmap=PL_color, clip=z_range),
+            map_spec(thickness_map, "Δz (um)", 1000, title="Observed diamond thickness", suffix="plot_3DPL_thickness.png", cmap=PL_color),
+            #map_spec(PL_averaged, "counts/s", 1, title="PL map z-averaged", suffix="plot_3DPL_z_averaged.png", cmap=PL_color),
+            #map_spec(PL_averaged, "log PL ($_{10}$log counts/s)", 1, title="PL map z-averaged", suffix="plot_log_3DPL_averaged.png", cmap=PL_color, log=True),
+            map_spec(PL_top_surface, "counts/s", 1, title="PL map fitted top surface", suffix="plot_3DPL_PL_top_surface.png", cmap=PL_color),
+            map_spec(PL_top_surface, "log PL ($_{10}$log counts/s)", 1, title="PL map fitted top surface", suffix="plot_log_3DPL_PL_top_surface.png", cmap=PL_color, log=True),
+            map_spec(PL_back_surface, "counts/s", 1, title="PL map fitted back surface", suffix="plot_3DPL_PL_back_surface.png", cmap=PL_color),
+            map_spec(PL_back_surface, "log PL ($_{10}$log counts/s)", 1, title="PL map fitted back surface", suffix="plot_log_3DPL_PL_back_surface.png", cmap=PL_color, log=True),
+        ]
+        build_pyramid({"top_surface": top_surface, "back_surface": back_surface, "thickness": thickness_map,
+                       "PL_top_surface": PL_top_surface, "PL_back_surface": PL_back_surface}, settings, filename_base)
+        render_all(specs, settings, filename_base, args.processes, show)
+
+        summary["mean_PL"] = float(np.mean(PL if measured is None else PL[measured]))
+        if(np.any(surfaces["diamond"] & np.isfinite(thickness_map))):
+            summary["thickness"] = float(np.median(thickness_map[surfaces["diamond"] & np.isfinite(thickness_map)]))
+        return summary
+
+    maps = pixel_maps(PL, method=args.normalization)
+    if(measured is not None):
+        maps["valid"] &= measured
+        for name in ["mean_PL", "contrast_raw", "snr"]:
+            maps[name][~measured] = np.nan
+    PL_normalized = maps["PL_normalized"]
 
     if(len(PL.shape)==3):
         print("Processing double dip fits")
@@ -269,77 +178,129 @@ def main() -> int:
         y_steps = settings["y_steps"]
 
         contrast_fit = np.zeros((x_steps, y_steps))
-        contrast_raw = np.zeros((x_steps, y_steps))
+        contrast_raw = maps["contrast_raw"]
         peak_splitting = np.zeros((x_steps, y_steps))
         frequency_shift = np.zeros((x_steps, y_steps))
 
         x = np.linspace(settings["min_freq"], settings["max_freq"], settings["num_measurements"])
-        fit_freq = np.linspace(settings["min_freq"], settings["max_freq"], 500)
         freq_GHz = x * 1e-9
         
-        """
-        for ix in range(x_steps):
-            for iy in range(y_steps):
-                #If number of counts is too low, ignore pixel
-                if(np.mean(PL_normalized[ix][iy])):
-                    fit_double_dip = double_fit.fit_double_dip_esr(x, PL_normalized[ix][iy])
-                    localminima = -fit_double_dip(fit_freq)
-                    peakyboo, _ = find_peaks(localminima, prominence=0.003)
-                    if(len(peakyboo) == 2):
-                        fs = max(fit_freq[peakyboo]) - min(fit_freq[peakyboo])
-                        center_freq = ( max(fit_freq[peakyboo]) + min(fit_freq[peakyboo]) ) / 2
-                        contr = (max(fit_double_dip(fit_freq))-min(fit_double_dip(fit_freq)[peakyboo]))
-                        contrast_raw[ix][iy] = np.max(PL_normalized[ix][iy]) - np.min(PL_normalized[ix][iy]) #scale 0 to 1
-                        contrast_fit[ix][iy] = contr #scale 0 to 1
-                        peak_splitting[ix][iy] = fs #Hz
-                        frequency_shift[ix][iy] = center_freq - 2.87e9 #Hz
-        """
-        
-        #Calculate contrast_raw
-        for ix in range(x_steps):
-            for iy in range(y_steps):
-                contrast_raw[ix][iy] = np.max(PL_normalized[ix][iy]) - np.min(PL_normalized[ix][iy]) #scale 0 to 1
-        
         #Use the improved fitting module
         #Note: Everything here will be with GHz as frequency unit
-        fitted_params = fit_double_lorentzian(PL_normalized, freq_GHz)
+        #Fit results are cached next to the scan, keyed by the data, frequencies and fitter settings
+        fit_settings = dict(default_fit_settings, method=args.method, likelihood=args.likelihood, snr_threshold=args.snr_threshold)
+        fit_data = PL_normalized
+        if(args.likelihood != "mse" and exposure != None):
+            #Fit the stored photon counts directly
+            fit_settings["exposure"] = 1.0
+            fit_data = raw
+        elif(args.likelihood != "mse"):
+            #Older scans store count rates: rates times the total time per frequency point are photon counts
+            fit_settings["exposure"] = settings["dwell_time"] * 1e-12 * settings["num_sweeps"]
+            fit_data = np.asarray(PL)
+        def fit(data):
+            return fit_double_lorentzian(data, freq_GHz, device=args.device, num_threads=num_threads, memory_budget=memory_budget, **fit_settings)
+        if(args.method == "scipy"):
+            if(args.likelihood != "mse" or args.snr_threshold != None):
+                raise Exception("ERROR: --method scipy only works with --likelihood mse and without --snr-threshold!")
+            def fit(data):
+                return fit_double_dip_map(data, freq_GHz, tail=fit_settings["tail"], error_threshold=fit_settings["error_threshold"], processes=args.processes)
+        if(args.spatial != None):
+            if(args.models != None or args.method != "lm" or args.snr_threshold != None):
+                raise Exception("ERROR: --spatial only works with --method lm, without --models and --snr-threshold!")
+            fit_settings.update(spatial=args.spatial, tv_weight=args.tv_weight)
+            def fit(data):
+                options = {key: fit_settings[key] for key in ["tail", "thresholds", "error_threshold", "max_iter", "likelihood", "exposure"] if key in fit_settings}
+                return fit_spatial(data, freq_GHz, args.spatial, args.tv_weight, device=args.device, num_threads=num_threads, **options)
+        if(args.models != None):
+            #All models in one pass, the best one per pixel
+            fit_settings.update(models=args.models, criterion=args.criterion)
+            def fit(data):
+                options = {key: fit_settings[key] for key in ["tail", "thresholds", "error_threshold", "max_iter", "likelihood", "exposure", "snr_threshold"] if key in fit_settings}
+                return fit_models(data, freq_GHz, args.models, args.criterion, device=args.device, num_threads=num_threads, memory_budget=memory_budget, **options)
+        #Only the measured pixels are fitted, as an (K, 1, F) column (the layout of the live fit's cache entry).
+        #The spatial fit needs the whole map: there the skipped pixels are masked afterwards.
+        fit_measured = measured is not None and args.spatial == None
+        if(fit_measured):
+            fit_data = measured_column(fit_data, measured)
+        cache_dir = filename_base + "_fitcache"
+        if(args.refit):
+            fit_cache.invalidate(cache_dir)
+        if(args.no_cache):
+            fitted_params = fit(fit_data)
+        else:
+            fitted_params = fit_cache.cached_fit(fit_data, freq_GHz, fit, fit_cache.fit_config(fit_settings, args.normalization), cache_dir)
+        if(measured is not None):
+            fitted_params = expand_measured(fitted_params if fit_measured else {name: values[measured] for name, values in fitted_params.items()}, measured)
         contrast_fit = fitted_params["A"]
         peak_splitting = fitted_params["f_delta"]
         frequency_shift = fitted_params["f_center"] - 2.87 #Yes, in GHz
         
-        #Show a few random plots to check whether stuff went well
+        #Plot a few random pixels with their fit to check whether stuff went well
         num_graphs = 10
+        specs = []
         for i in range(num_graphs):
             x = np.random.randint(0, x_steps, 1)[0]
             y = np.random.randint(0, y_steps, 1)[0]
-            fit = double_dip_func(freq_GHz,
-                                fitted_params["I0"][x][y],
-                                fitted_params["A"][x][y],
-                                fitted_params["width"][x][y],
-                                fitted_params["f_center"][x][y],
-                                fitted_params["f_delta"][x][y]
-                                )
-            plt.figure()
-            plt.plot(freq_GHz, PL_normalized[x][y], '.')
-            plt.plot(freq_GHz, fit)
-            plt.title("(" + str(x) + ", " + str(y) + ")")
-            plt.xlabel("Frequency (GHz)")
-            plt.ylabel("Intensity (normalized)")
-            plt.show()
-        
+            if(args.models != None):
+                fit = selected_curve(fitted_params, args.models, freq_GHz, x, y)
+            else:
+                fit = double_dip_func(freq_GHz,
+                                    fitted_params["I0"][x][y],
+                                    fitted_params["A"][x][y],
+                                    fitted_params["width"][x][y],
+                                    fitted_params["f_center"][x][y],
+                                    fitted_params["f_delta"][x][y]
+                                    )
+            specs.append(line_spec([(freq_GHz, np.asarray(PL_normalized[x][y]), '.'), (freq_GHz, fit, '-')],
+                                   "Frequency (GHz)", "Intensity (normalized)", title="(" + str(x) + ", " + str(y) + ")",
+                                   suffix="plot_ODMR_sample_{}_{}.png".format(x, y)))
+
+        specs += [
+            map_spec(maps["mean_PL"], "PL (kcounts/s)", 1e-3, title="Photoluminescence", suffix="plot_PL.png", cmap=PL_color),
+            map_spec(maps["mean_PL"], "log PL ($_{10}$log counts/s)", 1, title="Photoluminescence", suffix="plot_log_PL.png", cmap=PL_color, log=True),
+            map_spec(contrast_raw, "Raw contrast (%)", 100, title="Raw contrast (clipped to max 30%)", suffix="plot_contrast_raw.png", cmap=contrast_color, clip=(None, 0.3)),
+            map_spec(contrast_fit, "Fit contrast (%)", 100, title="Fit contrast (clipped to max 30%)", suffix="plot_contrast_fit.png", cmap=contrast_color, clip=(None, 0.3)),
+            map_spec(peak_splitting, "Peak splitting (MHz)", 1e3, title="Peak splitting (clipped above 25 MHz)", suffix="plot_peak_splitting.png", cmap=ps_color, clip=(0.025, None)),
+            map_spec(frequency_shift, "Frequency shift (MHz)", 1e3, title="Frequency shift (clipped at 5 MHz)", suffix="plot_frequency_shift.png", cmap=fshift_color, clip=(-0.005, 0.005)),
+        ]
+        if(args.models != None and len(args.models) > 1):
+            legend = ", ".join("{}: {}".format(i, name) for i, name in enumerate(args.models))
+            specs.append(map_spec(fitted_params["model"], "Model", title="Selected model (" + legend + ")", suffix="plot_model_selection.png", cmap="tab10"))
+        print("Average peak splitting (GHz): ", np.nanmean(np.clip(peak_splitting, a_min=0.025, a_max=0.035)))
+        print("Standard deviation peak splitting (GHz): ", np.nanstd(np.clip(peak_splitting, a_min=0.025, a_max=0.035)))
+
+        #Strain maps (Only valid when measurement is taken in zero field)
+        #Reminder: perpendicular ~ peak splitting. Axial ~ frequency shift. Both are in GHz, d_perp and d_axial in Hz.
+        if(args.strain):
+            specs += [
+                map_spec(np.abs(peak_splitting), r"$\epsilon_{perp}$ (%)", 1e9 * 2*np.pi / d_perp * 100, title="Perpendicular strain", suffix="plot_strain_perp.png", cmap=ps_color),
+                map_spec(np.abs(frequency_shift), r"$\epsilon_{axial}$ (%)", 1e9 * 2*np.pi / d_axial * 100, title="Axial strain", suffix="plot_strain_axial.png", cmap=fshift_color),
+            ]
+
+        #Multi-resolution maps for pyramid_viewer.py
+        build_pyramid({"PL": maps["mean_PL"], "contrast_raw": contrast_raw, "contrast_fit": contrast_fit, "peak_splitting": peak_splitting,
+                       "frequency_shift": frequency_shift, "width": fitted_params["width"], "mse": fitted_params["mse"]}, settings, filename_base)
+        render_all(specs, settings, filename_base, args.processes, show)
+
+        #Summary over the pixels with a good fit, with both dips inside the frequency sweep
+        dip_low = fitted_params["f_center"] - 0.5*fitted_params["f_delta"]
+        dip_high = fitted_params["f_center"] + 0.5*fitted_params["f_delta"]
+        good = maps["valid"] & (fitted_params["mse"] <= fit_settings["error_threshold"]) & (dip_low >= freq_GHz[0]) & (dip_high <= freq_GHz[-1])
+        summary["mean_PL"] = float(np.nanmean(maps["mean_PL"]))
+        if(np.any(good)):
+            summary["mean_contrast"] = float(np.mean(contrast_fit[good]))
+            summary["mean_splitting"] = float(np.mean(peak_splitting[good]))
+    return summary
 
-        plot_map(np.mean(PL, axis=2), settings, "PL (kcounts/s)", 1e-3, title="Photoluminescence", suffix="plot_PL.png", filename_base=filename_base, cmap=PL_color)
-        plot_map(np.clip(contrast_raw, a_min=None, a_max=0.3), settings, "Raw contrast (%)", 100, title="Raw contrast (clipped to max 30%)", suffix="plot_contrast_raw.png", filename_base=filename_base, cmap=contrast_color)
-        plot_map(np.clip(contrast_fit, a_min=None, a_max=0.3), settings, "Fit contrast (%)", 100, title="Fit contrast (clipped to max 30%)", suffix="plot_contrast_fit.png", filename_base=filename_base, cmap=contrast_color)
-        plot_map(np.clip(peak_splitting, a_min=0.025, a_max=None), settings, "Peak splitting (MHz)", 1e3, title="Peak splitting (clipped above 25 MHz)", suffix="plot_peak_splitting.png", filename_base=filename_base, cmap=ps_color)
-        print("Average peak splitting (GHz): ", np.mean(np.clip(peak_splitting, a_min=0.025, a_max=0.035)))
-        print("Standard deviation peak splitting (GHz): ", np.std(np.clip(peak_splitting, a_min=0.025, a_max=0.035)))
-        plot_map(np.clip(frequency_shift, a_min=-0.005, a_max=0.005), settings, "Frequency shift (MHz)", 1e3, title="Frequency shift (clipped at 5 MHz)", suffix="plot_frequency_shift.png", filename_base=filename_base, cmap=fshift_color)
 
-        #Strain maps (Only valid when measurement is takin in zero field)
-        #Reminder: perpendicular ~ peak splitting. Axial ~ frequency shift.
-        #plot_map(np.abs(peak_splitting), settings, "$\epsilon_{perp}$ (%)", 2*np.pi / d_perp * 100, title="Perpendicular strain", suffix="plot_strain_perp.png", filename_base=filename_base, cmap=ps_color)
-        #plot_map(np.abs(frequency_shift), settings, "$\epsilon_{axial}$ (%)", 2*np.pi / d_axial * 100, title="Axial strain", suffix="plot_strain_axial.png", filename_base=filename_base, cmap=fshift_color)
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Process and plot a 2D scan, 3D PL scan or z scan.")
+    parser.add_argument('filename', help="Path to the file to be processed. Expects a .npy file. Settings will be taken from a .json file with exactly the same name.")
+    add_processing_arguments(parser)
+    args = parser.parse_args()
+    process_scan(args.filename, args)
+    return 0
 
 if __name__ == "__main__":
     exitcode = main()
@@ -0,0 +1,99 @@
+'''Adaptive (quadtree) PL prescan for 2D scans.
+
+Instead of measuring every pixel of the x_steps x y_steps grid, plan_adaptive() first measures
+the PL on a coarse grid with coarse_step pixels between points. Every square cell of that grid
+is then handled by the PL at its four corners:
+- all corners below the PL threshold: the whole cell is background (substrate or blank);
+- all corners above the threshold and a small relative PL spread ((max - min) / max at most
+  gradient_threshold): the whole cell is diamond;
+- otherwise the cell contains an edge or structure. It is split into four, the new corner points
+  are measured, and the children are handled the same way, down to single pixels.
+The result is a diamond mask at full resolution, from which ODMR_2D.py measures only the diamond
+pixels. Diamond features smaller than coarse_step that lie entirely inside a background cell can
+be missed, so coarse_step sets the smallest feature that is always found.
+
+The prescan points are irregularly spaced and are stored with their coordinates by save_prescan().'''
+
+import numpy as np
+
+
+def coarse_indices(n, step):
+    '''Grid indices 0, step, 2*step, ... up to and including the last index n - 1.'''
+    indices = list(range(0, n, step))
+    if indices[-1] != n - 1:
+        indices.append(n - 1)
+    return indices
+
+
+def serpentine_order(points):
+    '''Sorts (ix, iy) points row by row along y, alternating the x direction, to keep the stage moves short.'''
+    return sorted(points, key=lambda p: (p[1], p[0] if p[1] % 2 == 0 else -p[0]))
+
+
+def plan_adaptive(measure_pl, x_steps, y_steps, coarse_step=8, pl_threshold=1000, gradient_threshold=0.5):
+    '''Runs the quadtree prescan.
+    measure_pl: function (ix, iy) -> PL (counts/s) that moves to grid pixel (ix, iy) and measures it
+    pl_threshold: pixels with more PL (counts/s) are diamond
+    gradient_threshold: largest relative PL spread over a cell that is taken as uniform diamond
+    Returns (diamond, samples): the (x_steps, y_steps) bool diamond mask and a dictionary {(ix, iy): PL}
+    of all measured points.'''
+    samples = {}
+    def measure(points):
+        for point in serpentine_order(set(points) - set(samples)):
+            samples[point] = measure_pl(*point)
+
+    xs = coarse_indices(x_steps, coarse_step)
+    ys = coarse_indices(y_steps, coarse_step)
+    measure([(ix, iy) for ix in xs for iy in ys])
+    cells = [(xs[a], ys[b], xs[a + 1], ys[b + 1]) for a in range(len(xs) - 1) for b in range(len(ys) - 1)]
+    if len(xs) == 1 or len(ys) == 1:
+        #A single row or column: no cells, every pixel is measured
+        measure([(ix, iy) for ix in range(x_steps) for iy in range(y_steps)])
+        cells = []
+
+    diamond = np.zeros((x_steps, y_steps), dtype=bool)
+    #Breadth first, so that all new points of a refinement level are measured in one serpentine pass
+    while cells:
+        split = []
+        for i0, j0, i1, j1 in cells:
+            corners = np.array([samples[(i0, j0)], samples[(i1, j0)], samples[(i0, j1)], samples[(i1, j1)]])
+            above = corners > pl_threshold
+            if not above.any():
+                continue
+            spread = (corners.max() - corners.min()) / corners.max()
+            if above.all() and spread <= gradient_threshold:
+                diamond[i0:i1 + 1, j0:j1 + 1] = True
+                continue
+            if i1 - i0 <= 1 and j1 - j0 <= 1:
+                #Nothing left to refine, the corners are classified by their own PL below
+                continue
+            im, jm = (i0 + i1) // 2, (j0 + j1) // 2
+            for a0, a1 in ([(i0, im), (im, i1)] if i1 - i0 > 1 else [(i0, i1)]):
+                for b0, b1 in ([(j0, jm), (jm, j1)] if j1 - j0 > 1 else [(j0, j1)]):
+                    split.append((a0, b0, a1, b1))
+        measure([(i, j) for a0, b0, a1, b1 in split for i in (a0, a1) for j in (b0, b1)])
+        cells = split
+
+    #Measured points are classified by their own PL
+    for (ix, iy), PL in samples.items():
+        diamond[ix, iy] = PL > pl_threshold
+    return diamond, samples
+
+
+def save_prescan(path, samples, xmove, ymove, diamond):
+    '''Stores the prescan points with their grid indices and positions (mm), and the diamond mask, in path (.npz).'''
+    points = sorted(samples)
+    ix = np.array([p[0] for p in points], dtype=np.int64)
+    iy = np.array([p[1] for p in points], dtype=np.int64)
+    np.savez(path, ix=ix, iy=iy, x=np.asarray(xmove)[ix], y=np.asarray(ymove)[iy],
+             PL=np.array([samples[p] for p in points], dtype=np.float32), diamond=diamond)
+
+
+if __name__ == "__main__":
+    #Prescan of a synthetic disk-shaped sample: how many points and how accurate the mask is
+    M, N = 200, 150
+    X, Y = np.meshgrid(np.arange(M), np.arange(N), indexing="ij")
+    truth = (X - 90)**2 + (Y - 70)**2 < 45**2
+    rate = np.where(truth, 2e5, 300) * (1 + 0.05*np.random.default_rng(0).standard_normal((M, N)))
+    diamond, samples = plan_adaptive(lambda ix, iy: rate[ix, iy], M, N, coarse_step=8)
+    print("Measured {} of {} pixels in the prescan, {} misclassified".format(len(samples), M*N, np.sum(diamond != truth)))
@@ -0,0 +1,181 @@
+'''Batch processing of all scans in a measurement folder.
+
+Finds every scan (2D_ODMR_scan_*, 2D_PL_scan_*, 3D_PL_scan_*, z_scan_*) in the folder and
+processes the ones without up-to-date outputs with ODMR_2D_process.process_scan, in parallel
+worker processes. Figures are written headless. A scan is up to date when its summary file
+(<scan>_summary.json) is newer than the scan and was made with the same processing options.
+The number of simultaneously running scans is limited by the CPU count and a memory budget.
+Finally, the summaries of all scans are collected in scan_index.csv in the folder.
+Example:
+    python3 batch_process.py /home/dl-lab-pc3/measurements/ --workers 8 --memory 16'''
+
+import os
+import re
+import sys
+import csv
+import json
+import time
+import argparse
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from ODMR_2D_process import process_scan, add_processing_arguments
+from double_dip_fitter import available_memory, batch_memory
+
+scan_pattern = re.compile(r"^(2D_ODMR_scan|2D_PL_scan|3D_PL_scan|z_scan)_\d+\.npy$")
+#Options that change the outputs. A scan processed with other values is processed again.
+output_options = ["plane_fit", "normalization", "method", "models", "criterion", "spatial", "tv_weight", "likelihood", "snr_threshold", "strain", "surfaces"]
+index_columns = ["scan", "measurement_type", "shape", "mean_PL", "mean_contrast", "mean_splitting", "thickness", "status"]
+#Memory of a worker besides the data (interpreter, torch, matplotlib)
+worker_overhead_bytes = 500 * 2**20
+
+
+def scan_complete(filename):
+    '''True if the scan has a settings file with an end time (scans that are still running have none).'''
+    if not os.path.exists(filename[:-4] + ".json"):
+        return False
+    with open(filename[:-4] + ".json", 'r') as f:
+        return "End time" in json.load(f)
+
+
+def discover_scans(folder):
+    '''Sorted list of the .npy files of all complete scans in folder.'''
+    scans = []
+    for name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, name)
+        if scan_pattern.match(name) and scan_complete(path):
+            scans.append(path)
+    return scans
+
+
+def summary_file(filename):
+    return filename[:-4] + "_summary.json"
+
+
+def is_up_to_date(filename, options):
+    '''True if the scan has a summary that is newer than its data and settings and was made with the same options.'''
+    path = summary_file(filename)
+    if not os.path.exists(path):
+        return False
+    if os.path.getmtime(path) < max(os.path.getmtime(filename), os.path.getmtime(filename[:-4] + ".json")):
+        return False
+    with open(path, 'r') as f:
+        stored = json.load(f)
+    return stored.get("options") == options and stored["summary"].get("status") == "ok"
+
+
+def memory_estimate(filename, fit_budget=None):
+    '''Rough peak memory (bytes) of processing one scan: the data, its float32 normalized copy and the fit buffers,
+    and for ODMR and 3DPL scans the working set of the fit batches within fit_budget (bytes, see process_scan).'''
+    data = np.load(filename, mmap_mode="r")
+    estimate = worker_overhead_bytes + data.nbytes + 3 * data.size * 4
+    if data.ndim == 3:
+        estimate += batch_memory(data.shape[0] * data.shape[1], data.shape[2], memory_budget=fit_budget)
+    return estimate
+
+
+def _process_one(filename, args, options, num_threads, fit_budget=None):
+    '''Worker: processes one scan and writes its summary file. Errors are reported in the summary instead of raised.'''
+    start = time.time()
+    try:
+        summary = process_scan(filename, args, num_threads=num_threads, memory_budget=fit_budget)
+        summary["status"] = "ok"
+    except Exception as e:
+        summary = {"scan": os.path.basename(filename[:-4]), "status": "failed: " + str(e)}
+    summary["processing_time"] = time.time() - start
+    with open(summary_file(filename), 'w') as f:
+        json.dump({"summary": summary, "options": options}, f, indent=4)
+    return summary
+
+
+def run_batch(scans, args, options, workers, memory_budget=None):
+    '''Processes the scans in a pool of workers. A scan is only started while the memory estimates
+    of all running scans fit in memory_budget (bytes, None for no limit); a scan that does not fit
+    on its own is run when nothing else is running. Every worker sizes its fit batches to its share of the
+    budget: the workers see the same free memory, so they cannot size them from it on their own.
+    Returns the summaries in the order of completion.'''
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+    fit_budget = None if memory_budget == None else memory_budget / workers
+    pending = [(filename, memory_estimate(filename, fit_budget)) for filename in scans]
+    running = {}
+    summaries = []
+    #Spawned workers start without the parent's torch and matplotlib state
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        while pending or running:
+            used = sum(running.values())
+            for item in list(pending):
+                filename, memory = item
+                if len(running) >= workers:
+                    break
+                if running and memory_budget != None and used + memory > memory_budget:
+                    continue
+                print("Processing " + filename)
+                running[pool.submit(_process_one, filename, args, options, num_threads, fit_budget)] = memory
+                used += memory
+                pending.remove(item)
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                summary = future.result()
+                print("Finished " + summary["scan"] + ": " + summary["status"])
+                summaries.append(summary)
+    return summaries
+
+
+def write_index(folder, scans):
+    '''Collects the summaries of all scans into scan_index.csv in folder. Returns the path of the index.'''
+    path = os.path.join(folder, "scan_index.csv")
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=index_columns, extrasaction="ignore")
+        writer.writeheader()
+        for filename in scans:
+            if not os.path.exists(summary_file(filename)):
+                writer.writerow({"scan": os.path.basename(filename[:-4]), "status": "not processed"})
+                continue
+            with open(summary_file(filename), 'r') as s:
+                writer.writerow(json.load(s)["summary"])
+    return path
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Process all scans in a measurement folder in parallel.")
+    parser.add_argument('folder', help="Folder with the scans (the save_folder of the measurements).")
+    parser.add_argument('--workers', type=int, default=None, help="Number of scans processed at the same time. Default: one per CPU.")
+    parser.add_argument('--memory', type=float, default=None, help="Memory budget in GB for all workers together. Default: 80%% of the available memory.")
+    parser.add_argument('--force', action='store_true', help="Also process scans whose outputs are up to date. Add --refit to ignore cached fits as well.")
+    add_processing_arguments(parser)
+    args = parser.parse_args()
+    #Figures are always written to files, one process per scan
+    args.headless = True
+    args.processes = 1
+
+    options = {key: getattr(args, key) for key in output_options}
+    scans = discover_scans(args.folder)
+    todo = [filename for filename in scans if args.force or not is_up_to_date(filename, options)]
+    print("Found {} scans, {} to process.".format(len(scans), len(todo)))
+
+    if(args.memory != None):
+        memory_budget = args.memory * 2**30
+    else:
+        memory_budget = available_memory()
+        if(memory_budget != None):
+            memory_budget *= 0.8
+    workers = args.workers or os.cpu_count() or 1
+    workers = max(1, min(workers, len(todo)))
+
+    if(len(todo) > 0):
+        start = time.time()
+        summaries = run_batch(todo, args, options, workers, memory_budget)
+        failed = [s["scan"] for s in summaries if s["status"] != "ok"]
+        print("Processed {} scans in {:.1f} s, {} failed.".format(len(summaries), time.time() - start, len(failed)))
+        for scan in failed:
+            print("  failed: " + scan)
+    print("Index written to " + write_index(args.folder, scans))
+    return 0
+
+
+if __name__ == "__main__":
+    exitcode = main()
+    if exitcode != 0:
+        sys.exit(exitcode)
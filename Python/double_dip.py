@@ -1,8 +1,24 @@
-'''Module that provides an improved double Lorentzian fitting.'''
+'''Module that provides an improved double Lorentzian fitting.
 
+fit_double_dip() fits one spectrum with scipy's curve_fit. fit_double_dip_map() fits every pixel of
+an (M, N, F) map that way, in blocks of pixels spread over a process pool, and returns the same maps
+as double_dip_fitter.fit_double_lorentzian. It needs only numpy and scipy and gives the same result
+for any number of processes, so it serves as the reference fitter on computers without torch.
+Nothing is printed; every pixel gets a status code (see status_names) instead of an exception.'''
+
+import os
+import warnings
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.optimize import curve_fit
+from scipy.optimize import curve_fit, OptimizeWarning
+from concurrent.futures import ProcessPoolExecutor
+
+param_names = ["I0", "A", "width", "f_center", "f_delta"]
+#Status codes of fit_double_dip_map, index into this list
+status_names = ["ok", "one_dip", "many_dips", "no_dip", "not_converged", "invalid"]
+OK, ONE_DIP, MANY_DIPS, NO_DIP, NOT_CONVERGED, INVALID = range(len(status_names))
+#Parameter bounds: positive, and not limited to normalized spectra
+lower_bounds = [0, 0, 0, 0, 0]
+upper_bounds = [np.inf, np.inf, np.inf, np.inf, np.inf]
 
 def double_dip_func(f, I0, A, width, f_center, f_delta):
     '''Double Lorentzian dip.
@@ -13,14 +29,7 @@ def double_dip_func(f, I0, A, width, f_center, f_delta):
     f_delta = difference in frequency between the two dips.'''
     return I0 - A/(1 + ((f_center - 0.5*f_delta - f)/width)**2) - A/(1 + ((f_center + 0.5*f_delta - f)/width)**2)
 
-def fit_double_dip(freq, intensity, tail=5, thresholds=[0.3, 0.5]):
-    '''Fits the double dip function to the intensity vs frequency data.
-    freq and intensity are the x and y data
-    tail = number of pixels to take from the side as a sample for baseline and noise
-    thresholds = values which have to be trespassed to count as dip. These are relative values with respect to baseline, counted from I0-A upwards.'''\
-    #Checks:
-    if(len(freq) != len(intensity)):
-        raise Exception("ERROR: Frequency and intensity data not of same length!")
+def check_arguments(freq, tail, thresholds):
     if(len(freq) < 2*tail):
         raise Exception("ERROR: length of data must be at least two times tail length!")
     if(thresholds[0] > thresholds[1]):
@@ -29,8 +38,12 @@ def fit_double_dip(freq, intensity, tail=5, thresholds=[0.3, 0.5]):
         raise Exception("ERROR: (First threshold) Thresholds must be between 0 and 1!")
     if(thresholds[1] < 0 or thresholds[1] > 1):
         raise Exception("ERROR: (Second threshold) Thresholds must be between 0 and 1!")
-        
-    #First estimates:
+
+def initial_estimate(freq, intensity, tail=5, thresholds=[0.3, 0.5]):
+    '''First estimates [I0, A, width, f_center, f_delta] from the dips in the intensity, and a status code:
+    ONE_DIP or OK for one or two dips, MANY_DIPS for more (estimated from the outer two), NO_DIP for none.
+    tail = number of pixels to take from the side as a sample for baseline and noise
+    thresholds = values which have to be trespassed to count as dip. These are relative values with respect to baseline, counted from I0-A upwards.'''
     #Estimate noise level
     tail_values = np.concatenate((intensity[:tail], intensity[-tail:]))
     noise_std = np.std(tail_values)
@@ -39,12 +52,10 @@ def fit_double_dip(freq, intensity, tail=5, thresholds=[0.3, 0.5]):
     dips = []
     dip_start = 0
     in_dip = False
-    
+
     #Calculate absolute threshold positions
     threshold_low = I0_est - (1 - thresholds[0])*A_est
     threshold_high = I0_est - (1 - thresholds[1])*A_est
-    print(threshold_high)
-    print(threshold_low)
     for i in range(len(freq)):
         if(in_dip):
             if(intensity[i] >= threshold_high):
@@ -56,49 +67,133 @@ def fit_double_dip(freq, intensity, tail=5, thresholds=[0.3, 0.5]):
                 #Reached start of dip
                 dip_start = i
                 in_dip = True
-                
-    print(dips)
-    
-    #Check number of dips found
-    if(len(dips) == 0):
-        #This shouldn't be possible. No dips found in this case.
-        raise Exception("ERROR: Fucked up the fit, no dips found!")
-    elif(len(dips) == 1):
-        print("Found one dip!")
+    if(in_dip and dip_start > 0):
+        #A dip running into the end of the sweep
+        dips += [[dip_start, len(freq) - 1]]
+
+    if(len(dips) == 0 or A_est <= 0):
+        return [I0_est, 0, freq[-1] - freq[0], freq[np.argmin(intensity)], 0], NO_DIP
+    if(len(dips) == 1):
         f_dip_start = freq[dips[0][0]]
         f_dip_finish = freq[dips[0][1]]
         width_est =  (f_dip_finish - f_dip_start) * 0.5 #the 0.5 is because the width parameter is half the FWHM of the dip
         f_center_est = ( f_dip_start + f_dip_finish) * 0.5 #(Average)
-        f_delta_est = 0
         #The dips are (mostly) stacked oneachother, so our previous estimation for amplitude should be half!
-        A_est *= 0.5
-    elif(len(dips) == 2):
-        print("Found two dips!")
-        f_dip_start_1 = freq[dips[0][0]]
-        f_dip_finish_1 = freq[dips[0][1]]
-        f_dip_start_2 = freq[dips[1][0]]
-        f_dip_finish_2 = freq[dips[1][1]]
-        width_est = 0.25 * (f_dip_finish_1 + f_dip_finish_2 - f_dip_start_1 - f_dip_start_2) #(Average of both widths, and divided by 2 to go from FWHM to width parameter)
-        middle_1 = 0.5 * (f_dip_finish_1 + f_dip_start_1) 
-        middle_2 = 0.5 * (f_dip_finish_2 + f_dip_start_2) 
-        f_center_est = 0.5 * (middle_1 + middle_2) #Average of both regions
-        f_delta_est = middle_2 - middle_1
-    else:
-        print("WARNING: I was not made for this >:[")
-        width_est = 1
-        f_center_est = 0
-        f_delta_est = 0
-    
-    #Initial estimates
-    p0 = [I0_est, A_est, width_est, f_center_est, f_delta_est]
-    print("First estimates:", p0)
-    
-    #Now it's time to finetune this rough graph.
-    popt, pcov = curve_fit(double_dip_func, freq, intensity, p0=p0, bounds=([0.5, 0, 0, 0, 0], [1.5, 1, np.inf, np.inf, np.inf]))
-    print("Finetuned estimates:", popt)
+        return [I0_est, 0.5*A_est, width_est, f_center_est, 0], ONE_DIP
+    #Two dips, or the outer two of more
+    f_dip_start_1 = freq[dips[0][0]]
+    f_dip_finish_1 = freq[dips[0][1]]
+    f_dip_start_2 = freq[dips[-1][0]]
+    f_dip_finish_2 = freq[dips[-1][1]]
+    width_est = 0.25 * (f_dip_finish_1 + f_dip_finish_2 - f_dip_start_1 - f_dip_start_2) #(Average of both widths, and divided by 2 to go from FWHM to width parameter)
+    middle_1 = 0.5 * (f_dip_finish_1 + f_dip_start_1)
+    middle_2 = 0.5 * (f_dip_finish_2 + f_dip_start_2)
+    f_center_est = 0.5 * (middle_1 + middle_2) #Average of both regions
+    f_delta_est = middle_2 - middle_1
+    return [I0_est, A_est, width_est, f_center_est, f_delta_est], OK if len(dips) == 2 else MANY_DIPS
+
+def fit_pixel(freq, intensity, tail=5, thresholds=[0.3, 0.5]):
+    '''Fits the double dip function to one spectrum without printing or raising.
+    Returns (popt, perr, status, nfev): parameters, standard errors, status code and number of function
+    evaluations. popt and perr are NaN when the pixel is not fitted (NO_DIP, NOT_CONVERGED, INVALID).'''
+    nan = np.full(len(param_names), np.nan)
+    if(not np.all(np.isfinite(intensity))):
+        return nan, nan, INVALID, 0
+    p0, status = initial_estimate(freq, intensity, tail, thresholds)
+    if(status == NO_DIP):
+        return nan, nan, status, 0
+    #Inside the bounds, with a width of at least half a frequency step
+    p0 = np.clip(p0, lower_bounds, upper_bounds)
+    p0[2] = max(p0[2], 0.5*abs(freq[1] - freq[0]))
+    try:
+        with warnings.catch_warnings():
+            #Undetermined parameters give an infinite error instead of a warning
+            warnings.simplefilter("ignore", OptimizeWarning)
+            popt, pcov, infodict, message, ier = curve_fit(double_dip_func, freq, intensity, p0=p0, bounds=(lower_bounds, upper_bounds), full_output=True)
+    except (RuntimeError, ValueError):
+        return nan, nan, NOT_CONVERGED, 0
+    return popt, np.sqrt(np.abs(np.diag(pcov))), status, infodict["nfev"]
+
+def fit_double_dip(freq, intensity, tail=5, thresholds=[0.3, 0.5]):
+    '''Fits the double dip function to the intensity vs frequency data.
+    freq and intensity are the x and y data
+    tail = number of pixels to take from the side as a sample for baseline and noise
+    thresholds = values which have to be trespassed to count as dip. These are relative values with respect to baseline, counted from I0-A upwards.
+    Returns [I0, A, width, f_center, f_delta]. Raises an exception when no dip is found or the fit fails.'''
+    if(len(freq) != len(intensity)):
+        raise Exception("ERROR: Frequency and intensity data not of same length!")
+    check_arguments(freq, tail, thresholds)
+    popt, perr, status, nfev = fit_pixel(np.asarray(freq), np.asarray(intensity), tail, thresholds)
+    if(status in [NO_DIP, NOT_CONVERGED, INVALID]):
+        raise Exception("ERROR: fit failed, " + status_names[status] + "!")
     return popt
 
+def _fit_block(freq, block, tail, thresholds):
+    '''Fits a (B, F) block of spectra. Returns (params, errors, status, nfev, mse) arrays.'''
+    B = len(block)
+    params = np.full((B, len(param_names)), np.nan)
+    errors = np.full((B, len(param_names)), np.nan)
+    status = np.zeros(B, dtype=np.int8)
+    nfev = np.zeros(B, dtype=np.int64)
+    mse = np.full(B, np.nan)
+    for b in range(B):
+        intensity = np.asarray(block[b], dtype=float)
+        params[b], errors[b], status[b], nfev[b] = fit_pixel(freq, intensity, tail, thresholds)
+        if(np.all(np.isfinite(params[b]))):
+            mse[b] = np.mean((intensity - double_dip_func(freq, *params[b]))**2)
+    return params, errors, status, nfev, mse
+
+def fit_double_dip_map(data, freq, tail=5, thresholds=[0.3, 0.5], error_threshold=0.1, default_values=None, processes=None, block_size=256):
+    '''Fits the double dip function to every spectrum of the (M, N, F) data with curve_fit.
+    Blocks of block_size pixels are fitted in a pool of `processes` worker processes (default: one per CPU;
+    1 fits in this process). The result does not depend on the number of processes.
+    Returns the maps of double_dip_fitter.fit_double_lorentzian with method "lm": the parameters (param_names),
+    their standard errors (key + "_err"), "mse", "r2", "iterations" (function evaluations), "converged" and
+    "masked" (not fitted: no dip or non-finite data), and "status", the status code of every pixel
+    (see status_names). Pixels that are not fitted or have a higher mse than error_threshold get default_values.'''
+    M, N, F = data.shape
+    freq = np.asarray(freq, dtype=float)
+    check_arguments(freq, tail, thresholds)
+    flat = data.reshape(-1, F)
+    blocks = [np.asarray(flat[start:start + block_size]) for start in range(0, M*N, block_size)]
+    if(processes == None):
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(blocks))
+    if(processes <= 1):
+        results = [_fit_block(freq, block, tail, thresholds) for block in blocks]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(_fit_block, [freq]*len(blocks), blocks, [tail]*len(blocks), [thresholds]*len(blocks)))
+    params, errors, status, nfev, mse = [np.concatenate(parts) for parts in zip(*results)]
+
+    fitted_params = {}
+    for i, name in enumerate(param_names):
+        fitted_params[name] = params[:, i]
+        fitted_params[name + "_err"] = errors[:, i]
+    #The model is symmetric in the sign of width and f_delta
+    fitted_params["width"] = np.abs(fitted_params["width"])
+    fitted_params["f_delta"] = np.abs(fitted_params["f_delta"])
+    variance = np.var(flat, axis=1)
+    r2 = np.full(M*N, np.nan)
+    np.divide(mse, variance, out=r2, where=variance > 0)
+    fitted_params["mse"] = mse
+    fitted_params["r2"] = 1 - r2
+    fitted_params["iterations"] = nfev
+    fitted_params["converged"] = np.isfinite(mse)
+    fitted_params["masked"] = (status == NO_DIP) | (status == INVALID)
+    fitted_params["status"] = status
+    fitted_params = {key: value.reshape(M, N) for key, value in fitted_params.items()}
+
+    if default_values is None:
+        default_values = {"I0": 1.0, "A": 0, "width": 1.0, "f_center": 2.87, "f_delta": 0.0}
+    failed_pixels = ~(fitted_params["mse"] <= error_threshold)
+    for name in param_names:
+        fitted_params[name][failed_pixels] = default_values[name]
+    return fitted_params
+
 if __name__ == "__main__":
+    import time
+    import matplotlib.pyplot as plt
     noise = 0.02
     num_points = 100
     freq = np.linspace(2.85, 2.89, num_points)
@@ -107,13 +202,23 @@ if __name__ == "__main__":
     intens += np.random.normal(0, noise, num_points)
     param = fit_double_dip(freq, intens)
     fitted_graph = double_dip_func(freq, param[0], param[1], param[2], param[3], param[4])
-    
+
     print(param)
-    
+
+    #A 40 x 40 map, serial and over all CPUs
+    rng = np.random.default_rng(0)
+    f_delta = rng.uniform(0.004, 0.010, (40, 40, 1))
+    data = double_dip_func(freq, 1, 0.15, 0.002, 2.87, f_delta) + rng.normal(0, 0.005, (40, 40, num_points))
+    for processes in [1, None]:
+        start = time.perf_counter()
+        maps = fit_double_dip_map(data, freq, processes=processes)
+        print("processes={}: {:.0f} pixels/s, median f_delta error {:.3f} MHz, status counts {}".format(
+            processes, data.shape[0]*data.shape[1] / (time.perf_counter() - start), 1e3*np.median(np.abs(maps["f_delta"] - f_delta[..., 0])),
+            dict(zip(status_names, np.bincount(maps["status"].ravel(), minlength=len(status_names)).tolist()))))
+
     plt.figure()
     plt.plot(freq, intens, '.')
     plt.plot(freq, fitted_graph)
     plt.xlabel("Frequency (GHz)")
     plt.ylabel("Intensity")
     plt.show()
-    
\ No newline at end of file
@@ -1,19 +1,50 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from tqdm import tqdm
 
 import os
-os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "expandable_segments:True"
+import sys
+import time
+#Lets the CUDA allocator reuse memory when the batches shrink after running out of memory
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
 
 import torch
 from torch import nn, optim
 
+from lm_solver import levenberg_marquardt
+from spectrum_statistics import snr_map
+
 plt.rcParams.update({'font.size': 15})
 
+def select_device(device=None, num_threads=None):
+    '''Returns the torch device to fit on.
+    device: "cuda", "cpu", a torch.device, or None to use CUDA when available and the CPU otherwise.
+    num_threads: number of CPU threads torch may use (None leaves the torch default).'''
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    return torch.device(device)
+
 def double_dip_func(f, I0, A, width, f_center, f_delta):
     '''Double Lorentzian dip.'''
     return I0 - A/(1 + ((f_center - 0.5*f_delta - f)/width)**2) - A/(1 + ((f_center + 0.5*f_delta - f)/width)**2)
 
+def synthetic_double_dip_map(M, N, freq, noise=0.005, seed=None):
+    '''Generates an (M, N, F) map of double-dip spectra with Gaussian noise for testing the fitter.
+    Widths and splittings are drawn at random for every pixel.
+    Returns (data, truth), where truth is a dictionary with the (M, N) parameter maps used.'''
+    rng = np.random.default_rng(seed)
+    truth = {
+        "I0": np.ones((M, N)),
+        "A": np.full((M, N), 0.15),
+        "width": rng.uniform(0.001, 0.004, (M, N)),
+        "f_center": np.full((M, N), 2.87),
+        "f_delta": rng.uniform(0.0, 0.010, (M, N)),
+    }
+    data = double_dip_func(freq, *[truth[key][..., None] for key in ["I0", "A", "width", "f_center", "f_delta"]])
+    data += rng.normal(0, noise, data.shape)
+    return data, truth
+
 class DoubleLorentzianModel(nn.Module):
     def __init__(self, I0, A, width, f_center, f_delta):
         super(DoubleLorentzianModel, self).__init__()
@@ -50,7 +81,471 @@ class DoubleLorentzianModel(nn.Module):
         lorentzian2 = A / (1 + ((f_center + 0.5 * f_delta - f) / width) ** 2)
         return I0 - (lorentzian1 + lorentzian2)
 
-def fit_double_lorentzian(data, freq, lr=0.0005, epochs=10000, tail=5, thresholds=[3, 5], error_threshold=0.1, default_values=None, batch_size=300000):
+def double_dip_jacobian(f, I0, A, width, f_center, f_delta):
+    '''Derivatives of double_dip_func to (I0, A, width, f_center, f_delta), stacked along a new last axis.
+    Works on torch tensors.'''
+    u1 = (f_center - 0.5*f_delta - f) / width
+    u2 = (f_center + 0.5*f_delta - f) / width
+    L1 = 1 / (1 + u1**2)
+    L2 = 1 / (1 + u2**2)
+    d_I0 = torch.ones_like(u1)
+    d_A = -(L1 + L2)
+    d_width = -2*A * (u1**2 * L1**2 + u2**2 * L2**2) / width
+    d_f_center = 2*A * (u1 * L1**2 + u2 * L2**2) / width
+    d_f_delta = -A * (u1 * L1**2 - u2 * L2**2) / width
+    return torch.stack((d_I0, d_A, d_width, d_f_center, d_f_delta), dim=-1)
+
+param_names = ["I0", "A", "width", "f_center", "f_delta"]
+
+#Fitter settings used for processed maps (ODMR_2D_process.py) and the live fit during acquisition (live_fit.py).
+#Both store their results in the fit cache, so they need to agree.
+default_fit_settings = {"method": "lm", "lr": 0.0005, "epochs": 10000, "tail": 5, "thresholds": [3, 5],
+                        "error_threshold": 0.1, "max_iter": 100, "check_interval": 100, "tol": 1e-4,
+                        "likelihood": "mse", "snr_threshold": None}
+
+def _double_dip_model(f, p):
+    return double_dip_func(f, *[p[:, i:i+1] for i in range(5)])
+
+def _double_dip_model_jacobian(f, p):
+    return double_dip_jacobian(f, *[p[:, i:i+1] for i in range(5)])
+
+def r_squared(batch_data, mse):
+    '''Coefficient of determination of every spectrum in a (B, F) batch, given the per-pixel mean squared error.'''
+    batch_data = np.asarray(batch_data)
+    variance = np.var(batch_data, axis=1)
+    r2 = np.zeros(len(variance))
+    np.divide(mse, variance, out=r2, where=variance > 0)
+    return 1 - r2
+
+def _drop_converged(model, optimizer, keep, lr):
+    '''Removes the pixels that are not in keep from the model parameters and the Adam state.
+    Returns the new optimizer.'''
+    states = {}
+    for name, param in list(model.named_parameters()):
+        state = optimizer.state.get(param, {})
+        new_param = nn.Parameter(param.data[keep])
+        setattr(model, name, new_param)
+        states[name] = {key: (value[keep] if torch.is_tensor(value) and value.dim() > 0 else value) for key, value in state.items()}
+    optimizer = optim.Adam(model.parameters(), lr=lr)
+    for name, param in model.named_parameters():
+        if states[name]:
+            optimizer.state[param] = states[name]
+    return optimizer
+
+def fit_batch_adam(batch_data, freq, estimates, device, lr=0.0005, epochs=10000, check_interval=100, tol=1e-4, verbose=True):
+    '''Fits the double Lorentzian to a (B, F) batch of spectra with the Adam optimizer.
+    Every check_interval epochs the mean squared error of each pixel is compared with the previous check. Pixels
+    whose error improved by less than the fraction tol (but did not get worse) have converged: their parameters
+    are frozen and they are dropped from the optimization. The batch stops when all pixels have converged or after `epochs` epochs.
+    estimates: (B, 5) numpy array of initial parameters in the order of param_names.
+    Returns a dictionary of (B,) numpy arrays: the parameters, "converged", "iterations" and "mse".'''
+    B, F = batch_data.shape
+    target = torch.as_tensor(np.asarray(batch_data)).to(device=device, dtype=torch.float32, non_blocking=True)
+    freq_tensor = torch.tensor(freq, dtype=torch.float32).to(device).unsqueeze(0)
+    p0 = torch.tensor(estimates, dtype=torch.float32).to(device)
+
+    # Initialize the model with different initial guesses for each pixel
+    model = DoubleLorentzianModel(*[p0[:, i] for i in range(5)]).to(device)
+    optimizer = optim.Adam(model.parameters(), lr=lr)
+    # Per-pixel loss. The loss that is minimized is the sum of the pixel losses, so that the update of a
+    # pixel does not depend on how many other pixels are still being fitted.
+    criterion = nn.MSELoss(reduction='none')
+
+    params = np.zeros((B, 5))
+    mse = np.zeros(B)
+    iterations = np.zeros(B, dtype=np.int64)
+    converged = np.zeros(B, dtype=bool)
+    active = np.arange(B)
+    previous_mse = None
+
+    for epoch in range(epochs):
+        optimizer.zero_grad()
+        pixel_mse = criterion(model(freq_tensor), target).mean(dim=1)
+        pixel_mse.sum().backward()
+        optimizer.step()
+
+        last_epoch = epoch == epochs - 1
+        if (epoch + 1) % check_interval != 0 and not last_epoch:
+            continue
+        with torch.no_grad():
+            pixel_mse = criterion(model(freq_tensor), target).mean(dim=1)
+        if previous_mse is None:
+            done = torch.zeros_like(pixel_mse, dtype=torch.bool)
+        else:
+            #A pixel whose error went up is oscillating, not converged: it keeps being optimized
+            improvement = previous_mse - pixel_mse
+            done = (improvement >= 0) & (improvement <= tol * previous_mse)
+        finished = torch.ones_like(done) if last_epoch else done
+        if finished.any():
+            # Store the frozen pixels
+            index = active[finished.cpu().numpy()]
+            params[index] = torch.cat([torch.exp(getattr(model, "log_" + name).data[finished]) for name in param_names], dim=1).cpu().numpy()
+            mse[index] = pixel_mse[finished].cpu().numpy()
+            iterations[index] = epoch + 1
+            converged[index] = done[finished].cpu().numpy()
+
+        if verbose and epoch % 1000 < check_interval:
+            print("Epoch {}, active pixels: {}, mean loss: {}".format(epoch, len(active), pixel_mse.mean().item()))
+        if last_epoch or finished.all():
+            break
+        if finished.any():
+            keep = ~finished
+            optimizer = _drop_converged(model, optimizer, keep, lr)
+            target = target[keep]
+            active = active[keep.cpu().numpy()]
+            pixel_mse = pixel_mse[keep]
+        previous_mse = pixel_mse
+
+    batch_fitted_params = {name: params[:, i] for i, name in enumerate(param_names)}
+    batch_fitted_params["converged"] = converged
+    batch_fitted_params["iterations"] = iterations
+    batch_fitted_params["mse"] = mse
+    return batch_fitted_params
+
+def fit_batch_lm(batch_data, freq, estimates, device, max_iter=100, dtype=torch.float64, likelihood="mse"):
+    '''Fits the double Lorentzian to a (B, F) batch of spectra with the batched Levenberg-Marquardt solver.
+    estimates: (B, 5) numpy array of initial parameters in the order of param_names.
+    likelihood:
+    - "mse": unweighted least squares; errors are scaled by the residual variance
+    - "wls": batch_data are photon counts, least squares weighted by 1/counts (Neyman chi-square)
+    - "poisson": batch_data are photon counts, maximum Poisson likelihood
+    For "wls" and "poisson" the errors follow from the Fisher information (the noise level is known).
+    Returns a dictionary of (B,) numpy arrays: the parameters, their standard errors (key + "_err"),
+    "converged", "iterations" and the per-pixel mean squared error "mse". The count likelihoods also
+    return "chi2_red", the deviance or chi-square per degree of freedom.'''
+    #Frequencies are taken relative to the middle of the sweep to keep the problem well conditioned
+    f_ref = 0.5 * (np.max(freq) + np.min(freq))
+    f = torch.tensor(np.asarray(freq) - f_ref, dtype=dtype, device=device)
+    #Shares the memory of batch_data when it has this dtype already (no copy on the CPU)
+    y = torch.as_tensor(np.asarray(batch_data)).to(device=device, dtype=dtype, non_blocking=True)
+    p0 = torch.tensor(estimates, dtype=dtype, device=device)
+    p0[:, 3] -= f_ref
+
+    if likelihood == "mse":
+        result = levenberg_marquardt(_double_dip_model, _double_dip_model_jacobian, f, y, p0, max_iter=max_iter)
+    elif likelihood == "wls":
+        weights = 1 / torch.clamp(y, min=1)
+        result = levenberg_marquardt(_double_dip_model, _double_dip_model_jacobian, f, y, p0, weights=weights,
+                                     max_iter=max_iter, scale_covariance=False)
+    elif likelihood == "poisson":
+        result = levenberg_marquardt(_double_dip_model, _double_dip_model_jacobian, f, y, p0, max_iter=max_iter,
+                                     scale_covariance=False, loss="poisson")
+    else:
+        raise Exception("ERROR: unknown likelihood " + str(likelihood) + "!")
+    mse = ((y - _double_dip_model(f, result["params"]))**2).mean(dim=1)
+
+    params = result["params"].cpu().numpy()
+    errors = result["errors"].cpu().numpy()
+    params[:, 3] += f_ref
+    #The model is symmetric in the sign of width and f_delta
+    params[:, 2] = np.abs(params[:, 2])
+    params[:, 4] = np.abs(params[:, 4])
+    batch_fitted_params = {}
+    for i, name in enumerate(param_names):
+        batch_fitted_params[name] = params[:, i]
+        batch_fitted_params[name + "_err"] = errors[:, i]
+    batch_fitted_params["converged"] = result["converged"].cpu().numpy()
+    batch_fitted_params["iterations"] = result["iterations"].cpu().numpy()
+    batch_fitted_params["mse"] = mse.cpu().numpy()
+    if likelihood != "mse":
+        batch_fitted_params["chi2_red"] = result["cost"].cpu().numpy() / max(len(freq) - len(param_names), 1)
+    return batch_fitted_params
+
+#Automatic batch sizes stay within these limits
+min_batch_size = 64
+max_batch_size = 1000000
+#Batch size when the free memory cannot be determined (about 300 MB at 100 frequency points)
+fallback_batch_size = 10000
+#Fraction of the available host memory that the batches use without a memory_budget. Small, because the
+#acquisition, other fits (batch_process.py) and the rest of processing share it, and running out of host
+#memory cannot be recovered from.
+host_memory_fraction = 0.2
+
+def available_memory(device=None):
+    '''Free memory in bytes: of the GPU for a CUDA device, otherwise the available physical memory
+    (with psutil when installed). None when it cannot be determined.'''
+    if device is not None and torch.device(device).type == "cuda":
+        return torch.cuda.mem_get_info(torch.device(device))[0]
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def memory_in_use(device):
+    '''Memory in bytes used by the fit: the peak allocated on a CUDA device since the last
+    torch.cuda.reset_peak_memory_stats, otherwise the resident memory of this process (the peak
+    resident memory without psutil). None when it cannot be determined.'''
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device)
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    except ImportError:
+        return None
+
+def bytes_per_pixel(num_freq, num_params=5, method="lm"):
+    '''Rough peak memory (bytes) that fitting one pixel takes on the device: for "lm" the float64 spectrum,
+    model, residuals and Jacobian temporaries and the normal equations, for "adam" the float32 autograd graph
+    (both measured on the CPU, with some margin).'''
+    if method == "lm":
+        return 8 * (num_freq * (12 + 4*num_params) + 4*num_params**2)
+    return 4 * num_freq * 40
+
+def host_bytes_per_pixel(num_freq):
+    '''Host memory (bytes) per pixel of a batch besides the fit: the stored rows, the staging buffer
+    and the temporaries of estimate_initial_parameters.'''
+    return 32 * num_freq
+
+def auto_batch_size(num_freq, device, num_params=5, method="lm", memory_fraction=0.5, memory_budget=None):
+    '''Number of pixels per batch, between min_batch_size and max_batch_size. The host memory of a batch
+    stays within memory_budget (bytes), or host_memory_fraction of the available memory when memory_budget
+    is None; on CUDA devices the fit also stays within memory_fraction of the free GPU memory.
+    Callers that run several fits at once (batch_process.py) pass each one its share as memory_budget:
+    the free memory is the same for all of them.
+    On the CPU this estimate is the only protection: the operating system (the Linux OOM killer) usually
+    ends the process before a too large batch raises an error, so fit_double_lorentzian cannot back off
+    there as it does on CUDA devices.'''
+    host = memory_budget
+    if host is None:
+        free = available_memory()
+        host = None if free is None else host_memory_fraction * free
+    per_pixel = bytes_per_pixel(num_freq, num_params, method)
+    if device.type == "cuda":
+        free = available_memory(device)
+        sizes = [int(memory_fraction * free / per_pixel)]
+        if host is not None:
+            sizes.append(int(host / host_bytes_per_pixel(num_freq)))
+        batch_size = min(sizes)
+    elif host is None:
+        return fallback_batch_size
+    else:
+        batch_size = int(host / (per_pixel + host_bytes_per_pixel(num_freq)))
+    return int(np.clip(batch_size, min_batch_size, max_batch_size))
+
+def batch_memory(num_pixels, num_freq, num_params=5, method="lm", memory_budget=None):
+    '''Host memory (bytes) that the batches of a CPU fit of num_pixels pixels take, with the batch size of
+    auto_batch_size for memory_budget.'''
+    batch_size = auto_batch_size(num_freq, torch.device("cpu"), num_params, method, memory_budget=memory_budget)
+    return min(batch_size, num_pixels) * (bytes_per_pixel(num_freq, num_params, method) + host_bytes_per_pixel(num_freq))
+
+def is_out_of_memory(error):
+    '''Whether an exception is an allocation failure of torch (CUDA or CPU) or numpy.'''
+    if isinstance(error, (MemoryError, torch.cuda.OutOfMemoryError)):
+        return True
+    message = str(error)
+    return isinstance(error, RuntimeError) and ("out of memory" in message or "not enough memory" in message or "can't allocate memory" in message)
+
+def staging_buffer(rows, F, dtype, device):
+    '''(rows, F) host buffer for batches of spectra: a numpy view of a torch tensor, in page-locked
+    (pinned) memory for CUDA devices, so that the upload of a batch is a single asynchronous copy.'''
+    return torch.empty((rows, F), dtype=dtype, pin_memory=(device.type == "cuda")).numpy()
+
+def _initial_guess_pixel(intens, freq, tail, thresholds):
+    '''Initial guess (I0, A, width, f_center, f_delta) for a single spectrum, with the per-point dip detection loop.
+    This is the reference for estimate_initial_parameters, which uses it for pixels that cannot be vectorized.'''
+    F = len(intens)
+
+    # Estimate noise level
+    tail_values = np.concatenate((intens[:tail], intens[-tail:]))
+    noise_std = np.std(tail_values)
+    I0_est = float(np.average(tail_values))
+    A_est = float(np.max(intens) - np.min(intens) - 2*noise_std)
+
+    dips = []
+    dip_start = 0
+    in_dip = False
+    
+    # Calculate absolute threshold positions
+    threshold_low = np.min(intens) + thresholds[0]*noise_std
+    threshold_high = np.min(intens) + thresholds[1]*noise_std
+
+    for i in range(F):
+        if in_dip:
+            if intens[i] >= threshold_high:
+                dips.append((dip_start, i))
+                in_dip = False
+        else:
+            if intens[i] <= threshold_low:
+                dip_start = i
+                in_dip = True
+
+    if len(dips) == 0:
+        #There's almost nothing we can do with this :(
+        width_est = 1
+        f_center_est = np.average(freq)
+        f_delta_est = (np.max(freq) - np.min(freq)) / 4
+    elif len(dips) == 1:
+        f_dip_start = freq[dips[0][0]]
+        f_dip_finish = freq[dips[0][1]]
+        width_est = 0.5 * (f_dip_finish - f_dip_start)
+        f_center_est = 0.5 * (f_dip_start + f_dip_finish)
+        f_delta_est = 0.003 #Assume the nuclear splitting as the only splitting 
+        A_est *= 0.5
+    elif len(dips) == 2:
+        f_dip_start_1 = freq[dips[0][0]]
+        f_dip_finish_1 = freq[dips[0][1]]
+        f_dip_start_2 = freq[dips[1][0]]
+        f_dip_finish_2 = freq[dips[1][1]]
+        width_est = 0.25 * (f_dip_finish_1 + f_dip_finish_2 - f_dip_start_1 - f_dip_start_2)
+        middle_1 = 0.5 * (f_dip_finish_1 + f_dip_start_1) 
+        middle_2 = 0.5 * (f_dip_finish_2 + f_dip_start_2) 
+        f_center_est = 0.5 * (middle_1 + middle_2)
+        f_delta_est = middle_2 - middle_1
+    else:
+        #In this case, multiple "dips" were found, and it's not clear where the two peaks are located, or if it's even two peaks.
+        #With the information we have, we try as best as possible to give reasonable first estimates, and hope the optimizer will take care of it.
+        
+        #Base width estimate on average of all "dips"
+        width_est = 0.0
+        for i in range(len(dips)):
+            width_est += 0.5 * (freq[dips[i][1]] - freq[dips[i][0]])
+        width_est /= len(dips)
+        
+        #For center frequency, just take the middle of all the "dips"
+        f_center_est = 0.0
+        for i in range(len(dips)):
+            f_center_est += 0.5 * (freq[dips[i][1]] + freq[dips[i][0]])
+        f_center_est /= len(dips)
+        
+        #Estimating f_delta is the hardest part with multiple "dips". One reasonable measure would be the standard deviation of the middels of each "dip"
+        middles = np.zeros(len(dips))
+        for i in range(len(dips)):
+            middles[i] = 0.5 * (freq[dips[i][1]] - freq[dips[i][0]])
+        f_delta_est = np.std(middles)
+    return I0_est, A_est, width_est, f_center_est, f_delta_est
+
+def estimate_initial_parameters(data, freq, tail=5, thresholds=[3, 5]):
+    '''Initial guesses for fit_double_lorentzian, computed for all pixels at once.
+
+    For every spectrum the baseline and noise are taken from the `tail` points on both sides.
+    A dip starts where the intensity drops to min + thresholds[0]*noise and ends where it rises
+    back to min + thresholds[1]*noise. Width, center and splitting are estimated from the first
+    two dips (or from all of them when more than two are found).
+    Gives exactly the same estimates as _initial_guess_pixel applied to every pixel.
+
+    Returns five (M, N) arrays: I0, A, width, f_center, f_delta.'''
+    M, N, F = data.shape
+    P = M * N
+    freq = np.asarray(freq)
+    x = np.asarray(data).reshape(P, F)
+
+    # Baseline, noise and amplitude from the tails
+    tail_values = np.concatenate((x[:, :tail], x[:, -tail:]), axis=1)
+    noise_std = np.std(tail_values, axis=1)
+    I0_est = np.zeros(P)
+    A_est = np.zeros(P)
+    I0_est[:] = np.mean(tail_values, axis=1)
+    minimum = np.min(x, axis=1)
+    A_est[:] = np.max(x, axis=1) - minimum - 2*noise_std
+    threshold_low = minimum + thresholds[0]*noise_std
+    threshold_high = minimum + thresholds[1]*noise_std
+
+    # Hysteresis thresholding. Where the thresholds coincide (no tail noise) a point can both start and
+    # end a dip, which depends on the running state. Those pixels are done one by one below.
+    regular = threshold_low < threshold_high
+    below = x <= threshold_low[:, None]
+    above = x >= threshold_high[:, None]
+    #The state after each point is set by the last point that crossed one of the thresholds
+    last_event = np.where(below | above, np.arange(F), -1)
+    np.maximum.accumulate(last_event, axis=1, out=last_event)
+    in_dip = np.take_along_axis(below, np.maximum(last_event, 0), axis=1) & (last_event >= 0) & regular[:, None]
+    was_in_dip = np.zeros_like(in_dip)
+    was_in_dip[:, 1:] = in_dip[:, :-1]
+    start_pixel, start_index = np.nonzero(in_dip & ~was_in_dip)
+    end_pixel, end_index = np.nonzero(~in_dip & was_in_dip)
+
+    # Pair the k-th end of a pixel with its k-th start. A dip still open at the end of the sweep does not count.
+    num_dips = np.bincount(end_pixel, minlength=P)
+    num_starts = np.bincount(start_pixel, minlength=P)
+    start_rank = np.arange(len(start_pixel)) - (np.cumsum(num_starts) - num_starts)[start_pixel]
+    start_index = start_index[start_rank < num_dips[start_pixel]]
+    f_start = freq[start_index]
+    f_finish = freq[end_index]
+    first_dip = np.cumsum(num_dips) - num_dips
+
+    width_est = np.zeros(P)
+    f_center_est = np.zeros(P)
+    f_delta_est = np.zeros(P)
+
+    # No dips
+    none = num_dips == 0
+    width_est[none] = 1
+    f_center_est[none] = np.average(freq)
+    f_delta_est[none] = (np.max(freq) - np.min(freq)) / 4
+
+    # One dip: assume the nuclear splitting as the only splitting
+    one = num_dips == 1
+    d = first_dip[one]
+    width_est[one] = 0.5 * (f_finish[d] - f_start[d])
+    f_center_est[one] = 0.5 * (f_start[d] + f_finish[d])
+    f_delta_est[one] = 0.003
+    A_est[one] *= 0.5
+
+    # Two dips
+    two = num_dips == 2
+    d = first_dip[two]
+    width_est[two] = 0.25 * (f_finish[d] + f_finish[d + 1] - f_start[d] - f_start[d + 1])
+    middle_1 = 0.5 * (f_finish[d] + f_start[d])
+    middle_2 = 0.5 * (f_finish[d + 1] + f_start[d + 1])
+    f_center_est[two] = 0.5 * (middle_1 + middle_2)
+    f_delta_est[two] = middle_2 - middle_1
+
+    # More dips: averages over all of them. bincount adds in order, like a running sum.
+    many = num_dips > 2
+    half_widths = 0.5 * (f_finish - f_start)
+    count = np.maximum(num_dips, 1)
+    width_est[many] = (np.bincount(end_pixel, weights=half_widths, minlength=P) / count)[many]
+    f_center_est[many] = (np.bincount(end_pixel, weights=0.5 * (f_finish + f_start), minlength=P) / count)[many]
+    mean_half_width = np.bincount(end_pixel, weights=half_widths, minlength=P) / count
+    variance = np.bincount(end_pixel, weights=(half_widths - mean_half_width[end_pixel])**2, minlength=P) / count
+    f_delta_est[many] = np.sqrt(variance[many])
+    #np.std sums eight or more values pairwise, so take those few pixels one at a time
+    for p in np.flatnonzero(num_dips >= 8):
+        f_delta_est[p] = np.std(half_widths[first_dip[p]:first_dip[p] + num_dips[p]])
+
+    # Pixels without tail noise
+    for p in np.flatnonzero(~regular):
+        I0_est[p], A_est[p], width_est[p], f_center_est[p], f_delta_est[p] = _initial_guess_pixel(x[p], freq, tail, thresholds)
+
+    return tuple(estimate.reshape(M, N) for estimate in [I0_est, A_est, width_est, f_center_est, f_delta_est])
+
+def _fit_rows(rows, batch_data, freq, device, method, likelihood, exposure, tail, thresholds, max_iter, lr, epochs, check_interval, tol, verbose):
+    '''Fits one batch for fit_double_lorentzian. rows: the (B, F) spectra as stored, batch_data: the (B, F)
+    staging buffer that they are converted into for the fit.'''
+    estimates = np.stack(estimate_initial_parameters(rows[None], freq, tail, thresholds), axis=-1)[0]
+    batch_data[...] = rows
+    if likelihood != "mse":
+        #Fit the photon counts. The initial guesses scale with the data.
+        batch_data *= exposure
+        estimates[:, :2] *= exposure
+        batch_fitted_params = fit_batch_lm(batch_data, freq, estimates, device, max_iter=max_iter, likelihood=likelihood)
+        batch_fitted_params["r2"] = r_squared(batch_data, batch_fitted_params["mse"])
+        #Back to the scale of spectra normalized by their maximum
+        norm = np.max(batch_data, axis=1)
+        scale = np.zeros(len(rows))
+        np.divide(1, norm, out=scale, where=norm > 0)
+        for name in ["I0", "A", "I0_err", "A_err"]:
+            batch_fitted_params[name] = batch_fitted_params[name] * scale
+        batch_fitted_params["mse"] = batch_fitted_params["mse"] * scale**2
+    else:
+        if method == "lm":
+            batch_fitted_params = fit_batch_lm(batch_data, freq, estimates, device, max_iter=max_iter)
+        else:
+            batch_fitted_params = fit_batch_adam(batch_data, freq, estimates, device, lr=lr, epochs=epochs, check_interval=check_interval, tol=tol, verbose=verbose)
+        batch_fitted_params["r2"] = r_squared(rows, batch_fitted_params["mse"])
+    return batch_fitted_params
+
+def fit_double_lorentzian(data, freq, lr=0.0005, epochs=10000, tail=5, thresholds=[3, 5], error_threshold=0.1, default_values=None, batch_size=None, device=None, num_threads=None, method="adam", max_iter=100, check_interval=100, tol=1e-4, verbose=True, likelihood="mse", exposure=1.0, snr_threshold=None, memory_fraction=0.5, memory_budget=None, batch_log=None):
     '''
     Fits the double Lorentzian model to the (M, N, F) shaped input data.
     
@@ -61,195 +556,118 @@ def fit_double_lorentzian(data, freq, lr=0.0005, epochs=10000, tail=5, threshold
     - epochs: number of epochs for the optimization
     - tail: number of pixels to take from the side as a sample for baseline and noise
     - thresholds: relative values used to detect dips
+    - batch_size: number of pixels fitted at once. Host and device memory use scale with it, not with the map
+      size: every batch is read from data (which may be memory-mapped) and uploaded to the device on its own.
+      None (default) sizes the batches from memory_budget, or a fraction of the free memory (see auto_batch_size).
+      When a batch runs out of memory anyway, the batch size is halved and the batch is fitted again. This is a
+      safety net for CUDA devices: on the CPU the operating system (the Linux OOM killer) usually ends the process
+      before a MemoryError is raised, so there the batch size must come from the budget.
+    - memory_budget: host memory (bytes) that the batches may use. Pass it when several fits run at once.
+    - memory_fraction: fraction of the free GPU memory that the batches may use on CUDA devices
+    - batch_log: list to which a dictionary is appended for every batch, with its number of "pixels", "time" (s),
+      "pixels_per_s" and "memory" (bytes, see memory_in_use; None if unknown). Printed when verbose.
+    - device: torch device to fit on ("cuda", "cpu" or None for automatic selection, see select_device)
+    - num_threads: number of CPU threads for torch (only relevant when fitting on the CPU)
+    - method: "adam" (gradient descent with per-pixel early stopping) or "lm" (batched Levenberg-Marquardt, see lm_solver.py)
+    - max_iter: maximum number of Levenberg-Marquardt iterations per pixel (method "lm" only)
+    - check_interval, tol: every check_interval epochs, pixels whose mean squared error improved by less than the
+      fraction tol are frozen (method "adam" only, see fit_batch_adam)
+    - error_threshold: pixels with a higher mean squared error are set to default_values
+    - verbose: print progress
+    - likelihood: "mse" (least squares on data, normally normalized spectra), or "wls" / "poisson" to fit the
+      photon counts data * exposure with weighted least squares or the Poisson likelihood (method "lm" only,
+      see fit_batch_lm). The count fits return I0, A and their errors divided by the maximum of each spectrum,
+      and "mse" of the spectra normalized that way, so the maps compare directly with fits of normalized spectra.
+    - exposure: counts per unit of data for the count likelihoods, e.g. dwell time (s) * number of sweeps for count rates
+    - snr_threshold: pixels whose spectrum has a lower SNR (see spectrum_statistics.spectrum_snr) are not fitted
+      and get default_values. None fits all pixels.
 
     Returns:
-    - A dictionary containing five (M, N) numpy arrays for the fitted parameters: I0, A, width, f_center, f_delta.
+    - A dictionary containing five (M, N) numpy arrays for the fitted parameters: I0, A, width, f_center, f_delta,
+      and the per-pixel quality maps: "mse" (mean squared error), "r2" (coefficient of determination),
+      "iterations" (epochs or iterations used), "converged" (convergence flags) and "masked" (not fitted because
+      of the SNR screening; mse and r2 are NaN there).
+      With method "lm" it also contains the standard errors (I0_err, A_err, ...), and with the count likelihoods
+      "chi2_red" (deviance or chi-square per degree of freedom).
     '''
     M, N, F = data.shape
-    freq_tensor = torch.tensor(freq, dtype=torch.float32).cuda().unsqueeze(0).unsqueeze(0).repeat(M, N, 1)
-    intensity = torch.tensor(data, dtype=torch.float32).cuda()
-
-    # Initialize arrays for initial guesses
-    I0_est = np.zeros((M, N))
-    A_est = np.zeros((M, N))
-    width_est = np.zeros((M, N))
-    f_center_est = np.zeros((M, N))
-    f_delta_est = np.zeros((M, N))
-    
+    if likelihood != "mse" and method != "lm":
+        raise Exception("ERROR: likelihood " + str(likelihood) + " is only available with method lm!")
+    device = select_device(device, num_threads)
+    if verbose:
+        print("Fitting on device:", device)
+
     #Batch management
     total_pixels = M * N
-    batch_size = min(batch_size, total_pixels)
-    
-    print("Starting initial guesses")
-
-    for m in tqdm(range(M)):
-        for n in range(N):
-            # Get the intensity data for the current pixel
-            intens = data[m, n, :]
-
-            # Estimate noise level
-            tail_values = np.concatenate((intens[:tail], intens[-tail:]))
-            noise_std = np.std(tail_values)
-            I0_est[m, n] = np.average(tail_values)
-            A_est[m, n] = np.max(intens) - np.min(intens) - 2*noise_std
-
-            dips = []
-            dip_start = 0
-            in_dip = False
-            
-            # Calculate absolute threshold positions
-            #threshold_low = I0_est[m, n] - (1 - thresholds[0])*A_est[m, n]
-            #threshold_high = I0_est[m, n] - (1 - thresholds[1])*A_est[m, n]
-            threshold_low = np.min(intens) + thresholds[0]*noise_std
-            threshold_high = np.min(intens) + thresholds[1]*noise_std
-
-            for i in range(F):
-                if in_dip:
-                    if intens[i] >= threshold_high:
-                        dips.append((dip_start, i))
-                        in_dip = False
-                else:
-                    if intens[i] <= threshold_low:
-                        dip_start = i
-                        in_dip = True
-
-            if len(dips) == 0:
-                #print("Warning: somehow zero dips?")
-                #There's almost nothing we can do with this :(
-                width_est[m, n] = 1
-                f_center_est[m, n] = np.average(freq)
-                f_delta_est[m, n] = (np.max(freq) - np.min(freq)) / 4
-            elif len(dips) == 1:
-                f_dip_start = freq[dips[0][0]]
-                f_dip_finish = freq[dips[0][1]]
-                width_est[m, n] = 0.5 * (f_dip_finish - f_dip_start)
-                f_center_est[m, n] = 0.5 * (f_dip_start + f_dip_finish)
-                f_delta_est[m, n] = 0.003 #Assume the nuclear splitting as the only splitting 
-                A_est[m, n] *= 0.5
-            elif len(dips) == 2:
-                f_dip_start_1 = freq[dips[0][0]]
-                f_dip_finish_1 = freq[dips[0][1]]
-                f_dip_start_2 = freq[dips[1][0]]
-                f_dip_finish_2 = freq[dips[1][1]]
-                width_est[m, n] = 0.25 * (f_dip_finish_1 + f_dip_finish_2 - f_dip_start_1 - f_dip_start_2)
-                middle_1 = 0.5 * (f_dip_finish_1 + f_dip_start_1) 
-                middle_2 = 0.5 * (f_dip_finish_2 + f_dip_start_2) 
-                f_center_est[m, n] = 0.5 * (middle_1 + middle_2)
-                f_delta_est[m, n] = middle_2 - middle_1
-            else:
-                #In this case, multiple "dips" were found, and it's not clear where the two peaks are located, or if it's even two peaks.
-                #With the information we have, we try as best as possible to give reasonable first estimates, and hope the optimizer will take care of it.
-                
-                #Base width estimate on average of all "dips"
-                width_est[m, n] = 0
-                for i in range(len(dips)):
-                    f_dip_start = freq[dips[i][0]]
-                    f_dip_finish = freq[dips[i][1]]
-                    width_est[m, n] += 0.5 * (f_dip_finish - f_dip_start)
-                width_est[m, n] /= len(dips)
-                
-                #For center frequency, just take the middle of all the "dips"
-                f_center_est[m, n] = 0
-                for i in range(len(dips)):
-                    f_dip_start = freq[dips[i][0]]
-                    f_dip_finish = freq[dips[i][1]]
-                    f_center_est[m, n] += 0.5 * (f_dip_finish + f_dip_start)
-                f_center_est[m, n] /= len(dips)
-                
-                #Estimating f_delta is the hardest part with multiple "dips". One reasonable measure would be the standard deviation of the middels of each "dip"
-                middles = np.zeros(len(dips))
-                for i in range(len(dips)):
-                    f_dip_start = freq[dips[i][0]]
-                    f_dip_finish = freq[dips[i][1]]
-                    middles[i] = 0.5 * (f_dip_finish - f_dip_start)
-                f_delta_est[m, n] = np.std(middles)
-
-    print("Initial guess done! Now invoking optimizer.")
-    
-    # Prepare storage for fitted parameters
-    fitted_params = {
-        "I0": np.zeros((M, N)),
-        "A": np.zeros((M, N)),
-        "width": np.zeros((M, N)),
-        "f_center": np.zeros((M, N)),
-        "f_delta": np.zeros((M, N)),
-    }
-    
-    # Flatten data for easier batching
     data = data.reshape(-1, F)
-    num_batches = (total_pixels + batch_size - 1) // batch_size  # Number of batches
-    
-    I0_est_flat = I0_est.reshape(-1)
-    A_est_flat = A_est.reshape(-1)
-    width_est_flat = width_est.reshape(-1)
-    f_center_est_flat = f_center_est.reshape(-1)
-    f_delta_est_flat = f_delta_est.reshape(-1)
-    
-    for batch_idx in range(num_batches):
-        print("batch_idx:", batch_idx)
-        
-        start = batch_idx * batch_size
-        end = min(start + batch_size, total_pixels)
-        current_batch_size = end - start  # Current batch size, which may vary
-        
-        # Select the batch of data and convert to PyTorch tensor
-        batch_data = data[start:end]
-        batch_data = torch.tensor(batch_data, dtype=torch.float32).cuda()
+    if snr_threshold is None:
+        fit_indices = np.arange(total_pixels)
+    else:
+        fit_indices = np.flatnonzero(snr_map(data, tail) >= snr_threshold)
+        if verbose:
+            print("SNR screening: fitting {} of {} pixels".format(len(fit_indices), total_pixels))
+    fit_pixels = len(fit_indices)
+    if batch_size is None:
+        batch_size = auto_batch_size(F, device, len(param_names), method, memory_fraction, memory_budget)
+        if verbose:
+            print("Automatic batch size: {} pixels".format(batch_size))
+    batch_size = max(1, min(batch_size, fit_pixels))
+    #Only one batch is on the host in the fit dtype and on the device at a time, so the memory use is set
+    #by batch_size and not by the map size. Every batch is read from data (which may be memory-mapped),
+    #converted into the same staging buffer and uploaded from there.
+    staging = staging_buffer(batch_size, F, torch.float64 if method == "lm" else torch.float32, device)
+
+    # Prepare storage for fitted parameters
+    fitted_params = {name: np.zeros(total_pixels) for name in param_names}
+    fitted_params["mse"] = np.full(total_pixels, np.nan)
+    fitted_params["r2"] = np.full(total_pixels, np.nan)
+    fitted_params["iterations"] = np.zeros(total_pixels, dtype=np.int64)
+    fitted_params["converged"] = np.zeros(total_pixels, dtype=bool)
+    fitted_params["masked"] = np.ones(total_pixels, dtype=bool)
+    fitted_params["masked"][fit_indices] = False
     
-        # Convert initial guesses to torch tensors
-        I0 = torch.tensor(I0_est_flat[start:end], dtype=torch.float32).cuda()
-        A = torch.tensor(A_est_flat[start:end], dtype=torch.float32).cuda()
-        width = torch.tensor(width_est_flat[start:end], dtype=torch.float32).cuda()
-        f_center = torch.tensor(f_center_est_flat[start:end], dtype=torch.float32).cuda()
-        f_delta = torch.tensor(f_delta_est_flat[start:end], dtype=torch.float32).cuda()
-        
-        # Ensure the frequency tensor has the correct shape for broadcasting
-        freq_tensor = torch.tensor(freq, dtype=torch.float32).cuda().unsqueeze(0).expand(current_batch_size, -1)
-
-        # Initialize the model with different initial guesses for each pixel
-        model = DoubleLorentzianModel(I0, A, width, f_center, f_delta).cuda()
-
-        # Define the loss function (mean squared error)
-        criterion = nn.MSELoss()
-        optimizer = optim.Adam(model.parameters(), lr=lr)
-
-        # Optimization loop
-        for epoch in range(epochs):
-            optimizer.zero_grad()
-            output = model(freq_tensor)
-            
-            # Get the batch-specific target intensity for loss calculation
-            batch_target = intensity.view(-1, F)[start:end]  # Reshape and slice intensity for the batch
-            loss = criterion(output, batch_target)
-            loss.backward()
-            optimizer.step()
-
-            if epoch % 1000 == 0:
-                print(f'Epoch {epoch}, Loss: {loss.item()}')
-
-        # Extract the optimized parameters
-        """fitted_params = {
-            "I0": model.I0.data.cpu().numpy(),
-            "A": model.A.data.cpu().numpy(),
-            "width": model.width.data.cpu().numpy(),
-            "f_center": model.f_center.data.cpu().numpy(),
-            "f_delta": model.f_delta.data.cpu().numpy(),
-        }"""
-        batch_fitted_params = {
-        "I0": torch.exp(model.log_I0).data.cpu().numpy(),
-        "A": torch.exp(model.log_A).data.cpu().numpy(),
-        "width": torch.exp(model.log_width).data.cpu().numpy(),
-        "f_center": torch.exp(model.log_f_center).data.cpu().numpy(),
-        "f_delta": torch.exp(model.log_f_delta).data.cpu().numpy(),
-        }
-        
+    start = 0
+    while start < fit_pixels:
+        end = min(start + batch_size, fit_pixels)
+        idx = fit_indices[start:end]
+        if device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(device)
+        batch_start = time.perf_counter()
+        try:
+            #A view of the stored rows, unless the SNR screening picks them out
+            rows = np.asarray(data[start:end] if snr_threshold is None else data[idx])
+            batch_fitted_params = _fit_rows(rows, staging[:end - start], freq, device, method, likelihood, exposure, tail, thresholds,
+                                            max_iter, lr, epochs, check_interval, tol, verbose)
+        except (RuntimeError, MemoryError) as error:
+            if not is_out_of_memory(error) or batch_size == 1:
+                raise
+            #Release what the failed batch allocated and try again with half as many pixels
+            if device.type == "cuda":
+                torch.cuda.empty_cache()
+            batch_size = max(1, batch_size // 2)
+            if verbose:
+                print("Out of memory, fitting batches of {} pixels".format(batch_size))
+            continue
+        elapsed = time.perf_counter() - batch_start
+        entry = {"pixels": end - start, "time": elapsed, "pixels_per_s": (end - start) / max(elapsed, 1e-9), "memory": memory_in_use(device)}
+        if batch_log is not None:
+            batch_log.append(entry)
+        if verbose:
+            print("Pixels {} to {} of {}: {:.2f} s, {:.0f} pixels/s, {} MB in use, {} converged".format(
+                start, end, fit_pixels, elapsed, entry["pixels_per_s"],
+                "?" if entry["memory"] is None else "{:.0f}".format(entry["memory"] / 2**20), np.sum(batch_fitted_params["converged"])))
+
         # Place batch results into the final storage array
-        for param in fitted_params:
-            fitted_params[param].reshape(-1)[start:end] = batch_fitted_params[param].reshape(-1)
-        
-        #This batch is done. Now emptyy cache.
+        for param in batch_fitted_params:
+            if param not in fitted_params:
+                fitted_params[param] = np.zeros(total_pixels, dtype=batch_fitted_params[param].dtype)
+            fitted_params[param][idx] = batch_fitted_params[param].reshape(-1)
+        start = end
+
+    #The allocator keeps the memory of the batches for the next fit otherwise
+    if device.type == "cuda":
         torch.cuda.empty_cache()
-    
+
     # Reshape the final storage arrays back to (M, N)
     for param in fitted_params:
         fitted_params[param] = fitted_params[param].reshape(M, N)
@@ -258,13 +676,13 @@ def fit_double_lorentzian(data, freq, lr=0.0005, epochs=10000, tail=5, threshold
     if default_values is None:
         default_values = {"I0": 1.0, "A": 0, "width": 1.0, "f_center": 2.87, "f_delta": 0.0}
     
-    failed_pixels = (loss > error_threshold).cpu().numpy()  # Boolean mask of failed pixels
-    for param in fitted_params:
+    failed_pixels = ~(fitted_params["mse"] <= error_threshold)  # Boolean mask of failed pixels (also catches NaN and masked pixels)
+    for param in param_names:
         fitted_params[param][failed_pixels] = default_values[param]
         
     return fitted_params
 
-def inspect_initial_and_final_fit(data, freq, m, n, tail=5, thresholds=[3, 5], lr=0.0005, epochs=10000):
+def inspect_initial_and_final_fit(data, freq, m, n, tail=5, thresholds=[3, 5], lr=0.0005, epochs=10000, device=None):
     """
     Generates two plots for inspection:
     - Initial guessed parameters with thresholds and dip regions
@@ -278,7 +696,9 @@ def inspect_initial_and_final_fit(data, freq, m, n, tail=5, thresholds=[3, 5], l
     - thresholds: thresholds for detecting dips
     - lr: learning rate for optimizer
     - epochs: number of epochs for fitting
+    - device: torch device to fit on (None for automatic selection)
     """
+    device = select_device(device)
     intens = data[m, n, :]
     F = len(freq)
 
@@ -348,17 +768,17 @@ def inspect_initial_and_final_fit(data, freq, m, n, tail=5, thresholds=[3, 5], l
     plt.show()
 
     # Fine-tune parameters with the model
-    I0 = torch.tensor([I0_est], dtype=torch.float32, requires_grad=True).cuda()
-    A = torch.tensor([A_est], dtype=torch.float32, requires_grad=True).cuda()
-    width = torch.tensor([width_est], dtype=torch.float32, requires_grad=True).cuda()
-    f_center = torch.tensor([f_center_est], dtype=torch.float32, requires_grad=True).cuda()
-    f_delta = torch.tensor([f_delta_est], dtype=torch.float32, requires_grad=True).cuda()
-    freq_tensor = torch.tensor(freq, dtype=torch.float32).unsqueeze(0).cuda()
-
-    model = DoubleLorentzianModel(I0, A, width, f_center, f_delta).cuda()
+    I0 = torch.tensor([I0_est], dtype=torch.float32, requires_grad=True).to(device)
+    A = torch.tensor([A_est], dtype=torch.float32, requires_grad=True).to(device)
+    width = torch.tensor([width_est], dtype=torch.float32, requires_grad=True).to(device)
+    f_center = torch.tensor([f_center_est], dtype=torch.float32, requires_grad=True).to(device)
+    f_delta = torch.tensor([f_delta_est], dtype=torch.float32, requires_grad=True).to(device)
+    freq_tensor = torch.tensor(freq, dtype=torch.float32).unsqueeze(0).to(device)
+
+    model = DoubleLorentzianModel(I0, A, width, f_center, f_delta).to(device)
     optimizer = optim.Adam(model.parameters(), lr=lr)
     criterion = nn.MSELoss()
-    target_data = torch.tensor(intens, dtype=torch.float32).unsqueeze(0).cuda()
+    target_data = torch.tensor(intens, dtype=torch.float32).unsqueeze(0).to(device)
 
     for epoch in range(epochs):
         optimizer.zero_grad()
@@ -397,11 +817,7 @@ if __name__ == "__main__":
     freq = np.linspace(2.85, 2.89, F)
 
     # Generate synthetic data with two dips
-    intensity = np.zeros((M, N, F))
-    for m in range(M):
-        for n in range(N):
-            intensity[m, n, :] = double_dip_func(freq, 1, 0.15, np.random.uniform(0.001, 0.004), 2.87, np.random.uniform(0.0, 0.010))
-            intensity[m, n, :] += np.random.normal(0, 0.005, F)
+    intensity, truth = synthetic_double_dip_map(M, N, freq)
 
     inspect_initial_and_final_fit(intensity, freq, 0, 0)
     exit()
@@ -0,0 +1,140 @@
+'''Figure rendering for the processing scripts.
+
+Every figure is described by a plot spec, a dictionary that holds the data and how to
+show it. A spec with "kind": "map" (the default) is a colour map of an (M, N) array:
+- "data": (M, N) array, data[x][y]
+- "label": colour bar label (include a unit!)
+- "factor": multiplied with the data to match the label (default 1)
+- "clip": (a_min, a_max) applied before the factor, either may be None (default: no clipping)
+- "log": plot log10 of the data (default False)
+- "title", "cmap"
+- "suffix": added at the end of the file name. INCLUDE A FILE EXTENSION!
+
+A spec with "kind": "line" is a graph with one or more curves:
+- "curves": list of (x, y, format) tuples, format as in plt.plot (e.g. '.' or 'r-')
+- "xlabel", "ylabel", "title", "suffix"
+
+render_all() writes a list of specs to files on the Agg backend in a process pool, so that a
+scan can be processed without a display and without closing windows. render() draws a
+single spec, and shows it in a window when show is True.'''
+
+import os
+import matplotlib
+import matplotlib.pyplot as plt
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from map_pyramid import bin_2x2
+
+#Plot settings
+plot_settings = {'font.size': 24, 'figure.autolayout': True}
+plt.rcParams.update(plot_settings)
+PL_color = "inferno"
+contrast_color = "plasma"
+ps_color = "viridis"
+fshift_color = "cividis"
+interpolation = "nearest"
+#Larger maps are 2x2 binned before drawing; the figure cannot show more pixels anyway
+max_plot_pixels = 2048
+
+
+def map_spec(data, label, factor=1, title=None, suffix="out.png", cmap=PL_color, clip=None, log=False):
+    '''Plot spec of a colour map. See the module docstring.'''
+    return {"kind": "map", "data": data, "label": label, "factor": factor, "title": title,
+            "suffix": suffix, "cmap": cmap, "clip": clip, "log": log}
+
+
+def line_spec(curves, xlabel, ylabel, title=None, suffix="out.png"):
+    '''Plot spec of a graph. See the module docstring.'''
+    return {"kind": "line", "curves": curves, "xlabel": xlabel, "ylabel": ylabel, "title": title, "suffix": suffix}
+
+
+def plot_map(data, settings, color_label, unit_conversion_factor=1, title=None, suffix="out.png", filename_base="", cmap=PL_color, show=False):
+    """Data[x][y]
+    color label: What comes to display on the color bar (include a unit!)
+    unit conversion factor: By which factor does the data need to be multiplied to match the label.
+    suffix: Added at the end of the file name. INCLUDE A FILE EXTENSION!
+    show: Show the figure in a window after saving it."""
+
+    # Colour plot of diamond surface
+    fig = plt.figure(figsize=(12,8))
+    #imshow is (y, x) instead of (x, y) as we have our PL data in, so transpose PL
+    pos = plt.imshow(data.T * unit_conversion_factor, cmap=cmap, interpolation = interpolation, extent = [settings["x1"], settings["x2"], settings["y1"], settings["y2"]], origin="lower")
+    if(title != None):
+        plt.title(title)
+    plt.xlabel("x (mm)", fontweight ="bold")
+    plt.ylabel("y (mm)", fontweight ="bold")
+    cb = plt.colorbar(pos)
+    cb.set_label(color_label, rotation=270, fontweight ="bold", labelpad=30)
+    plt.savefig(filename_base + suffix, dpi = 100, transparent=False)
+    if(show):
+        plt.show()
+    plt.close(fig)
+
+
+def plot_lines(curves, xlabel, ylabel, title=None, suffix="out.png", filename_base="", show=False):
+    '''Graph of the (x, y, format) curves, saved to filename_base + suffix.'''
+    fig = plt.figure()
+    for x, y, fmt in curves:
+        plt.plot(x, y, fmt)
+    if(title != None):
+        plt.title(title)
+    plt.xlabel(xlabel)
+    plt.ylabel(ylabel)
+    plt.savefig(filename_base + suffix, dpi = 100, transparent=False, bbox_inches="tight")
+    if(show):
+        plt.show()
+    plt.close(fig)
+
+
+def render(spec, settings, filename_base, show=False):
+    '''Draws one plot spec and saves it to filename_base + spec["suffix"]. Returns the file name.'''
+    kind = spec.get("kind", "map")
+    if(kind == "map"):
+        data = np.asarray(spec["data"], dtype=float)
+        while max(data.shape) > max_plot_pixels:
+            data = bin_2x2(data)
+        clip = spec.get("clip")
+        if(clip != None):
+            data = np.clip(data, a_min=clip[0], a_max=clip[1])
+        if(spec.get("log", False)):
+            with np.errstate(divide="ignore", invalid="ignore"):
+                data = np.log10(data)
+        plot_map(data, settings, spec["label"], spec.get("factor", 1), title=spec.get("title"), suffix=spec["suffix"],
+                 filename_base=filename_base, cmap=spec.get("cmap", PL_color), show=show)
+    elif(kind == "line"):
+        plot_lines(spec["curves"], spec["xlabel"], spec["ylabel"], title=spec.get("title"), suffix=spec["suffix"],
+                   filename_base=filename_base, show=show)
+    else:
+        raise Exception("ERROR: unknown plot kind " + str(kind) + "!")
+    return filename_base + spec["suffix"]
+
+
+def _init_worker():
+    plt.switch_backend("Agg")
+    plt.rcParams.update(plot_settings)
+
+
+def _render_headless(spec, settings, filename_base):
+    return render(spec, settings, filename_base, show=False)
+
+
+def render_all(specs, settings, filename_base, processes=None, show=False):
+    '''Renders a list of plot specs to files.
+    With show=False the figures are rendered on the Agg backend in a pool of `processes`
+    worker processes (default: one per CPU, at most one per figure). With show=True they
+    are drawn one by one in the current process and shown in windows.
+    Returns the list of written files.'''
+    if(show):
+        return [render(spec, settings, filename_base, show=True) for spec in specs]
+    if(len(specs) == 0):
+        return []
+    if(processes == None):
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(specs))
+    if(processes <= 1):
+        _init_worker()
+        return [_render_headless(spec, settings, filename_base) for spec in specs]
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker) as pool:
+        futures = [pool.submit(_render_headless, spec, settings, filename_base) for spec in specs]
+        return [future.result() for future in futures]
@@ -0,0 +1,123 @@
+'''Persistent cache of fitted parameter maps.
+
+Fitting a full ODMR map takes much longer than plotting it, and the data do not change
+between reruns of ODMR_2D_process.py. The cache stores all fitted maps (parameters and
+quality metrics) next to the scan, in a directory with one .npz file per fitter
+configuration. An entry is reused when the frequency axis and the fitter configuration
+are identical. The data are hashed in blocks of rows; when only some blocks changed,
+only those rows are refitted.'''
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+cache_version = 1
+rows_per_block = 8
+
+
+def _hash(*buffers):
+    h = hashlib.blake2b(digest_size=16)
+    for buffer in buffers:
+        h.update(buffer)
+    return h.hexdigest()
+
+
+def config_key(freq, config):
+    '''Hash of the frequency axis and the fitter configuration (a JSON-serializable dictionary).'''
+    freq = np.ascontiguousarray(freq, dtype=np.float64)
+    settings = json.dumps({"version": cache_version, "config": config}, sort_keys=True)
+    return _hash(freq.tobytes(), settings.encode())
+
+
+def fit_config(fit_settings, normalization):
+    '''Cache configuration of a double Lorentzian fit of spectra normalized with the given method.'''
+    return dict(fit_settings, normalization=normalization)
+
+
+def block_hashes(data):
+    '''Content hash of every block of rows_per_block rows of data (along the first axis).
+    Memory-mapped data are read one block at a time.'''
+    hashes = []
+    for start in range(0, data.shape[0], rows_per_block):
+        block = np.ascontiguousarray(data[start:start + rows_per_block])
+        hashes.append(_hash(str(block.dtype).encode(), str(block.shape).encode(), block.tobytes()))
+    return np.array(hashes)
+
+
+def cache_file(cache_dir, key):
+    return os.path.join(cache_dir, key + ".npz")
+
+
+def load(cache_dir, key):
+    '''Returns (maps, hashes) of a cache entry, or (None, None) if there is none.'''
+    path = cache_file(cache_dir, key)
+    if not os.path.exists(path):
+        return None, None
+    with np.load(path) as stored:
+        hashes = stored["__block_hashes__"]
+        maps = {name: stored[name] for name in stored.files if not name.startswith("__")}
+    return maps, hashes
+
+
+def save(cache_dir, key, maps, hashes, config=None):
+    '''Writes a cache entry. The file is replaced atomically.'''
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_file(cache_dir, key)
+    temporary = path + ".tmp.npz"
+    extra = {"__block_hashes__": hashes, "__config__": np.array(json.dumps(config, sort_keys=True))}
+    np.savez(temporary, **maps, **extra)
+    os.replace(temporary, path)
+
+
+def store(data, freq, maps, config, cache_dir):
+    '''Stores maps that were fitted elsewhere as the cache entry of data, freq and config.'''
+    save(cache_dir, config_key(freq, config), maps, block_hashes(data), config)
+
+
+def invalidate(cache_dir, key=None):
+    '''Removes one cache entry, or the whole cache when key is None.'''
+    if key is None:
+        if os.path.isdir(cache_dir):
+            shutil.rmtree(cache_dir)
+    elif os.path.exists(cache_file(cache_dir, key)):
+        os.remove(cache_file(cache_dir, key))
+
+
+def cached_fit(data, freq, fit_function, config, cache_dir):
+    '''Returns the fitted maps of the (M, N, F) data, from the cache where possible.
+
+    Arguments:
+    - data: (M, N, F) array (may be memory-mapped) that is fitted
+    - freq: (F,) frequency axis
+    - fit_function: fit_function(subset) fits an (m, N, F) subset of data and returns a dictionary of (m, N) maps
+    - config: dictionary with everything else that determines the fit result (fitter parameters, normalization, ...)
+    - cache_dir: directory of the cache, normally next to the scan
+
+    Rows in blocks whose content changed since the cached fit are refitted and merged into the cached maps,
+    unless fit_function returns other maps than the cached ones: then all rows are fitted again.'''
+    key = config_key(freq, config)
+    hashes = block_hashes(data)
+    maps, cached_hashes = load(cache_dir, key)
+
+    if maps is not None and len(cached_hashes) == len(hashes) and all(m.shape[:2] == data.shape[:2] for m in maps.values()):
+        changed_blocks = np.flatnonzero(cached_hashes != hashes)
+        if len(changed_blocks) == 0:
+            print("Using cached fit from " + cache_file(cache_dir, key))
+            return maps
+        rows = np.concatenate([np.arange(b * rows_per_block, min((b + 1) * rows_per_block, data.shape[0])) for b in changed_blocks])
+        print("Cached fit found, refitting {} of {} rows that changed.".format(len(rows), data.shape[0]))
+        refitted = fit_function(np.asarray(data[rows]))
+        if set(refitted) == set(maps):
+            for name in maps:
+                maps[name][rows] = refitted[name]
+        else:
+            #The entry was written by another fit function (e.g. the live fit), with other maps
+            print("Cached maps differ from the fit results, refitting all rows.")
+            maps = fit_function(data)
+    else:
+        maps = fit_function(data)
+
+    save(cache_dir, key, maps, hashes, config)
+    return maps
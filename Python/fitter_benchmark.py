@@ -0,0 +1,69 @@
+'''Benchmark of fit_double_lorentzian on the available devices.
+
+Fits the same synthetic map on every requested device with every requested method and reports the throughput
+(pixels/s) and the accuracy of the fitted parameters with respect to the ground truth.
+Example:
+    python3 fitter_benchmark.py --size 50 --epochs 2000 --devices cpu cuda --threads 8'''
+
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+
+from double_dip_fitter import fit_double_lorentzian, synthetic_double_dip_map
+
+
+def accuracy(fitted_params, truth, keys=["f_center", "f_delta", "width"]):
+    '''Median absolute error of the fitted parameters (GHz).'''
+    return {key: float(np.median(np.abs(fitted_params[key] - truth[key]))) for key in keys}
+
+
+def benchmark_device(data, freq, truth, device, epochs, num_threads=None, **fit_kwargs):
+    '''Fits data on one device. Returns a dictionary with time, throughput and errors.'''
+    M, N, F = data.shape
+    start = time.perf_counter()
+    fitted_params = fit_double_lorentzian(data, freq, epochs=epochs, device=device, num_threads=num_threads, **fit_kwargs)
+    if device == "cuda":
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+    result = {"device": device, "method": fit_kwargs.get("method", "adam"), "time": elapsed, "pixels_per_s": M * N / elapsed}
+    result.update(accuracy(fitted_params, truth))
+    return result
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Compare throughput and accuracy of the double Lorentzian fitter on CPU and GPU, with Adam and Levenberg-Marquardt.")
+    parser.add_argument('--size', type=int, default=50, help="Map size (size x size pixels).")
+    parser.add_argument('--num-freq', type=int, default=100, help="Number of frequency points.")
+    parser.add_argument('--epochs', type=int, default=2000, help="Optimizer epochs.")
+    parser.add_argument('--devices', nargs="+", default=["cpu", "cuda"], help="Devices to benchmark.")
+    parser.add_argument('--threads', type=int, default=None, help="Number of CPU threads for torch.")
+    parser.add_argument('--methods', nargs="+", default=["adam", "lm"], help="Fit methods to benchmark.")
+    parser.add_argument('--batch-size', type=int, default=None, help="Pixels per batch (default: sized from the free memory of the device).")
+    parser.add_argument('--noise', type=float, default=0.005, help="Standard deviation of the noise on the synthetic data.")
+    args = parser.parse_args()
+
+    freq = np.linspace(2.85, 2.89, args.num_freq)
+    data, truth = synthetic_double_dip_map(args.size, args.size, freq, noise=args.noise, seed=0)
+
+    results = []
+    for device in args.devices:
+        if device == "cuda" and not torch.cuda.is_available():
+            print("CUDA not available, skipping GPU benchmark.")
+            continue
+        for method in args.methods:
+            results.append(benchmark_device(data, freq, truth, device, args.epochs, args.threads, method=method, batch_size=args.batch_size))
+
+    print()
+    print("{:<8}{:<8}{:>10}{:>12}{:>22}{:>21}{:>19}".format("device", "method", "time (s)", "pixels/s", "f_center err (MHz)", "f_delta err (MHz)", "width err (MHz)"))
+    for r in results:
+        print("{:<8}{:<8}{:>10.2f}{:>12.1f}{:>22.4f}{:>21.4f}{:>19.4f}".format(r["device"], r["method"], r["time"], r["pixels_per_s"],
+              r["f_center"]*1e3, r["f_delta"]*1e3, r["width"]*1e3))
+    return 0
+
+
+if __name__ == "__main__":
+    exitcode = main()
+    if exitcode != 0:
+        sys.exit(exitcode)
@@ -0,0 +1,147 @@
+'''Focus tracking for 2D scans.
+
+Instead of the fixed plane z = z0 + ax*(x - x0) + ay*(y - y0) from hand-entered tilts, ODMR_2D.py
+can keep a running model of the sample surface. Every probe_interval measured pixels it makes a
+short z-probe around the predicted surface (probe_focus()) and adds the PL maximum it finds to a
+SurfaceModel, which gives the z targets of the next pixels:
+- no probes yet: the hand-entered plane;
+- probes on a line only (the first row of the scan): the hand-entered tilts, shifted and tilted along
+  the line to the probes;
+- then a robust (Huber) plane through the probes;
+- with "thin_plate" and at least min_probes probes, a smoothed thin-plate spline on top of that plane,
+  which follows warped (e.g. bonded) samples. Away from the probes it falls back to the plane.
+Probes that find no clear maximum inside their z range, or land more than max_jump away from the
+prediction, are kept in the record but not used.'''
+
+import numpy as np
+from scipy.interpolate import RBFInterpolator
+
+from surface_detection import fit_plane
+
+#A direction is fitted once the probes spread along it by at least this fraction of their largest spread
+min_span = 0.2
+
+
+class SurfaceModel:
+    '''Running model z(x, y) (mm) of the surface, updated with add().'''
+    def __init__(self, z0, ax, ay, x0=0.0, y0=0.0, model="thin_plate", min_probes=6, smoothing=1e-3, max_jump=0.02):
+        '''z0, ax, ay, x0, y0: the initial plane z0 + ax*(x - x0) + ay*(y - y0)
+        model: "plane" or "thin_plate"
+        min_probes: number of probes before the thin-plate spline is used
+        smoothing: smoothing of the thin-plate spline (in units of the probed area)
+        max_jump: largest accepted difference (mm) between a probe and the prediction'''
+        if(model not in ["plane", "thin_plate"]):
+            raise Exception("ERROR: unknown surface model " + str(model) + "!")
+        self.prior = (z0, ax, ay, x0, y0)
+        self.model = model
+        self.min_probes = min_probes
+        self.smoothing = smoothing
+        self.max_jump = max_jump
+        #All probes: position, found z (NaN if none), prediction at the time and whether it is used
+        self.probes = {"x": [], "y": [], "z": [], "predicted": [], "accepted": []}
+        self._plane = None
+        self._spline = None
+
+    def prior_z(self, x, y):
+        z0, ax, ay, x0, y0 = self.prior
+        return z0 + ax*(np.asarray(x) - x0) + ay*(np.asarray(y) - y0)
+
+    def z(self, x, y):
+        '''Predicted surface z at (x, y). Scalars or arrays.'''
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        z = self.prior_z(x, y)
+        if(self._plane != None):
+            dz, bx, by, xm, ym = self._plane
+            z = z + dz + bx*(x - xm) + by*(y - ym)
+        if(self._spline != None):
+            spline, xm, ym, scale = self._spline
+            points = np.stack((np.ravel(x - xm), np.ravel(y - ym)), axis=1) / scale
+            z = z + spline(points).reshape(np.shape(z))
+        return z if np.ndim(z) else float(z)
+
+    def add(self, x, y, z_found):
+        '''Adds a probe at (x, y) that found the surface at z_found (None if no maximum was found)
+        and updates the model. Returns True if the probe is used.'''
+        predicted = self.z(x, y)
+        accepted = z_found != None and abs(z_found - predicted) <= self.max_jump
+        for key, value in zip(["x", "y", "z", "predicted", "accepted"], [x, y, np.nan if z_found == None else z_found, predicted, accepted]):
+            self.probes[key].append(value)
+        if(accepted):
+            self._update()
+        return accepted
+
+    def _update(self):
+        used = np.array(self.probes["accepted"])
+        x = np.array(self.probes["x"])[used]
+        y = np.array(self.probes["y"])[used]
+        #Everything is fitted relative to the initial plane, around the mean probe position. Only directions
+        #that the probes span are fitted (not across the first row), the others keep the initial tilt.
+        residual = np.array(self.probes["z"])[used] - self.prior_z(x, y)
+        xm, ym = np.mean(x), np.mean(y)
+        xy = np.stack((x - xm, y - ym), axis=1)
+        axes = np.linalg.svd(xy, full_matrices=False)[2] if len(x) > 1 else np.eye(2)
+        uv = xy @ axes.T
+        spread = np.std(uv, axis=0)
+        spanned = spread > min_span * max(spread[0], 1e-12)
+        uv[:, ~spanned] = 0
+        if(len(residual) < 3):
+            dz, bu, bv = np.mean(residual), 0.0, 0.0
+        else:
+            dz, bu, bv = fit_plane(uv[:, 0], uv[:, 1], residual, method="huber")
+        bx, by = np.array([bu, bv]) @ axes
+        self._plane = (dz, bx, by, xm, ym)
+        self._spline = None
+        if(self.model == "thin_plate" and len(residual) >= self.min_probes and spanned.all()):
+            scale = spread[0]
+            values = residual - (dz + xy @ np.array([bx, by]))
+            spline = RBFInterpolator(xy / scale, values, kernel="thin_plate_spline", smoothing=self.smoothing, degree=1)
+            self._spline = (spline, xm, ym, scale)
+
+    def probe_arrays(self):
+        return {key: np.array(values) for key, values in self.probes.items()}
+
+
+def probe_focus(measure_rate, z_center, half_range=0.01, steps=7, min_contrast=0.2):
+    '''Short z-probe: measures the count rate at steps positions from z_center - half_range to z_center + half_range
+    (measure_rate: function z -> counts/s) and locates the maximum with a parabola through the highest point and
+    its neighbours. Returns (z_peak, z, rates); z_peak is None if the maximum lies at the edge of the range or
+    is less than min_contrast (relative) above the lowest rate, e.g. off the diamond.'''
+    z = np.linspace(z_center - half_range, z_center + half_range, steps)
+    rates = np.array([measure_rate(zi) for zi in z], dtype=float)
+    i = int(np.argmax(rates))
+    if(i == 0 or i == steps - 1 or rates[i] <= (1 + min_contrast) * np.min(rates)):
+        return None, z, rates
+    left, top, right = rates[i - 1:i + 2]
+    curvature = left - 2*top + right
+    step = z[1] - z[0]
+    return z[i] + 0.5*step*(left - right)/curvature, z, rates
+
+
+def save_probes(path, model):
+    '''Stores the probes of a SurfaceModel in path (.npz).'''
+    np.savez(path, **model.probe_arrays())
+
+
+if __name__ == "__main__":
+    #Serpentine scan over a tilted and warped simulated sample, probing every 37 pixels:
+    #focus error of the hand-entered plane against the tracked surface models
+    from instruments import SimulatedSample
+    sample = SimulatedSample(tilt=(-0.0009, 0.1), warp=10.0)
+    rng = np.random.default_rng(0)
+    dwell = 0.05
+    xs = np.linspace(-0.03, 0.03, 60)
+    ys = np.linspace(-0.03, 0.03, 60)
+    for model_name in ["plane", "thin_plate"]:
+        model = SurfaceModel(sample.z_top, -0.0009, 0.0, model=model_name)
+        errors = []
+        pixel = 0
+        for iy, y in enumerate(ys):
+            for x in (xs if iy % 2 == 0 else xs[::-1]):
+                if(pixel % 37 == 0):
+                    z_peak = probe_focus(lambda z: rng.poisson(sample.rate(x, y, z) * dwell) / dwell, model.z(x, y))[0]
+                    model.add(x, y, z_peak)
+                errors.append(model.z(x, y) - sample.surface(x, y))
+                pixel += 1
+        fixed = sample.z_top - 0.0009*xs[:, None] - sample.surface(xs[:, None], ys[None, :])
+        print("{}: {} probes, RMS focus error {:.2f} um (fixed plane {:.2f} um)".format(
+            model_name, len(model.probes["z"]), 1e3*np.sqrt(np.mean(np.square(errors))), 1e3*np.sqrt(np.mean(np.square(fixed)))))
@@ -0,0 +1,227 @@
+'''Long-lived instrument broker.
+
+Setting up the time tagger, the LabOne Q session and the three stage connections takes
+a while, and every scan script used to do it again at startup. The broker is a local
+process that opens these connections once and keeps them. Scripts connect to it with
+connect_instruments(), which returns an object with the same interface as
+instruments.Instruments, so a scan only pays for a local socket connection.
+
+Start the broker once per session:
+    python3 instrument_broker.py
+or, without hardware:
+    python3 instrument_broker.py --simulate
+
+Clients are served one at a time: a second script waits until the first one has
+disconnected, so two scans never drive the stages at the same time.'''
+
+import sys
+import argparse
+import unittest
+from multiprocessing.connection import Listener, Client
+
+from instruments import Instruments
+
+broker_address = ("localhost", 6020)
+broker_authkey = b"odmr-instrument-broker"
+
+#Methods of Instruments that clients may call
+exposed_methods = ["count_rate", "photon_counts", "set_osc_frequency", "stage_call", "stage_diagnostics", "full_autozero", "ping"]
+
+
+def _handle_client(conn, instruments):
+    '''Serves requests of one client until it disconnects. Returns True if the client asked for a shutdown.'''
+    while True:
+        try:
+            method, args, kwargs = conn.recv()
+        except (EOFError, ConnectionResetError):
+            return False
+        if(method == "shutdown"):
+            conn.send(("ok", None))
+            return True
+        if(method not in exposed_methods):
+            conn.send(("error", "Unknown broker method: " + str(method)))
+            continue
+        try:
+            result = getattr(instruments, method)(*args, **kwargs)
+        except Exception as e:
+            conn.send(("error", repr(e)))
+        else:
+            conn.send(("ok", result))
+
+
+def serve(instruments, address=broker_address, authkey=broker_authkey):
+    '''Serves the given Instruments object until a client sends "shutdown".'''
+    with Listener(address, authkey=authkey) as listener:
+        print("Instrument broker listening on {}:{}".format(*address))
+        while True:
+            conn = listener.accept()
+            try:
+                shutdown = _handle_client(conn, instruments)
+            finally:
+                conn.close()
+            if(shutdown):
+                break
+    instruments.close()
+    print("Instrument broker stopped.")
+
+
+class RemoteStage:
+    '''Stage controller proxy. Every method call is executed by the broker.
+    open() and close() do nothing: the broker owns the connection.'''
+    def __init__(self, client, axis):
+        self._client = client
+        self._axis = axis
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __getattr__(self, method):
+        if(method.startswith("_")):
+            raise AttributeError(method)
+        def call(*args, **kwargs):
+            return self._client._call("stage_call", self._axis, method, *args, **kwargs)
+        return call
+
+
+class BrokerClient:
+    '''Client side of the broker. Has the same interface as instruments.Instruments.'''
+    def __init__(self, address=broker_address, authkey=broker_authkey):
+        self._conn = Client(address, authkey=authkey)
+        self._stages = {}
+
+    def _call(self, method, *args, **kwargs):
+        self._conn.send((method, args, kwargs))
+        status, result = self._conn.recv()
+        if(status != "ok"):
+            raise Exception("ERROR: instrument broker: " + result)
+        return result
+
+    def stage(self, axis):
+        if(axis not in self._stages):
+            self._stages[axis] = RemoteStage(self, axis)
+        return self._stages[axis]
+
+    def count_rate(self, dwell_time):
+        return self._call("count_rate", dwell_time)
+
+    def photon_counts(self, dwell_time):
+        return self._call("photon_counts", dwell_time)
+
+    def set_osc_frequency(self, osc_frequency):
+        return self._call("set_osc_frequency", osc_frequency)
+
+    def stage_diagnostics(self, axis):
+        return self._call("stage_diagnostics", axis)
+
+    def full_autozero(self):
+        return self._call("full_autozero")
+
+    def ping(self):
+        return self._call("ping")
+
+    def shutdown(self):
+        '''Stops the broker and closes its instrument connections.'''
+        self._call("shutdown")
+        self.close()
+
+    def close(self):
+        '''Disconnects from the broker. The instrument connections stay open.'''
+        self._conn.close()
+
+
+def connect_instruments(use_broker=True, simulate=False):
+    '''Returns an object to control the instruments with.
+    With use_broker, connects to a running broker and falls back to direct connections
+    (instruments.Instruments) when no broker is running.'''
+    if(use_broker):
+        try:
+            client = BrokerClient()
+            print("Connected to instrument broker.")
+            return client
+        except (ConnectionRefusedError, FileNotFoundError):
+            print("No instrument broker running. Connecting to the instruments directly.")
+    return Instruments(simulate=simulate)
+
+
+###############################################################################
+class TestInstrumentBroker(unittest.TestCase):
+    '''Runs a broker with simulated instruments in a background thread.'''
+
+    address = ("localhost", 6021)
+
+    def setUp(self):
+        import threading
+        self.instruments = Instruments(simulate=True)
+        self.thread = threading.Thread(target=serve, args=(self.instruments, self.address), daemon=True)
+        self.thread.start()
+        import time
+        for attempt in range(100):
+            try:
+                self.client = BrokerClient(self.address)
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.01)
+
+    def tearDown(self):
+        self.client.shutdown()
+        self.thread.join(timeout=5)
+
+    def test_stage_moves(self):
+        pi_z = self.client.stage("z")
+        pi_z.move(4.5)
+        self.assertTrue(pi_z.get_on_target_state())
+        self.assertEqual(pi_z.get_real_position(), 4.5)
+        self.assertEqual(self.instruments.stage("z").position, 4.5)
+        self.assertTrue(pi_z.wait_on_target(timeout=10))
+
+    def test_count_rate(self):
+        self.client.stage("z").move(self.instruments.sample.z_top)
+        in_focus = self.client.count_rate(2e11)
+        self.client.stage("z").move(self.instruments.sample.z_top - 0.05)
+        out_of_focus = self.client.count_rate(2e11)
+        self.assertGreater(in_focus, out_of_focus)
+
+    def test_odmr_dip(self):
+        z_top = self.instruments.sample.z_top
+        self.client.stage("z").move(z_top)
+        self.client.set_osc_frequency(1e9) #Far from resonance
+        off_resonance = self.client.count_rate(1e12)
+        f_dip = self.instruments.sample.f_center - 0.5*self.instruments.sample.f_delta
+        self.client.set_osc_frequency(f_dip - 2.8e9)
+        on_resonance = self.client.count_rate(1e12)
+        self.assertLess(on_resonance, off_resonance)
+
+    def test_errors_are_forwarded(self):
+        with self.assertRaises(Exception):
+            self.client.stage("w").move(0)
+        self.assertEqual(self.client.ping(), "pong")
+
+###############################################################################
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Keep the instrument connections open and share them with the scan scripts.")
+    parser.add_argument('--simulate', action='store_true', help="Use simulated instruments instead of hardware.")
+    parser.add_argument('--port', type=int, default=broker_address[1], help="Local port to listen on.")
+    parser.add_argument('--stop', action='store_true', help="Stop a running broker.")
+    args = parser.parse_args()
+    address = (broker_address[0], args.port)
+
+    if(args.stop):
+        BrokerClient(address).shutdown()
+        return 0
+
+    instruments = Instruments(simulate=args.simulate)
+    print("Connecting to the instruments...")
+    instruments.connect_all()
+    serve(instruments, address)
+    return 0
+
+
+if __name__ == "__main__":
+    exitcode = main()
+    if exitcode != 0:
+        sys.exit(exitcode)
@@ -0,0 +1,380 @@
+'''Shared instrument setup for the confocal scan scripts.
+
+ODMR_2D.py, z_scan.py and single_SPAD_ODMR.py all talk to the same hardware: the
+Swabian time tagger, the Zurich Instruments SHFSG and the three PI piezo stages.
+The descriptor, addresses and connection routines live here so they are defined
+once. Simulated stand-ins for every device are included, so the scripts and the
+instrument broker can be exercised without any hardware attached.'''
+
+import time
+import numpy as np
+
+#SHFSG setup. Only channel 1 (q1) is used for the ODMR drive.
+SHFSG_DESCRIPTOR = """
+instruments:
+  SHFSG:
+    - address: DEV12120
+      uid: device_shfsg
+      interface: 1GbE
+
+connections:
+  device_shfsg:
+    - iq_signal: q0/drive_line
+      ports: SGCHANNELS/0/OUTPUT
+    - iq_signal: q0/drive_line_ef
+      ports: SGCHANNELS/0/OUTPUT
+    - iq_signal: q1/drive_line
+      ports: SGCHANNELS/1/OUTPUT
+    - iq_signal: q1/drive_line_ef
+      ports: SGCHANNELS/1/OUTPUT
+    - iq_signal: q2/drive_line
+      ports: SGCHANNELS/2/OUTPUT
+    - iq_signal: q2/drive_line_ef
+      ports: SGCHANNELS/2/OUTPUT
+    - iq_signal: q3/drive_line
+      ports: SGCHANNELS/3/OUTPUT
+    - iq_signal: q3/drive_line_ef
+      ports: SGCHANNELS/3/OUTPUT
+    - iq_signal: q4/drive_line
+      ports: SGCHANNELS/4/OUTPUT
+    - iq_signal: q4/drive_line_ef
+      ports: SGCHANNELS/4/OUTPUT
+    - iq_signal: q5/drive_line
+      ports: SGCHANNELS/5/OUTPUT
+    - iq_signal: q5/drive_line_ef
+      ports: SGCHANNELS/5/OUTPUT
+"""
+server_host = "localhost" #LabOne data server
+server_port = '8004'
+channel_index = 1          #which channel am I using   #1 is 2
+output_range = 0           #leave at 0 = limit of small amp, large amp has 7 dbm but check for large amp to make sure
+center_frequency = 2.8e9   #Hz
+rflf_path = 1
+osc1_frequency = 7e7       #Hz
+gains_cw = (0.0, 0.95, 0.95, 0.0) #unitless
+
+#Piezo stack
+stage_addresses = {
+    "x": "type=tcp;host=192.168.20.21;port=50000",
+    "y": "type=tcp;host=192.168.20.22;port=50000",
+    "z": "type=tcp;host=192.168.20.23;port=50000",
+}
+stage_velocity = 5
+
+#Time tagger
+countrate_channels = [1]   # 1 is 1
+
+
+def define_calibration():
+    '''Baseline signal calibration of the drive line.'''
+    from laboneq.simple import Calibration, SignalCalibration, Oscillator, ModulationType
+
+    calib = Calibration()
+    calib[f"/logical_signal_groups/q1/drive_line"] = \
+        SignalCalibration(
+            oscillator = Oscillator(
+                frequency = osc1_frequency,
+                modulation_type = ModulationType.HARDWARE,
+            ),
+            local_oscillator = Oscillator(
+                frequency = center_frequency,              #center frequency Hz
+            ),
+            range = output_range,                          #Strength in dBm
+        )
+    return calib
+
+
+def connect_signal_generator():
+    '''Connects to the SHFSG and configures the CW output of the drive channel.
+    Returns (session, channel). The channel object accepts configure_sine_generation(...).'''
+    from laboneq.simple import DeviceSetup, Session
+
+    my_setup = DeviceSetup.from_descriptor(
+        yaml_text=SHFSG_DESCRIPTOR,
+        server_host=server_host,
+        server_port=server_port,
+        setup_name='Setup_Name',
+    )
+    my_setup.set_calibration(define_calibration())
+    my_session = Session(device_setup=my_setup)
+    my_session.connect()
+
+    instrument_serial = my_setup.instruments[0].address
+    device = my_session.devices[instrument_serial]
+    channel = device.sgchannels[channel_index]
+
+    # Configure RF output
+    channel.configure_channel(enable = True, output_range = output_range,
+                              center_frequency = center_frequency, rf_path = rflf_path)
+    # Configure digital sine generator
+    channel.configure_sine_generation(enable = True,
+                                      osc_index = 0, osc_frequency = osc1_frequency,
+                                      phase = 0, gains = gains_cw)
+    return my_session, channel
+
+
+def open_stage(axis):
+    '''Opens the piezo stage controller of one axis ("x", "y" or "z") and sets its velocity.'''
+    from rtcs.devices.physikinstrumente.pi_E873_controller import Pistage_controller
+    stage = Pistage_controller(stage_addresses[axis])
+    stage.open()
+    stage.send_command("VEL 1 {}".format(stage_velocity))
+    return stage
+
+
+def stage_diagnostics(stage):
+    '''Queries servo, error, velocity, on-target and motion status of a stage.
+    Used by the anti-stuck procedure. Returns a dictionary of raw responses.'''
+    responses = {}
+    for query in ["SVO?", "ERR?", "VEL?", "ONT?"]:
+        stage.send_command(query)
+        responses[query] = stage._readline()
+    stage._transport.write(b'\x05')
+    responses["#5 (motion status)"] = stage._readline()
+    return responses
+
+
+###############################################################################
+#Simulated stand-ins. They mimic the parts of the device APIs that the scripts use.
+
+class SimulatedSample:
+    '''Synthetic NV diamond slab used by the simulated devices.
+    PL peaks (Lorentzian in z) at the top and back surface, the diamond occupies the disk
+    of the given radius around (x_c, y_c), the top surface is tilted and bowed by warp (mm per mm²,
+    like bonded samples), and NV centers show a double dip around
+    f_center when the microwave drive is on.'''
+    def __init__(self, z_top=4.531, thickness=0.1, tilt=(0.0, 0.0), x_c=0.0, y_c=0.0, radius=np.inf, warp=0.0,
+                 brightness=2e5, background=300, depth_of_focus=0.004,
+                 contrast=0.1, width=4e6, f_center=2.87e9, f_delta=1e7):
+        self.z_top = z_top
+        self.thickness = thickness
+        self.tilt = tilt
+        self.x_c = x_c
+        self.y_c = y_c
+        self.radius = radius
+        self.warp = warp
+        self.brightness = brightness
+        self.background = background
+        self.depth_of_focus = depth_of_focus
+        self.contrast = contrast
+        self.width = width
+        self.f_center = f_center
+        self.f_delta = f_delta
+
+    def surface(self, x, y):
+        '''z position of the top surface at (x, y).'''
+        return (self.z_top + self.tilt[0]*(x - self.x_c) + self.tilt[1]*(y - self.y_c)
+                + self.warp*((x - self.x_c)**2 + (y - self.y_c)**2))
+
+    def rate(self, x, y, z, frequency=None):
+        '''Expected count rate (counts/s) at stage position (x, y, z) and microwave frequency (Hz, None is off).'''
+        if((x - self.x_c)**2 + (y - self.y_c)**2 > self.radius**2):
+            return self.background
+        z_top = self.surface(x, y)
+        focus = 1/(1 + ((z - z_top)/self.depth_of_focus)**2) + 1/(1 + ((z - z_top - self.thickness)/self.depth_of_focus)**2)
+        odmr = 1.0
+        if(frequency != None):
+            for f_dip in [self.f_center - 0.5*self.f_delta, self.f_center + 0.5*self.f_delta]:
+                odmr -= self.contrast / (1 + ((frequency - f_dip)/self.width)**2)
+        return self.background + self.brightness * focus * odmr
+
+
+class SimulatedStage:
+    '''Stand-in for Pistage_controller. Moves are instantaneous.'''
+    def __init__(self, axis):
+        self.axis = axis
+        self.position = 0.0
+        self.target = 0.0
+        self.is_open = False
+        self._last_response = ""
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def send_command(self, command):
+        self._last_response = "0"
+
+    def _readline(self):
+        return self._last_response
+
+    def move(self, position):
+        self.target = float(position)
+        self.position = float(position)
+
+    def get_on_target_state(self):
+        return True
+
+    def wait_on_target(self, timeout=None):
+        return True
+
+    def get_real_position(self):
+        return self.position
+
+    def get_target_position(self):
+        return self.target
+
+    def autozero(self):
+        self.position = 0.0
+        self.target = 0.0
+
+
+class SimulatedSignalGenerator:
+    '''Stand-in for an SHFSG channel. Remembers the configured oscillator frequency.'''
+    def __init__(self):
+        self.enabled = False
+        self.osc_frequency = None
+
+    def configure_channel(self, enable, output_range, center_frequency, rf_path):
+        self.enabled = enable
+
+    def configure_sine_generation(self, enable, osc_index, osc_frequency, phase, gains):
+        self.enabled = enable
+        self.osc_frequency = osc_frequency
+
+    def frequency(self):
+        '''Absolute drive frequency in Hz, or None when the drive is off.'''
+        if(not self.enabled or self.osc_frequency == None):
+            return None
+        return center_frequency + self.osc_frequency
+
+
+class SimulatedCountrate:
+    '''Stand-in for TimeTagger.Countrate. Draws Poisson counts from a SimulatedSample
+    at the current position of the simulated stages.'''
+    def __init__(self, sample, stages, signal_generator, seed=None):
+        self.sample = sample
+        self.stages = stages
+        self.signal_generator = signal_generator
+        self.rng = np.random.default_rng(seed)
+        self._data = np.zeros(1)
+
+    def startFor(self, duration):
+        '''duration in picoseconds, like the real Countrate.'''
+        seconds = duration * 1e-12
+        expected = self.sample.rate(self.stages["x"].position, self.stages["y"].position, self.stages["z"].position,
+                                    self.signal_generator.frequency())
+        self._data = np.array([self.rng.poisson(expected * seconds) / seconds])
+
+    def waitUntilFinished(self):
+        pass
+
+    def getData(self):
+        return self._data
+
+
+###############################################################################
+
+class Instruments:
+    '''Owns the time tagger, the signal generator and the three piezo stages.
+    Every device is connected on first use and stays connected until close(), so the
+    same object can serve many scans (see instrument_broker.py).
+    simulate: use the simulated stand-ins instead of hardware.'''
+    def __init__(self, simulate=False, sample=None):
+        self.simulate = simulate
+        self.sample = sample if sample != None else SimulatedSample()
+        self._stages = {}
+        self._countrate = None
+        self._tagger = None
+        self._session = None
+        self._sg_channel = None
+
+    def connect_all(self):
+        '''Opens every connection now rather than on first use.'''
+        for axis in ["x", "y", "z"]:
+            self.stage(axis)
+        self._get_signal_generator()
+        self._get_countrate()
+
+    def stage(self, axis):
+        '''Returns the (opened) stage controller of axis "x", "y" or "z".'''
+        if(axis not in stage_addresses):
+            raise Exception("ERROR: unknown stage axis " + str(axis) + "!")
+        if(axis not in self._stages):
+            if(self.simulate):
+                self._stages[axis] = SimulatedStage(axis)
+                self._stages[axis].open()
+            else:
+                self._stages[axis] = open_stage(axis)
+        return self._stages[axis]
+
+    def _get_signal_generator(self):
+        if(self._sg_channel == None):
+            if(self.simulate):
+                self._sg_channel = SimulatedSignalGenerator()
+                self._sg_channel.configure_channel(enable = True, output_range = output_range,
+                                                   center_frequency = center_frequency, rf_path = rflf_path)
+            else:
+                self._session, self._sg_channel = connect_signal_generator()
+        return self._sg_channel
+
+    def _get_countrate(self):
+        if(self._countrate == None):
+            if(self.simulate):
+                for axis in ["x", "y", "z"]:
+                    self.stage(axis)
+                self._countrate = SimulatedCountrate(self.sample, self._stages, self._get_signal_generator())
+            else:
+                import TimeTagger
+                self._tagger = TimeTagger.createTimeTagger()
+                self._countrate = TimeTagger.Countrate(tagger=self._tagger, channels=countrate_channels)
+        return self._countrate
+
+    def count_rate(self, dwell_time):
+        '''Counts for dwell_time (picoseconds) and returns the count rate in counts/s.'''
+        countrate = self._get_countrate()
+        countrate.startFor(dwell_time)
+        countrate.waitUntilFinished()
+        return float(countrate.getData()[0])
+
+    def photon_counts(self, dwell_time):
+        '''Counts for dwell_time (picoseconds) and returns the number of detected photons.'''
+        return int(round(self.count_rate(dwell_time) * dwell_time * 1e-12))
+
+    def set_osc_frequency(self, osc_frequency):
+        '''Sets the digital oscillator frequency (Hz, relative to center_frequency) of the drive channel.'''
+        self._get_signal_generator().configure_sine_generation(enable = True,
+                                                               osc_index = 0,
+                                                               osc_frequency = osc_frequency,
+                                                               phase = 0,
+                                                               gains = gains_cw)
+
+    def stage_call(self, axis, method, *args, **kwargs):
+        '''Calls a method of a stage controller by name. This is what remote stages go through.'''
+        if(method.startswith("_")):
+            raise Exception("ERROR: private stage method " + method + " cannot be called!")
+        return getattr(self.stage(axis), method)(*args, **kwargs)
+
+    def stage_diagnostics(self, axis):
+        return stage_diagnostics(self.stage(axis))
+
+    def full_autozero(self):
+        '''Moves all axes home and autozeroes them one by one.'''
+        sleep_time = 0 if self.simulate else 1
+        self.stage("z").move(0)
+        self.stage("y").move(0)
+        self.stage("x").move(0)
+        time.sleep(3 * sleep_time)
+        for axis in ["x", "y", "z"]:
+            self.stage(axis).autozero()
+            time.sleep(10 * sleep_time)
+
+    def ping(self):
+        return "pong"
+
+    def close(self):
+        '''Closes every open connection.'''
+        for stage in self._stages.values():
+            stage.close()
+        self._stages = {}
+        if(self._session != None):
+            self._session.disconnect()
+        self._session = None
+        self._sg_channel = None
+        if(self._tagger != None):
+            import TimeTagger
+            TimeTagger.freeTimeTagger(self._tagger)
+        self._tagger = None
+        self._countrate = None
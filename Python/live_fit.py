@@ -0,0 +1,146 @@
+'''Live double Lorentzian fitting during an ODMR scan.
+
+ODMR_2D.py hands every completed spectrum to a LiveFitter. A background thread normalizes
+and fits the completed pixels in batches on the CPU with Levenberg-Marquardt, and saves the
+live maps (fit contrast, splitting, frequency shift and all other fit results) next to the
+raw data as <scan>_live_fit.npz after every batch. A misaligned or dead scan is therefore
+visible after the first rows.
+
+When the scan ends, finish() fits the measured pixels that are left and stores the maps in the
+fit cache with the same settings and layout as ODMR_2D_process.py, so processing the scan with the
+default fit options does not fit it again. Pixels that the scan skipped (triangle, adaptive prescan)
+are not fitted: they keep fitted = False.'''
+
+import os
+import time
+import queue
+import threading
+import numpy as np
+
+import fit_cache
+from double_dip_fitter import fit_double_lorentzian, default_fit_settings
+from spectrum_statistics import pixel_maps
+from scan_data import measured_pixels, measured_column
+
+
+class LiveFitter:
+    def __init__(self, shape, freq_GHz, save_path, normalization="max", batch_size=256, num_threads=1, report_interval=60):
+        '''shape: (M, N) of the scan
+        freq_GHz: (F,) frequency axis in GHz
+        save_path: path of the scan without file extension
+        normalization: normalization of the spectra (see spectrum_statistics.normalization_values)
+        batch_size: maximum number of completed pixels fitted at once
+        num_threads: CPU threads for torch, keep low so the acquisition is not slowed down
+        report_interval: seconds between printed progress reports'''
+        self.shape = tuple(shape)
+        self.freq = np.asarray(freq_GHz, dtype=float)
+        self.save_path = save_path
+        self.normalization = normalization
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self.report_interval = report_interval
+        self.fit_settings = dict(default_fit_settings, method="lm")
+
+        self.maps = {}
+        self.fitted = np.zeros(self.shape, dtype=bool)
+        self.error = None
+        self._last_report = time.time()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, ix, iy, spectrum):
+        '''Hands the completed spectrum of pixel (ix, iy) to the fitter. Returns immediately.'''
+        self._queue.put((ix, iy, np.array(spectrum, dtype=float)))
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            #Take all other spectra that completed in the meantime
+            while len(items) < self.batch_size:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = items[-1] is None
+            items = [item for item in items if item is not None]
+            if items and self.error == None:
+                try:
+                    ix = np.array([item[0] for item in items])
+                    iy = np.array([item[1] for item in items])
+                    self._fit_pixels(ix, iy, np.stack([item[2] for item in items]))
+                    self.save()
+                    self._report()
+                except Exception as e:
+                    #Never interrupt the acquisition; the scan can still be processed afterwards
+                    self.error = e
+                    print("\nWARNING: live fit stopped: " + str(e))
+            if stop:
+                return
+
+    def _fit_pixels(self, ix, iy, spectra):
+        '''Normalizes and fits the (B, F) spectra of the pixels (ix, iy) and writes the results into the maps.'''
+        normalized = pixel_maps(spectra, method=self.normalization)["PL_normalized"]
+        fitted_params = fit_double_lorentzian(normalized[None], self.freq, device="cpu", num_threads=self.num_threads, verbose=False, **self.fit_settings)
+        with self._lock:
+            for name, values in fitted_params.items():
+                if name not in self.maps:
+                    self.maps[name] = np.zeros(self.shape, dtype=values.dtype)
+                self.maps[name][ix, iy] = values[0]
+            self.fitted[ix, iy] = True
+
+    def live_maps(self):
+        '''Copy of the current maps: the fit results, "contrast", "splitting" and "frequency_shift" (GHz)
+        and the mask "fitted" of the pixels fitted so far.'''
+        with self._lock:
+            maps = {name: values.copy() for name, values in self.maps.items()}
+            maps["fitted"] = self.fitted.copy()
+        if "A" in maps:
+            maps["contrast"] = maps["A"]
+            maps["splitting"] = maps["f_delta"]
+            maps["frequency_shift"] = np.where(maps["fitted"], maps["f_center"] - 2.87, 0)
+        return maps
+
+    def save(self):
+        '''Writes the live maps to <scan>_live_fit.npz (replaced atomically).'''
+        path = self.save_path + "_live_fit.npz"
+        np.savez(path + ".tmp.npz", **self.live_maps())
+        os.replace(path + ".tmp.npz", path)
+
+    def _report(self):
+        if time.time() - self._last_report < self.report_interval:
+            return
+        self._last_report = time.time()
+        maps = self.live_maps()
+        fitted = maps["fitted"]
+        print("\nLive fit: {} of {} pixels. Median contrast: {:.3f}, median splitting: {:.2f} MHz, median shift: {:.2f} MHz".format(
+            np.sum(fitted), fitted.size, np.median(maps["contrast"][fitted]), 1e3*np.median(maps["splitting"][fitted]),
+            1e3*np.median(maps["frequency_shift"][fitted])))
+
+    def finish(self, PL):
+        '''Waits for the pending fits, fits the measured pixels that were never submitted (see
+        scan_data.measured_pixels; all pixels for scans without a progress file), saves the live maps
+        and stores them in the fit cache of the scan.
+        PL: (M, N, F) data of the full scan in counts/s, as saved. Returns the live maps.'''
+        self._queue.put(None)
+        self._thread.join()
+        if self.error != None:
+            return self.live_maps()
+        try:
+            measured = measured_pixels(self.save_path, self.shape)
+            remaining = np.nonzero(~self.fitted if measured is None else ~self.fitted & measured)
+            if len(remaining[0]) > 0:
+                self._fit_pixels(remaining[0], remaining[1], np.asarray(PL)[remaining])
+            self.save()
+
+            #Same normalized data, layout (only the measured pixels) and configuration as ODMR_2D_process.py,
+            #so it finds this entry
+            PL_normalized = pixel_maps(PL, method=self.normalization)["PL_normalized"]
+            maps = {name: measured_column(values, measured) for name, values in self.maps.items()}
+            fit_cache.store(measured_column(PL_normalized, measured), self.freq, maps, fit_cache.fit_config(self.fit_settings, self.normalization), self.save_path + "_fitcache")
+            print("Live fit complete, results cached for processing.")
+        except Exception as e:
+            self.error = e
+            print("WARNING: could not complete the live fit: " + str(e))
+        return self.live_maps()
@@ -0,0 +1,149 @@
+'''Batched Levenberg-Marquardt least-squares solver.
+
+Fits one small nonlinear model to many independent data sets (pixels) at once. Every
+pixel has its own damping parameter and convergence state; converged pixels are
+removed from the active set, so the cost of an iteration shrinks as the map converges.
+The solver runs on any torch device.
+
+A model is given as two functions of the x values (F,) and a batch of parameters (B, P):
+- func(x, p) -> (B, F) model values
+- jacobian(x, p) -> (B, F, P) derivatives of the model values to the parameters
+
+Besides (weighted) least squares, the solver can maximize the Poisson likelihood of photon
+counts. The normal equations then use the Fisher information J^T diag(1/model) J, and the
+returned covariance is its inverse.'''
+
+import torch
+
+
+def levenberg_marquardt(func, jacobian, x, y, p0, weights=None, lower=None, upper=None, max_iter=100,
+                        ftol=1e-10, xtol=1e-8, lam0=1e-3, lam_up=10.0, lam_down=0.1, lam_max=1e10,
+                        scale_covariance=True, loss="lsq"):
+    '''Minimizes sum(weights * (y - func(x, p))**2) (loss "lsq") or the Poisson deviance
+    2 * sum(func(x, p) - y + y*log(y / func(x, p))) (loss "poisson") for every row of y independently.
+
+    Arguments:
+    - func, jacobian: model functions, see module docstring
+    - x: (F,) tensor of x values, shared by all pixels
+    - y: (B, F) tensor of data
+    - p0: (B, P) tensor of initial parameters
+    - weights: (B, F) tensor of weights (1/variance), or None for unweighted least squares. Not used for loss "poisson".
+    - lower, upper: (P,) bounds on the parameters, or None. Steps are projected onto the bounds.
+    - max_iter: maximum number of iterations per pixel
+    - ftol: converged when an accepted step reduces the cost by less than this fraction
+    - xtol: converged when every parameter changes by less than this fraction of its value
+    - lam0, lam_up, lam_down, lam_max: initial damping, and factors for rejected and accepted steps. Pixels whose
+      damping exceeds lam_max are stopped as not converged.
+    - scale_covariance: multiply the covariance by the reduced chi-square (use True when the weights do not
+      describe the absolute noise level)
+    - loss: "lsq" or "poisson". For "poisson", y are counts and the model must stay positive; steps to
+      non-positive model values are rejected.
+
+    Returns a dictionary with
+    - "params": (B, P) fitted parameters
+    - "covariance": (B, P, P) parameter covariance
+    - "errors": (B, P) standard errors (square root of the covariance diagonal)
+    - "cost": (B,) final weighted sum of squared residuals, or the Poisson deviance
+    - "converged": (B,) bool convergence flags
+    - "iterations": (B,) number of iterations used'''
+    B, P = p0.shape
+    F = y.shape[-1]
+    device = p0.device
+    p = p0.clone()
+    if lower is not None:
+        lower = torch.as_tensor(lower, dtype=p.dtype, device=device)
+    if upper is not None:
+        upper = torch.as_tensor(upper, dtype=p.dtype, device=device)
+    p = _project(p, lower, upper)
+
+    lam = torch.full((B,), lam0, dtype=p.dtype, device=device)
+    converged = torch.zeros(B, dtype=torch.bool, device=device)
+    active = torch.ones(B, dtype=torch.bool, device=device)
+    iterations = torch.zeros(B, dtype=torch.int64, device=device)
+    if loss not in ["lsq", "poisson"]:
+        raise Exception("ERROR: unknown loss " + str(loss) + "!")
+    cost = _cost(y, func(x, p), weights, loss)
+
+    for iteration in range(max_iter):
+        idx = torch.nonzero(active).squeeze(1)
+        if idx.numel() == 0:
+            break
+        p_a = p[idx]
+        y_a = y[idx]
+        w_a = weights[idx] if weights is not None else None
+        cost_a = cost[idx]
+
+        model_a = func(x, p_a)
+        JTJ, g = _normal_equations(jacobian(x, p_a), y_a - model_a, _fisher_weights(model_a, w_a, loss))
+        diagonal = torch.diagonal(JTJ, dim1=-2, dim2=-1)
+        #Marquardt scaling, with a floor so that directions without curvature are still damped
+        floor = 1e-12 * torch.clamp(diagonal.max(dim=1, keepdim=True).values, min=1e-30)
+        damping = lam[idx, None] * torch.maximum(diagonal, floor)
+        delta, info = torch.linalg.solve_ex(JTJ + torch.diag_embed(damping), g)
+
+        p_new = _project(p_a + delta, lower, upper)
+        cost_new = _cost(y_a, func(x, p_new), w_a, loss)
+        accepted = (info == 0) & torch.isfinite(cost_new) & (cost_new < cost_a)
+
+        step = (p_new - p_a).abs()
+        small_step = (step <= xtol * (p_a.abs() + xtol)).all(dim=1)
+        small_reduction = (cost_a - cost_new) <= ftol * cost_a
+        done = accepted & (small_step | small_reduction | (cost_new == 0))
+
+        p[idx] = torch.where(accepted[:, None], p_new, p_a)
+        cost[idx] = torch.where(accepted, cost_new, cost_a)
+        lam[idx] = torch.where(accepted, lam[idx] * lam_down, lam[idx] * lam_up)
+        iterations[idx] += 1
+        converged[idx] = done
+        active[idx] = ~done & (lam[idx] <= lam_max)
+
+    #Covariance from the Gauss-Newton approximation of the Hessian at the solution
+    model = func(x, p)
+    JTJ, g = _normal_equations(jacobian(x, p), y - model, _fisher_weights(model, weights, loss))
+    covariance = torch.linalg.pinv(JTJ, hermitian=True)
+    if scale_covariance:
+        dof = max(F - P, 1)
+        covariance = covariance * (cost / dof)[:, None, None]
+    errors = torch.sqrt(torch.clamp(torch.diagonal(covariance, dim1=-2, dim2=-1), min=0))
+
+    return {
+        "params": p,
+        "covariance": covariance,
+        "errors": errors,
+        "cost": cost,
+        "converged": converged,
+        "iterations": iterations,
+    }
+
+
+def _project(p, lower, upper):
+    if lower is not None:
+        p = torch.maximum(p, lower)
+    if upper is not None:
+        p = torch.minimum(p, upper)
+    return p
+
+
+def _cost(y, model, weights, loss="lsq"):
+    if loss == "poisson":
+        deviance = 2 * (model - y + torch.xlogy(y, y / model)).sum(dim=-1)
+        return torch.where((model > 0).all(dim=-1), deviance, torch.full_like(deviance, float("inf")))
+    residuals = y - model
+    if weights is None:
+        return (residuals**2).sum(dim=-1)
+    return (weights * residuals**2).sum(dim=-1)
+
+
+def _fisher_weights(model, weights, loss):
+    '''Weights of the normal equations: the given weights for least squares, 1/model (Fisher scoring) for Poisson counts.'''
+    if loss == "poisson":
+        return 1 / torch.clamp(model, min=1e-12)
+    return weights
+
+
+def _normal_equations(J, residuals, weights):
+    '''Returns J^T W J (B, P, P) and J^T W r (B, P).'''
+    JW = J if weights is None else J * weights[..., None]
+    JTJ = torch.einsum('bfp,bfq->bpq', JW, J)
+    g = torch.einsum('bfp,bf->bp', JW, residuals)
+    return JTJ, g
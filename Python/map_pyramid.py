@@ -0,0 +1,113 @@
+'''Multi-resolution pyramids of scan maps.
+
+Level 0 of a pyramid is the map itself, every next level averages 2x2 pixels of the previous
+one (NaN pixels are left out of the average, blocks at odd edges are smaller). The levels are
+stored next to the scan as <scan>_pyramid/<name>_<level>.npy with an index pyramid.json, and
+are read memory-mapped, so read_region() only loads the part of the level that is shown.
+pyramid_viewer.py browses them interactively, and spatial_fit.py uses bin_2x2 for its
+coarse-to-fine fit.
+
+Pixel i of level 0 covers x from x1 + i*(x2 - x1)/M to x1 + (i + 1)*(x2 - x1)/M, as in plot_map.'''
+
+import os
+import json
+import warnings
+import numpy as np
+
+#Maps are reduced until both sides are at most this many pixels
+min_size = 256
+
+
+def bin_2x2(data):
+    '''Mean of every 2x2 block of pixels of the (M, N, ...) data, ignoring NaN.
+    Returns a float32 (ceil(M/2), ceil(N/2), ...) array.'''
+    data = np.asarray(data, dtype=np.float32)
+    M, N = data.shape[:2]
+    padded = np.full((M + M % 2, N + N % 2) + data.shape[2:], np.nan, dtype=np.float32)
+    padded[:M, :N] = data
+    blocks = padded.reshape((padded.shape[0] // 2, 2, padded.shape[1] // 2, 2) + data.shape[2:])
+    with warnings.catch_warnings():
+        #All-NaN blocks stay NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanmean(blocks, axis=(1, 3))
+
+
+def pyramid_levels(data, smallest=min_size):
+    '''List of the levels of data, from data itself (level 0) down to the first level that fits in smallest x smallest.'''
+    levels = [data]
+    while max(levels[-1].shape[:2]) > smallest:
+        levels.append(bin_2x2(levels[-1]))
+    return levels
+
+
+def pyramid_dir(filename_base):
+    return filename_base + "_pyramid"
+
+
+def build_pyramid(maps, settings, filename_base, smallest=min_size):
+    '''Writes the pyramids of the (M, N) maps (dictionary name -> array) to <filename_base>_pyramid.
+    settings: scan settings, for the extent (x1, x2, y1, y2). Returns the pyramid index.'''
+    folder = pyramid_dir(filename_base)
+    os.makedirs(folder, exist_ok=True)
+    index = {"extent": [settings["x1"], settings["x2"], settings["y1"], settings["y2"]], "maps": {}}
+    for name, data in maps.items():
+        levels = pyramid_levels(np.asarray(data, dtype=np.float32), smallest)
+        for level, values in enumerate(levels):
+            np.save(os.path.join(folder, "{}_{}.npy".format(name, level)), values)
+        index["maps"][name] = [list(values.shape) for values in levels]
+    #Written last, so that an index always describes complete levels
+    with open(os.path.join(folder, "pyramid.json"), 'w') as f:
+        json.dump(index, f, indent=4)
+    return index
+
+
+def load_index(filename_base):
+    with open(os.path.join(pyramid_dir(filename_base), "pyramid.json"), 'r') as f:
+        return json.load(f)
+
+
+def open_level(filename_base, name, level):
+    '''Memory-mapped level of a stored pyramid.'''
+    return np.load(os.path.join(pyramid_dir(filename_base), "{}_{}.npy".format(name, level)), mmap_mode="r")
+
+
+def choose_level(index, name, x_range, y_range, max_pixels=1024):
+    '''Finest level at which the region x_range, y_range (mm) is at most max_pixels wide and high.'''
+    x1, x2, y1, y2 = index["extent"]
+    M, N = index["maps"][name][0][:2]
+    nx = abs(x_range[1] - x_range[0]) / abs(x2 - x1) * M
+    ny = abs(y_range[1] - y_range[0]) / abs(y2 - y1) * N
+    level = 0
+    while level + 1 < len(index["maps"][name]) and max(nx, ny) / 2**level > max_pixels:
+        level += 1
+    return level
+
+
+def read_region(filename_base, name, x_range=None, y_range=None, max_pixels=1024, index=None):
+    '''Reads the part of map `name` inside x_range, y_range (mm, default the whole map) at the finest level
+    that has at most max_pixels per side. Only that part of the level is loaded.
+    Returns (data, extent, level): the data[x][y] block, its extent [x1, x2, y1, y2] in mm and the level.'''
+    if index is None:
+        index = load_index(filename_base)
+    x1, x2, y1, y2 = index["extent"]
+    x_range = x_range if x_range is not None else (x1, x2)
+    y_range = y_range if y_range is not None else (y1, y2)
+    level = choose_level(index, name, x_range, y_range, max_pixels)
+    data = open_level(filename_base, name, level)
+    M, N = data.shape[:2]
+    #Pixel size at this level
+    px = (x2 - x1) / index["maps"][name][0][0] * 2**level
+    py = (y2 - y1) / index["maps"][name][0][1] * 2**level
+    def pixel_range(lo, hi, start, size, n):
+        a, b = sorted(((lo - start) / size, (hi - start) / size))
+        return max(0, int(np.floor(a))), min(n, int(np.ceil(b)))
+    i0, i1 = pixel_range(x_range[0], x_range[1], x1, px, M)
+    j0, j1 = pixel_range(y_range[0], y_range[1], y1, py, N)
+    i0, j0 = min(i0, M - 1), min(j0, N - 1)
+    i1, j1 = max(i1, i0 + 1), max(j1, j0 + 1)
+    block = np.array(data[i0:i1, j0:j1])
+    #Edges from the level 0 pixels: the last block of a level covers fewer of them when the size was odd
+    M0, N0 = index["maps"][name][0][:2]
+    def edge(i, M0):
+        return min(i * 2**level, M0) / M0
+    return block, [x1 + edge(i0, M0)*(x2 - x1), x1 + edge(i1, M0)*(x2 - x1), y1 + edge(j0, N0)*(y2 - y1), y1 + edge(j1, N0)*(y2 - y1)], level
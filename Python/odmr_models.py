@@ -0,0 +1,485 @@
+'''Library of batched ODMR resonance models.
+
+Every model describes a spectrum as a baseline I0 minus one or more dips, and provides the
+model values, the analytic Jacobian and vectorized initial guesses for a whole batch of
+pixels. All models are fitted with the same batched Levenberg-Marquardt engine (lm_solver.py).
+fit_models() fits several models to a map in a single pass over the data and selects the
+best model of every pixel with the AIC or BIC.
+
+Available models (frequencies in GHz, magnetic field in mT):
+- "single": one Lorentzian dip (I0, A, width, f0)
+- "double_symmetric": two Lorentzian dips with equal amplitude and width (I0, A, width, f_center, f_delta),
+  the model of double_dip_fitter.fit_double_lorentzian
+- "double": two Lorentzian dips with independent amplitudes and widths (I0, A1, A2, width1, width2, f1, f2)
+- "triple": 14N hyperfine triplet, three equal Lorentzian dips at f0 - a_hf, f0, f0 + a_hf (I0, A, width, f0, a_hf)
+- "eight": the eight dips of the four NV orientations in a magnetic field of arbitrary direction, in the
+  secular approximation f = D +- gamma*|B.n| (I0, A, width, D, Bx, By, Bz)
+- "gaussian": two Gaussian dips with equal amplitude and standard deviation (I0, A, sigma, f_center, f_delta)
+- "voigt": two pseudo-Voigt dips (eta * Lorentzian + (1 - eta) * Gaussian with the same half width at half
+  maximum), with equal amplitude and width (I0, A, width, eta, f_center, f_delta)
+
+Every model also maps its parameters to the common quantities I0, A, width, f_center and f_delta,
+so that the maps of ODMR_2D_process.py work with any model.'''
+
+import math
+import numpy as np
+import torch
+
+from lm_solver import levenberg_marquardt
+from spectrum_statistics import snr_map, tail_values
+from double_dip_fitter import (select_device, r_squared, estimate_initial_parameters, double_dip_func,
+                               double_dip_jacobian, auto_batch_size, param_names as common_names)
+
+gamma_NV = 0.028025 #GHz per mT
+a_hf_14N = 0.00216 #GHz
+#NV axis directions in the crystal frame
+nv_axes = np.array([[1, 1, 1], [1, -1, -1], [-1, 1, -1], [-1, -1, 1]]) / np.sqrt(3)
+#Half width at half maximum of a Gaussian divided by its standard deviation
+hwhm_sigma = math.sqrt(2 * math.log(2))
+
+
+def _lorentzian(f, center, width):
+    '''Lorentzian dip shape L and its derivatives to center and width.'''
+    u = (f - center) / width
+    L = 1 / (1 + u**2)
+    return L, 2*u * L**2 / width, 2*u**2 * L**2 / width
+
+
+def _gaussian(f, center, sigma):
+    '''Gaussian dip shape G and its derivatives to center and sigma.'''
+    u = (f - center) / sigma
+    G = torch.exp(-0.5 * u**2)
+    return G, G * u / sigma, G * u**2 / sigma
+
+
+def _pseudo_voigt(f, center, width, eta):
+    '''Pseudo-Voigt shape with half width at half maximum width, and its derivatives to center, width and eta.'''
+    L, dL_c, dL_w = _lorentzian(f, center, width)
+    G, dG_c, dG_s = _gaussian(f, center, width / hwhm_sigma)
+    return eta*L + (1 - eta)*G, eta*dL_c + (1 - eta)*dG_c, eta*dL_w + (1 - eta)*dG_s / hwhm_sigma, L - G
+
+
+def _columns(p):
+    return [p[:, i:i+1] for i in range(p.shape[1])]
+
+
+#Model functions: f (F,) and p (B, P) -> (B, F); Jacobians -> (B, F, P)
+
+def _single(f, p):
+    I0, A, width, f0 = _columns(p)
+    return I0 - A * _lorentzian(f, f0, width)[0]
+
+def _single_jacobian(f, p):
+    I0, A, width, f0 = _columns(p)
+    L, dL_c, dL_w = _lorentzian(f, f0, width)
+    return torch.stack((torch.ones_like(L), -L, -A*dL_w, -A*dL_c), dim=-1)
+
+
+def _double_symmetric(f, p):
+    return double_dip_func(f, *_columns(p))
+
+def _double_symmetric_jacobian(f, p):
+    return double_dip_jacobian(f, *_columns(p))
+
+
+def _double(f, p):
+    I0, A1, A2, w1, w2, f1, f2 = _columns(p)
+    return I0 - A1 * _lorentzian(f, f1, w1)[0] - A2 * _lorentzian(f, f2, w2)[0]
+
+def _double_jacobian(f, p):
+    I0, A1, A2, w1, w2, f1, f2 = _columns(p)
+    L1, dL1_c, dL1_w = _lorentzian(f, f1, w1)
+    L2, dL2_c, dL2_w = _lorentzian(f, f2, w2)
+    return torch.stack((torch.ones_like(L1), -L1, -L2, -A1*dL1_w, -A2*dL2_w, -A1*dL1_c, -A2*dL2_c), dim=-1)
+
+
+def _triple(f, p):
+    I0, A, width, f0, a = _columns(p)
+    return I0 - A * sum(_lorentzian(f, f0 + k*a, width)[0] for k in (-1, 0, 1))
+
+def _triple_jacobian(f, p):
+    I0, A, width, f0, a = _columns(p)
+    d_A, d_width, d_f0, d_a = 0, 0, 0, 0
+    for k in (-1, 0, 1):
+        L, dL_c, dL_w = _lorentzian(f, f0 + k*a, width)
+        d_A = d_A - L
+        d_width = d_width - A*dL_w
+        d_f0 = d_f0 - A*dL_c
+        d_a = d_a - A*k*dL_c
+    return torch.stack((torch.ones_like(d_A), d_A, d_width, d_f0, d_a), dim=-1)
+
+
+def _eight_centers(p):
+    '''Dip centers (B, 8) and their derivatives to (D, Bx, By, Bz), shape (B, 8, 4).'''
+    D = p[:, 3:4]
+    B = p[:, 4:7]
+    axes = torch.as_tensor(nv_axes, dtype=p.dtype, device=p.device)
+    s = gamma_NV * B @ axes.T #(B, 4) projections
+    sign_s = torch.where(s >= 0, 1.0, -1.0).to(p.dtype)
+    centers = torch.cat((D - s.abs(), D + s.abs()), dim=1)
+    d_B = gamma_NV * sign_s[..., None] * axes[None] #(B, 4, 3), derivative of |s| to B
+    d_B = torch.cat((-d_B, d_B), dim=1)
+    d_D = torch.ones(d_B.shape[:2] + (1,), dtype=p.dtype, device=p.device)
+    return centers, torch.cat((d_D, d_B), dim=-1)
+
+def _eight(f, p):
+    I0, A, width = p[:, 0:1], p[:, 1:2], p[:, 2:3]
+    centers, _ = _eight_centers(p)
+    return I0 - A * _lorentzian(f, centers[..., None], width[..., None])[0].sum(dim=1)
+
+def _eight_jacobian(f, p):
+    I0, A, width = p[:, 0:1], p[:, 1:2], p[:, 2:3]
+    centers, d_centers = _eight_centers(p)
+    L, dL_c, dL_w = _lorentzian(f, centers[..., None], width[..., None]) #(B, 8, F)
+    d_position = -A[..., None] * torch.einsum('bkf,bkq->bfq', dL_c, d_centers)
+    return torch.cat((torch.ones_like(L[:, 0])[..., None], -L.sum(dim=1)[..., None],
+                      (-A * dL_w.sum(dim=1))[..., None], d_position), dim=-1)
+
+
+def _gaussian_double(f, p):
+    I0, A, sigma, f_center, f_delta = _columns(p)
+    return I0 - A * (_gaussian(f, f_center - 0.5*f_delta, sigma)[0] + _gaussian(f, f_center + 0.5*f_delta, sigma)[0])
+
+def _gaussian_double_jacobian(f, p):
+    I0, A, sigma, f_center, f_delta = _columns(p)
+    G1, dG1_c, dG1_s = _gaussian(f, f_center - 0.5*f_delta, sigma)
+    G2, dG2_c, dG2_s = _gaussian(f, f_center + 0.5*f_delta, sigma)
+    return torch.stack((torch.ones_like(G1), -(G1 + G2), -A*(dG1_s + dG2_s), -A*(dG1_c + dG2_c),
+                        -A*0.5*(dG2_c - dG1_c)), dim=-1)
+
+
+def _voigt_double(f, p):
+    I0, A, width, eta, f_center, f_delta = _columns(p)
+    V1 = _pseudo_voigt(f, f_center - 0.5*f_delta, width, eta)[0]
+    V2 = _pseudo_voigt(f, f_center + 0.5*f_delta, width, eta)[0]
+    return I0 - A * (V1 + V2)
+
+def _voigt_double_jacobian(f, p):
+    I0, A, width, eta, f_center, f_delta = _columns(p)
+    V1, dV1_c, dV1_w, dV1_eta = _pseudo_voigt(f, f_center - 0.5*f_delta, width, eta)
+    V2, dV2_c, dV2_w, dV2_eta = _pseudo_voigt(f, f_center + 0.5*f_delta, width, eta)
+    return torch.stack((torch.ones_like(V1), -(V1 + V2), -A*(dV1_w + dV2_w), -A*(dV1_eta + dV2_eta),
+                        -A*(dV1_c + dV2_c), -A*0.5*(dV2_c - dV1_c)), dim=-1)
+
+
+#Vectorized initial guesses: features (see spectral_features) -> (B, P)
+
+def spectral_features(data, freq, tail=5, thresholds=[3, 5]):
+    '''Per-spectrum quantities used for the initial guesses of all models, for (B, F) data.'''
+    freq = np.asarray(freq, dtype=float)
+    tails = tail_values(data, tail)
+    baseline = np.mean(tails, axis=-1)
+    depth = baseline - np.min(data, axis=-1)
+    below = data < (baseline - 0.5*depth)[:, None]
+    first = np.argmax(below, axis=-1)
+    last = data.shape[-1] - 1 - np.argmax(below[:, ::-1], axis=-1)
+    weights = np.clip(baseline[:, None] - data, 0, None)
+    weight_sum = np.sum(weights, axis=-1)
+    centroid = np.divide(weights @ freq, weight_sum, out=np.full(len(data), np.mean(freq)), where=weight_sum > 0)
+    I0, A, width, f_center, f_delta = estimate_initial_parameters(data[None], freq, tail, thresholds)
+    #Second deepest dip: the minimum outside a few widths around the deepest one
+    f_min = freq[np.argmin(data, axis=-1)]
+    window = np.minimum(3 * width[0], 0.25 * (np.max(freq) - np.min(freq)))
+    outside = np.where(np.abs(freq[None] - f_min[:, None]) > window[:, None], data, np.inf)
+    second = np.argmin(outside, axis=-1)
+    return {
+        "baseline": baseline,
+        "depth": depth,
+        "f_min": f_min,
+        "f_second": freq[second],
+        "depth_second": np.maximum(baseline - data[np.arange(len(data)), second], 0),
+        "centroid": centroid,
+        "extent": freq[last] - freq[first],
+        "step": np.min(np.abs(np.diff(freq))),
+        "double": np.stack((I0[0], A[0], width[0], f_center[0], f_delta[0]), axis=1),
+    }
+
+def _single_guess(features):
+    width = np.maximum(0.5 * features["extent"], features["step"])
+    return np.stack((features["baseline"], features["depth"], width, features["f_min"]), axis=1)
+
+def _double_symmetric_guess(features):
+    return features["double"]
+
+def _double_guess(features):
+    I0, A, width, f_center, f_delta = features["double"].T
+    #The deepest dip and the deepest point away from it, so that dips of different depth are both found
+    first = features["f_min"] <= features["f_second"]
+    f1 = np.where(first, features["f_min"], features["f_second"])
+    f2 = np.where(first, features["f_second"], features["f_min"])
+    A1 = np.where(first, features["depth"], features["depth_second"])
+    A2 = np.where(first, features["depth_second"], features["depth"])
+    width = np.maximum(width, features["step"])
+    return np.stack((I0, A1, A2, width, width, f1, f2), axis=1)
+
+def _triple_guess(features):
+    width = np.maximum(features["extent"] / 6, features["step"])
+    a = np.full(len(width), a_hf_14N)
+    return np.stack((features["baseline"], features["depth"], width, features["centroid"], a), axis=1)
+
+def _eight_guess(features):
+    #Field along the first NV axis, tilted slightly so that the degenerate dips can separate
+    direction = nv_axes[0] + 0.2*nv_axes[1]
+    direction = direction / np.linalg.norm(direction)
+    s_max = gamma_NV * np.max(np.abs(nv_axes @ direction))
+    B = (0.5 * features["extent"] / s_max)[:, None] * direction[None]
+    width = np.maximum(features["extent"] / 16, features["step"])
+    return np.concatenate((np.stack((features["baseline"], features["depth"], width, features["centroid"]), axis=1), B), axis=1)
+
+def _gaussian_guess(features):
+    guess = features["double"].copy()
+    guess[:, 2] /= hwhm_sigma
+    return guess
+
+def _voigt_guess(features):
+    I0, A, width, f_center, f_delta = features["double"].T
+    return np.stack((I0, A, width, np.full(len(I0), 0.5), f_center, f_delta), axis=1)
+
+
+#Common quantities: params (B, P) numpy -> dictionary of I0, A, width, f_center, f_delta
+
+def _single_common(p):
+    return {"I0": p[:, 0], "A": p[:, 1], "width": p[:, 2], "f_center": p[:, 3], "f_delta": np.zeros(len(p))}
+
+def _identity_common(p):
+    return {name: p[:, i] for i, name in enumerate(common_names)}
+
+def _double_common(p):
+    return {"I0": p[:, 0], "A": 0.5*(p[:, 1] + p[:, 2]), "width": 0.5*(p[:, 3] + p[:, 4]),
+            "f_center": 0.5*(p[:, 5] + p[:, 6]), "f_delta": np.abs(p[:, 6] - p[:, 5])}
+
+def _triple_common(p):
+    return {"I0": p[:, 0], "A": p[:, 1], "width": p[:, 2], "f_center": p[:, 3], "f_delta": np.zeros(len(p))}
+
+def _eight_common(p):
+    s = gamma_NV * np.abs(p[:, 4:7] @ nv_axes.T)
+    return {"I0": p[:, 0], "A": p[:, 1], "width": p[:, 2], "f_center": p[:, 3], "f_delta": 2*np.max(s, axis=1)}
+
+def _voigt_common(p):
+    return {"I0": p[:, 0], "A": p[:, 1], "width": p[:, 2], "f_center": p[:, 4], "f_delta": p[:, 5]}
+
+
+class ResonanceModel:
+    def __init__(self, name, param_names, func, jacobian, guess, common, intensity_params, position_params, lower=None, upper=None):
+        '''name: model name
+        param_names: names of the P parameters
+        func, jacobian: model functions (see lm_solver.py)
+        guess: guess(features) -> (B, P) initial parameters, see spectral_features
+        common: common(params) -> dictionary of I0, A, width, f_center, f_delta
+        intensity_params: indices of the parameters that scale with the intensity (baseline and amplitudes)
+        position_params: indices of the parameters that are absolute frequencies
+        lower, upper: (P,) bounds, None for unbounded'''
+        self.name = name
+        self.param_names = param_names
+        self.func = func
+        self.jacobian = jacobian
+        self.guess = guess
+        self.common = common
+        self.intensity_params = intensity_params
+        self.position_params = position_params
+        self.lower = lower
+        self.upper = upper
+
+    def __call__(self, freq, params):
+        '''Model values for (F,) frequencies and (B, P) or (P,) parameters, as numpy array.'''
+        params = np.atleast_2d(params)
+        values = self.func(torch.as_tensor(np.asarray(freq, dtype=float)), torch.as_tensor(params, dtype=torch.float64))
+        return values.numpy()[0] if values.shape[0] == 1 else values.numpy()
+
+
+inf = float("inf")
+models = {
+    "single": ResonanceModel("single", ["I0", "A", "width", "f0"], _single, _single_jacobian, _single_guess, _single_common,
+                             [0, 1], [3], lower=[-inf, -inf, 1e-6, -inf]),
+    "double_symmetric": ResonanceModel("double_symmetric", list(common_names), _double_symmetric, _double_symmetric_jacobian,
+                                       _double_symmetric_guess, _identity_common, [0, 1], [3], lower=[-inf, -inf, 1e-6, -inf, 0]),
+    "double": ResonanceModel("double", ["I0", "A1", "A2", "width1", "width2", "f1", "f2"], _double, _double_jacobian,
+                             _double_guess, _double_common, [0, 1, 2], [5, 6], lower=[-inf, -inf, -inf, 1e-6, 1e-6, -inf, -inf]),
+    "triple": ResonanceModel("triple", ["I0", "A", "width", "f0", "a_hf"], _triple, _triple_jacobian, _triple_guess,
+                             _triple_common, [0, 1], [3], lower=[-inf, -inf, 1e-6, -inf, 0]),
+    "eight": ResonanceModel("eight", ["I0", "A", "width", "D", "Bx", "By", "Bz"], _eight, _eight_jacobian, _eight_guess,
+                            _eight_common, [0, 1], [3], lower=[-inf, -inf, 1e-6, -inf, -inf, -inf, -inf]),
+    "gaussian": ResonanceModel("gaussian", ["I0", "A", "sigma", "f_center", "f_delta"], _gaussian_double, _gaussian_double_jacobian,
+                               _gaussian_guess, _identity_common, [0, 1], [3], lower=[-inf, -inf, 1e-6, -inf, 0]),
+    "voigt": ResonanceModel("voigt", ["I0", "A", "width", "eta", "f_center", "f_delta"], _voigt_double, _voigt_double_jacobian,
+                            _voigt_guess, _voigt_common, [0, 1], [4], lower=[-inf, -inf, 1e-6, 0, -inf, 0], upper=[inf, inf, inf, 1, inf, inf]),
+}
+
+
+def fit_batch_model(model, batch_data, freq, estimates, device, max_iter=100, likelihood="mse", dtype=torch.float64):
+    '''Fits one model to a (B, F) batch of spectra with the batched Levenberg-Marquardt solver.
+    likelihood: "mse", "wls" or "poisson", see double_dip_fitter.fit_batch_lm.
+    Returns (params, errors, cost, converged, iterations, mse) as numpy arrays.'''
+    #Frequencies are taken relative to the middle of the sweep to keep the problem well conditioned
+    f_ref = 0.5 * (np.max(freq) + np.min(freq))
+    f = torch.tensor(np.asarray(freq) - f_ref, dtype=dtype, device=device)
+    y = torch.tensor(np.asarray(batch_data), dtype=dtype, device=device)
+    p0 = torch.tensor(estimates, dtype=dtype, device=device)
+    p0[:, model.position_params] -= f_ref
+    #Start inside the bounds
+    if model.lower is not None:
+        p0 = torch.maximum(p0, torch.tensor(model.lower, dtype=dtype, device=device))
+
+    options = {"lower": model.lower, "upper": model.upper, "max_iter": max_iter}
+    if likelihood == "wls":
+        options.update(weights=1 / torch.clamp(y, min=1), scale_covariance=False)
+    elif likelihood == "poisson":
+        options.update(loss="poisson", scale_covariance=False)
+    elif likelihood != "mse":
+        raise Exception("ERROR: unknown likelihood " + str(likelihood) + "!")
+    result = levenberg_marquardt(model.func, model.jacobian, f, y, p0, **options)
+
+    mse = ((y - model.func(f, result["params"]))**2).mean(dim=1).cpu().numpy()
+    params = result["params"].cpu().numpy()
+    params[:, model.position_params] += f_ref
+    return (params, result["errors"].cpu().numpy(), result["cost"].cpu().numpy(), result["converged"].cpu().numpy(),
+            result["iterations"].cpu().numpy(), mse)
+
+
+def information_criterion(cost, num_points, num_params, likelihood="mse", criterion="bic"):
+    '''AIC or BIC of every pixel from the final cost of the fit.
+    For least squares with unknown noise the -2 log likelihood is F*log(RSS/F); for the count
+    likelihoods the cost (deviance or chi-square) is used directly.'''
+    if likelihood == "mse":
+        minus_2_log_likelihood = num_points * np.log(np.maximum(cost, 1e-300) / num_points)
+    else:
+        minus_2_log_likelihood = cost
+    if criterion == "aic":
+        return minus_2_log_likelihood + 2*num_params
+    elif criterion == "bic":
+        return minus_2_log_likelihood + num_params*np.log(num_points)
+    raise Exception("ERROR: unknown information criterion " + str(criterion) + "!")
+
+
+def fit_models(data, freq, model_names=["double_symmetric"], criterion="bic", tail=5, thresholds=[3, 5], error_threshold=0.1,
+               default_values=None, batch_size=None, device=None, num_threads=None, max_iter=100, verbose=True,
+               likelihood="mse", exposure=1.0, snr_threshold=None, memory_budget=None):
+    '''Fits all models in model_names to the (M, N, F) data in one pass over the data and selects the best
+    model of every pixel with the information criterion ("aic" or "bic").
+    The other arguments are as in double_dip_fitter.fit_double_lorentzian; batch_size None sizes the batches
+    for the model with the most parameters.
+
+    Returns a dictionary of (M, N) maps:
+    - "model": index into model_names of the selected model
+    - the common quantities I0, A, width, f_center, f_delta (see the module docstring), "mse", "r2",
+      "converged", "iterations" and "masked" of the selected model. Pixels with a higher mse than
+      error_threshold get default_values, as in fit_double_lorentzian.
+    - for every model: its parameters and their standard errors as "<model>_<param>" and "<model>_<param>_err",
+      and "<model>_mse", "<model>_converged" and "<model>_" + criterion'''
+    M, N, F = data.shape
+    device = select_device(device, num_threads)
+    selected_models = [models[name] for name in model_names]
+    if verbose:
+        print("Fitting models " + ", ".join(model_names) + " on device:", device)
+
+    total_pixels = M * N
+    data = data.reshape(-1, F)
+    if snr_threshold is None:
+        fit_indices = np.arange(total_pixels)
+    else:
+        fit_indices = np.flatnonzero(snr_map(data, tail) >= snr_threshold)
+        if verbose:
+            print("SNR screening: fitting {} of {} pixels".format(len(fit_indices), total_pixels))
+    fit_pixels = len(fit_indices)
+    if batch_size is None:
+        batch_size = auto_batch_size(F, device, max(len(model.param_names) for model in selected_models), memory_budget=memory_budget)
+    batch_size = max(1, min(batch_size, fit_pixels))
+
+    results = {"model": np.zeros(total_pixels, dtype=np.int64), "masked": np.ones(total_pixels, dtype=bool)}
+    results["masked"][fit_indices] = False
+    for name in common_names:
+        results[name] = np.zeros(total_pixels)
+    results["mse"] = np.full(total_pixels, np.nan)
+    results["r2"] = np.full(total_pixels, np.nan)
+    results["converged"] = np.zeros(total_pixels, dtype=bool)
+    results["iterations"] = np.zeros(total_pixels, dtype=np.int64)
+    for model in selected_models:
+        for param in model.param_names:
+            results[model.name + "_" + param] = np.zeros(total_pixels)
+            results[model.name + "_" + param + "_err"] = np.zeros(total_pixels)
+        results[model.name + "_mse"] = np.full(total_pixels, np.nan)
+        results[model.name + "_converged"] = np.zeros(total_pixels, dtype=bool)
+        results[model.name + "_" + criterion] = np.full(total_pixels, np.nan)
+
+    for start in range(0, fit_pixels, batch_size):
+        idx = fit_indices[start:start + batch_size]
+        batch_data = np.asarray(data[idx], dtype=float)
+        if likelihood != "mse":
+            batch_data = batch_data * exposure
+        #Features are computed once and shared by the initial guesses of all models
+        features = spectral_features(batch_data, freq, tail, thresholds)
+        norm = np.max(batch_data, axis=1)
+        scale = np.zeros(len(idx))
+        np.divide(1, norm, out=scale, where=norm > 0)
+
+        best = np.full(len(idx), np.inf)
+        for m, model in enumerate(selected_models):
+            params, errors, cost, converged, iterations, mse = fit_batch_model(model, batch_data, freq, model.guess(features), device,
+                                                                               max_iter=max_iter, likelihood=likelihood)
+            score = information_criterion(cost, F, len(model.param_names), likelihood, criterion)
+            r2 = r_squared(batch_data, mse)
+            if likelihood != "mse":
+                #Back to the scale of spectra normalized by their maximum, as fit_double_lorentzian does
+                params[:, model.intensity_params] *= scale[:, None]
+                errors[:, model.intensity_params] *= scale[:, None]
+                mse = mse * scale**2
+            for i, param in enumerate(model.param_names):
+                results[model.name + "_" + param][idx] = params[:, i]
+                results[model.name + "_" + param + "_err"][idx] = errors[:, i]
+            results[model.name + "_mse"][idx] = mse
+            results[model.name + "_converged"][idx] = converged
+            results[model.name + "_" + criterion][idx] = score
+
+            better = np.isfinite(score) & (score < best)
+            best[better] = score[better]
+            selected = idx[better]
+            results["model"][selected] = m
+            for name, values in model.common(params).items():
+                results[name][selected] = values[better]
+            results["mse"][selected] = mse[better]
+            results["r2"][selected] = r2[better]
+            results["converged"][selected] = converged[better]
+            results["iterations"][selected] = iterations[better]
+        if verbose:
+            print("Fitted {} of {} pixels".format(min(start + batch_size, fit_pixels), fit_pixels))
+        if device.type == "cuda":
+            torch.cuda.empty_cache()
+
+    for name in results:
+        results[name] = results[name].reshape(M, N)
+
+    if default_values is None:
+        default_values = {"I0": 1.0, "A": 0, "width": 1.0, "f_center": 2.87, "f_delta": 0.0}
+    failed_pixels = ~(results["mse"] <= error_threshold)
+    for name in common_names:
+        results[name][failed_pixels] = default_values[name]
+    return results
+
+
+def selected_curve(results, model_names, freq, x, y):
+    '''Fitted curve of the selected model of pixel (x, y), on the scale of the normalized spectrum.'''
+    model = models[model_names[int(results["model"][x][y])]]
+    params = np.array([results[model.name + "_" + param][x][y] for param in model.param_names])
+    return model(freq, params)
+
+
+if __name__ == "__main__":
+    #Check the analytic Jacobians against automatic differentiation
+    torch.manual_seed(0)
+    freq = torch.linspace(2.80, 2.94, 141, dtype=torch.float64)
+    examples = {
+        "single": [1, 0.1, 0.004, 2.87],
+        "double_symmetric": [1, 0.1, 0.003, 2.87, 0.01],
+        "double": [1, 0.1, 0.08, 0.003, 0.004, 2.865, 2.876],
+        "triple": [1, 0.1, 0.001, 2.87, a_hf_14N],
+        "eight": [1, 0.05, 0.002, 2.87, 1.0, 0.6, 0.3],
+        "gaussian": [1, 0.1, 0.003, 2.87, 0.01],
+        "voigt": [1, 0.1, 0.003, 0.3, 2.87, 0.01],
+    }
+    for name, example in examples.items():
+        model = models[name]
+        p = torch.tensor([example], dtype=torch.float64)
+        p = p * (1 + 0.01*torch.randn(p.shape, dtype=torch.float64))
+        numeric = torch.autograd.functional.jacobian(lambda q: model.func(freq, q), p)[0, :, 0, :]
+        analytic = model.jacobian(freq, p)[0]
+        print("{:<18} max Jacobian error: {:.2e}".format(name, (numeric - analytic).abs().max().item() / numeric.abs().max().item()))
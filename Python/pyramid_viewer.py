@@ -0,0 +1,89 @@
+'''Interactive viewer for large processed maps.
+
+Shows one map of the pyramid that ODMR_2D_process.py writes next to a scan (see map_pyramid.py).
+On every zoom or pan only the visible part is loaded, at the finest level that still fits the
+window, so even maps of 1000 x 1000 pixels respond immediately.
+Example:
+    python3 pyramid_viewer.py /home/dl-lab-pc3/measurements/2D_ODMR_scan_1700000000.npy --map contrast_fit
+With --roi x1 x2 y1 y2 (mm) and --save, the region is written to <scan>_roi_<map>.png instead of shown.'''
+
+import sys
+import argparse
+import numpy as np
+import matplotlib.pyplot as plt
+
+import map_pyramid
+from figure_rendering import PL_color, interpolation
+
+
+class PyramidViewer:
+    def __init__(self, filename_base, name, cmap=PL_color, max_pixels=1024):
+        self.filename_base = filename_base
+        self.name = name
+        self.max_pixels = max_pixels
+        self.index = map_pyramid.load_index(filename_base)
+        if name not in self.index["maps"]:
+            raise Exception("ERROR: no map " + name + " in the pyramid. Available: " + ", ".join(self.index["maps"]))
+        #The colour scale is fixed from the smallest level, so it does not jump while zooming
+        overview = map_pyramid.open_level(filename_base, name, len(self.index["maps"][name]) - 1)
+        limits = (np.nanmin(overview), np.nanmax(overview)) if np.any(np.isfinite(overview)) else (0, 1)
+
+        self.fig, self.ax = plt.subplots(figsize=(12, 8))
+        data, extent, level = map_pyramid.read_region(filename_base, name, max_pixels=max_pixels, index=self.index)
+        #imshow is (y, x), the maps are (x, y)
+        self.image = self.ax.imshow(data.T, cmap=cmap, interpolation=interpolation, extent=extent, origin="lower", vmin=limits[0], vmax=limits[1])
+        self.ax.set_xlabel("x (mm)")
+        self.ax.set_ylabel("y (mm)")
+        cb = self.fig.colorbar(self.image, ax=self.ax)
+        cb.set_label(name, rotation=270, labelpad=30)
+        self._set_title(level)
+        self._updating = False
+        self.ax.callbacks.connect("xlim_changed", self.update)
+        self.ax.callbacks.connect("ylim_changed", self.update)
+
+    def _set_title(self, level):
+        self.ax.set_title("{} (level {}, {}x binned)".format(self.name, level, 2**level))
+
+    def show_region(self, x_range, y_range):
+        '''Loads and shows the region x_range, y_range (mm).'''
+        data, extent, level = map_pyramid.read_region(self.filename_base, self.name, x_range, y_range, self.max_pixels, self.index)
+        self._updating = True
+        self.image.set_data(data.T)
+        self.image.set_extent(extent)
+        self.ax.set_xlim(*x_range)
+        self.ax.set_ylim(*y_range)
+        self._updating = False
+        self._set_title(level)
+        self.fig.canvas.draw_idle()
+
+    def update(self, ax=None):
+        if not self._updating:
+            self.show_region(self.ax.get_xlim(), self.ax.get_ylim())
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Browse a processed map with multi-resolution loading.")
+    parser.add_argument('filename', help="The .npy file of the scan (processed with ODMR_2D_process.py).")
+    parser.add_argument('--map', default=None, help="Name of the map. Default: the first map of the pyramid.")
+    parser.add_argument('--roi', type=float, nargs=4, default=None, metavar=("X1", "X2", "Y1", "Y2"), help="Region to show (mm).")
+    parser.add_argument('--save', action='store_true', help="Write the view to <scan>_roi_<map>.png instead of showing it.")
+    args = parser.parse_args()
+
+    filename_base = args.filename[:-4]
+    name = args.map if args.map != None else list(map_pyramid.load_index(filename_base)["maps"])[0]
+    if(args.save):
+        plt.switch_backend("Agg")
+    viewer = PyramidViewer(filename_base, name)
+    if(args.roi != None):
+        viewer.show_region(args.roi[0:2], args.roi[2:4])
+    if(args.save):
+        viewer.fig.savefig(filename_base + "_roi_" + name + ".png", dpi=100)
+    else:
+        plt.show()
+    return 0
+
+
+if __name__ == "__main__":
+    exitcode = main()
+    if exitcode != 0:
+        sys.exit(exitcode)
@@ -0,0 +1,116 @@
+'''Reading and writing the raw data of 2D scans.
+
+ODMR_2D.py stores the photon counts of every data point as unsigned integers (settings
+"data_unit": "counts"); for ODMR scans the counts of all sweeps are summed. Counts are what
+the time tagger measures, so nothing is lost, and they take half the space of the float64
+count rates that were stored before. Older scans without "data_unit" hold count rates
+(counts/s) as float64.
+
+load_scan() opens either kind memory-mapped and returns the raw data together with a
+RateView: a read-only float32 view in counts/s that converts only the rows that are read.
+The processing scripts work on the RateView, so they never make a float64 copy of the cube.
+Pixels that a scan skipped hold zeros; measured_pixels() tells them apart from measured ones.'''
+
+import os
+import numpy as np
+
+#Default type of the stored counts. uint16 halves the size again, but saturates at 65535 counts per point.
+count_dtype = "uint32"
+
+
+def stores_counts(settings):
+    return settings.get("data_unit") == "counts"
+
+
+def exposure_time(settings):
+    '''Counting time (s) behind one data point: the dwell time, times the number of sweeps for ODMR scans.'''
+    seconds = settings["dwell_time"] * 1e-12
+    if(settings.get("measurement_type") == "ODMR"):
+        seconds *= settings.get("num_sweeps", 1)
+    return seconds
+
+
+def add_counts(data, index, counts):
+    '''Adds counts to data[index] of an integer count array, saturating at the largest value of its type.'''
+    maximum = np.iinfo(data.dtype).max
+    data[index] = min(int(data[index]) + int(counts), maximum)
+
+
+class RateView:
+    '''Read-only float32 view in counts/s of raw scan data. Indexing returns numpy arrays; only the
+    indexed part is read and converted.'''
+    def __init__(self, raw, exposure=1.0):
+        '''raw: stored data (counts, or rates with exposure 1)
+        exposure: counting time (s) per data point'''
+        self.raw = raw
+        self.scale = np.float32(1 / exposure)
+        self.shape = raw.shape
+        self.ndim = raw.ndim
+        self.dtype = np.dtype(np.float32)
+        self.nbytes = raw.size * 4
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __getitem__(self, key):
+        return np.multiply(np.asarray(self.raw[key]), self.scale, dtype=np.float32)
+
+    def __array__(self, dtype=None, copy=None):
+        values = self[...]
+        return values if dtype is None else values.astype(dtype)
+
+
+def load_scan(filename, settings, mmap_mode="r"):
+    '''Opens the .npy file of a scan. Returns (raw, rates, exposure):
+    - raw: the stored array (memory-mapped)
+    - rates: RateView of the data in counts/s
+    - exposure: counting time (s) per data point when raw holds counts, None for scans that store rates'''
+    raw = np.load(filename, mmap_mode=mmap_mode)
+    if(stores_counts(settings)):
+        exposure = exposure_time(settings)
+        return raw, RateView(raw, exposure), exposure
+    return raw, RateView(raw), None
+
+
+def measured_pixels(filename_base, shape):
+    '''(M, N) mask of the pixels of a 2D scan that were measured, from <scan>_progress.npy, or from the
+    adaptive prescan (<scan>_prescan.npz) when there is no progress file. None when neither exists, e.g. for
+    older scans: all pixels were measured. Skipped pixels (adaptive scans, triangles, stopped scans) hold zeros.'''
+    if(os.path.exists(filename_base + "_progress.npy")):
+        measured = np.load(filename_base + "_progress.npy") != 0
+    elif(os.path.exists(filename_base + "_prescan.npz")):
+        with np.load(filename_base + "_prescan.npz") as prescan:
+            measured = prescan["diamond"].astype(bool)
+    else:
+        return None
+    if(measured.shape != tuple(shape)):
+        raise Exception("ERROR: the measured pixel mask of " + filename_base + " has shape " + str(measured.shape) + " instead of " + str(tuple(shape)) + "!")
+    return measured
+
+
+def measured_column(values, measured):
+    '''The measured pixels of the (M, N, ...) values as a (K, 1, ...) column, the layout in which processing
+    fits and caches them (measured.nonzero() order). values itself when measured is None.'''
+    if(measured is None):
+        return values
+    return np.asarray(values[measured])[:, None]
+
+
+def expand_measured(maps, measured):
+    '''Full (M, N) maps from maps of only the measured pixels (arrays with the values of measured.nonzero(),
+    of any shape with that many elements). Unmeasured pixels get NaN, -1 for integer maps, False for boolean
+    maps and True for "masked".'''
+    expanded = {}
+    for name, values in maps.items():
+        values = np.asarray(values).reshape(-1)
+        if(name == "masked"):
+            fill = True
+        elif(values.dtype == bool):
+            fill = False
+        elif(np.issubdtype(values.dtype, np.integer)):
+            fill = -1
+        else:
+            fill = np.nan
+        expanded[name] = np.full(measured.shape, fill, dtype=values.dtype)
+        expanded[name][measured] = values
+    return expanded
@@ -0,0 +1,153 @@
+'''Live monitor of a running 2D scan.
+
+ODMR_2D.py writes the scan directly into its memory-mapped .npy file and marks every completed
+pixel in <scan>_progress.npy. This monitor runs as a separate process, opens both files
+read-only and redraws the PL map (and for ODMR scans the raw contrast map) at a fixed refresh
+rate. Only the pixels completed since the previous refresh are read and computed, so the
+monitor stays cheap and never slows down the acquisition.
+Example:
+    python3 scan_monitor.py /home/dl-lab-pc3/measurements/2D_ODMR_scan_1700000000.npy --interval 2
+Without a filename, the newest scan in the folder given by --folder is monitored.'''
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import numpy as np
+import matplotlib.pyplot as plt
+
+from figure_rendering import PL_color, contrast_color, interpolation
+from scan_data import load_scan
+
+
+def newest_scan(folder):
+    '''Path of the most recently started scan in folder, or None.'''
+    scans = glob.glob(os.path.join(folder, "*_progress.npy"))
+    if len(scans) == 0:
+        return None
+    return max(scans, key=os.path.getmtime)[:-len("_progress.npy")] + ".npy"
+
+
+def pixel_values(spectra, measurement_type):
+    '''Map values of a (B, ...) block of completed pixels: (PL, contrast).
+    PL is the count rate for PL scans, the mean over the spectrum for ODMR scans and the maximum along z for 3DPL.
+    contrast is the raw ODMR contrast (max - min) / max, None for other scans.'''
+    if(measurement_type == "PL"):
+        return spectra, None
+    if(measurement_type == "3DPL"):
+        return np.max(spectra, axis=-1), None
+    maximum = np.max(spectra, axis=-1)
+    contrast = np.divide(maximum - np.min(spectra, axis=-1), maximum, out=np.zeros(maximum.shape), where=maximum > 0)
+    return np.mean(spectra, axis=-1), contrast
+
+
+class ScanMonitor:
+    def __init__(self, filename):
+        self.filename = filename
+        self.filename_base = filename[:-4]
+        with open(self.filename_base + ".json", 'r') as f:
+            self.settings = json.load(f)
+        self.measurement_type = self.settings["measurement_type"]
+        self.PL = load_scan(filename, self.settings)[1]
+        self.progress = np.load(self.filename_base + "_progress.npy", mmap_mode="r")
+        shape = self.progress.shape
+        self.shown = np.zeros(shape, dtype=bool)
+        self.maps = {"PL": np.full(shape, np.nan)}
+        if(self.measurement_type == "ODMR"):
+            self.maps["contrast"] = np.full(shape, np.nan)
+
+        self.fig, axes = plt.subplots(1, len(self.maps), figsize=(9*len(self.maps), 7), squeeze=False)
+        self.images = {}
+        extent = [self.settings["x1"], self.settings["x2"], self.settings["y1"], self.settings["y2"]]
+        labels = {"PL": ("PL (counts/s)", PL_color), "contrast": ("Raw contrast (%)", contrast_color)}
+        for ax, name in zip(axes[0], self.maps):
+            label, cmap = labels[name]
+            #imshow is (y, x), the maps are (x, y)
+            self.images[name] = ax.imshow(self.maps[name].T, cmap=cmap, interpolation=interpolation, extent=extent, origin="lower")
+            ax.set_xlabel("x (mm)")
+            ax.set_ylabel("y (mm)")
+            cb = self.fig.colorbar(self.images[name], ax=ax)
+            cb.set_label(label, rotation=270, labelpad=30)
+
+    def scan_finished(self):
+        try:
+            with open(self.filename_base + ".json", 'r') as f:
+                return "End time" in json.load(f)
+        except ValueError:
+            #The settings file is being rewritten at the end of the scan
+            return False
+
+    def update(self):
+        '''Reads and draws the pixels completed since the last update. Returns the number of new pixels.'''
+        new = (np.asarray(self.progress) != 0) & ~self.shown
+        ix, iy = np.nonzero(new)
+        if len(ix) == 0:
+            return 0
+        PL, contrast = pixel_values(self.PL[ix, iy], self.measurement_type)
+        self.maps["PL"][ix, iy] = PL
+        if contrast is not None:
+            self.maps["contrast"][ix, iy] = contrast * 100
+        self.shown[ix, iy] = True
+        for name, image in self.images.items():
+            image.set_data(self.maps[name].T)
+            if np.any(np.isfinite(self.maps[name])):
+                image.set_clim(np.nanmin(self.maps[name]), np.nanmax(self.maps[name]))
+        self.fig.suptitle("{}: {} of {} pixels".format(os.path.basename(self.filename_base), np.sum(self.shown), self.shown.size))
+        self.fig.canvas.draw_idle()
+        return len(ix)
+
+    def run(self, interval=2.0, save=False):
+        '''Refreshes every `interval` seconds until the scan is finished.
+        With save=True, every refresh with new pixels is also written to <scan>_monitor.png.'''
+        while True:
+            start = time.time()
+            finished = self.scan_finished()
+            if self.update() > 0 and save:
+                self.fig.savefig(self.filename_base + "_monitor.png", dpi=100)
+            if finished or self.shown.all():
+                break
+            wait = max(0.01, interval - (time.time() - start))
+            if(plt.get_backend().lower() == "agg"):
+                time.sleep(wait)
+            else:
+                #Also keeps the window responsive
+                plt.pause(wait)
+        print("Scan finished.")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Show a running 2D scan live.")
+    parser.add_argument('filename', nargs="?", default=None, help="The .npy file of the running scan. Default: the newest scan in --folder.")
+    parser.add_argument('--folder', default="/home/dl-lab-pc3/measurements/", help="Folder to look for the newest scan in.")
+    parser.add_argument('--interval', type=float, default=2.0, help="Seconds between refreshes.")
+    parser.add_argument('--save', action='store_true', help="Also write every refresh to <scan>_monitor.png (e.g. when running without a display).")
+    args = parser.parse_args()
+
+    filename = args.filename
+    if(filename == None):
+        filename = newest_scan(args.folder)
+        if(filename == None):
+            print("Waiting for a scan to start in " + args.folder)
+        while filename == None:
+            time.sleep(0.5)
+            filename = newest_scan(args.folder)
+    print("Monitoring " + filename)
+    while not os.path.exists(filename[:-4] + "_progress.npy"):
+        time.sleep(0.5)
+
+    monitor = ScanMonitor(filename)
+    if(plt.get_backend().lower() != "agg"):
+        plt.ion()
+    monitor.run(args.interval, args.save)
+    if(plt.get_backend().lower() != "agg"):
+        plt.ioff()
+        plt.show()
+    return 0
+
+
+if __name__ == "__main__":
+    exitcode = main()
+    if exitcode != 0:
+        sys.exit(exitcode)
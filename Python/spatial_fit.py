@@ -0,0 +1,270 @@
+'''Spatially seeded double Lorentzian fitting of ODMR maps.
+
+Neighbouring pixels of a strain map have nearly the same spectrum, so instead of starting every
+pixel from its own noisy threshold guess (as fit_double_lorentzian does), fit_spatial:
+1. builds a pyramid of 2x2 binned levels (map_pyramid.bin_2x2) down to bin_factor x bin_factor
+   binned pixels, whose spectra have a much better signal to noise ratio, and fits it from coarse
+   to fine: every pixel starts from the result of its parent in the level above (or from its own
+   guess where the parent fit failed);
+2. fits the full resolution map the same way;
+3. refits the pixels that did not converge in wavefronts, starting from the median of their
+   converged neighbours, until no pixel improves any more;
+4. optionally refines the map with a total variation penalty on width, f_center and f_delta between
+   neighbouring pixels, which suppresses single-pixel outliers while keeping sharp edges.
+All fits use the batched Levenberg-Marquardt solver.'''
+
+import numpy as np
+import torch
+
+from lm_solver import levenberg_marquardt
+from map_pyramid import bin_2x2
+from scan_data import RateView
+from double_dip_fitter import (select_device, fit_batch_lm, estimate_initial_parameters, r_squared, param_names,
+                               _double_dip_model, _double_dip_model_jacobian)
+
+#Parameters that the total variation penalty acts on: width, f_center, f_delta
+tv_params = [2, 3, 4]
+#Offsets of the four nearest neighbours
+neighbour_offsets = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+
+
+def _seed_from_parent(seeds, parent_params, parent_good, shape):
+    '''Replaces the (M*N, 5) seeds of the pixels whose 2x2 parent (in the (M/2, N/2) level above) was fitted well
+    by the parameters of the parent. Returns the mask of those pixels.'''
+    M, N = shape
+    parent = ((np.arange(M)[:, None] // 2) * parent_good.shape[1] + np.arange(N)[None] // 2).reshape(-1)
+    use_parent = parent_good.reshape(-1)[parent]
+    seeds[use_parent] = parent_params.reshape(-1, seeds.shape[1])[parent[use_parent]]
+    return use_parent
+
+
+def neighbour_stack(values, valid):
+    '''Values of the four neighbours of every pixel of the (M, N, ...) map, shape (4, M, N, ...),
+    and whether each neighbour exists and is valid, shape (4, M, N).'''
+    M, N = valid.shape
+    stacked = np.zeros((4,) + values.shape)
+    exists = np.zeros((4, M, N), dtype=bool)
+    for k, (dx, dy) in enumerate(neighbour_offsets):
+        target = (slice(max(dx, 0), M + min(dx, 0)), slice(max(dy, 0), N + min(dy, 0)))
+        source = (slice(max(-dx, 0), M + min(-dx, 0)), slice(max(-dy, 0), N + min(-dy, 0)))
+        stacked[k][target] = values[source]
+        exists[k][target] = valid[source]
+    return stacked, exists
+
+
+def _spectra(data, F, scale=1.0):
+    '''Float32 (M*N, F) view of the (M, N, F) data (an array, memory map or RateView) times scale.
+    Only the rows that are indexed are read and converted.'''
+    if isinstance(data, RateView):
+        return RateView(np.reshape(data.raw, (-1, F)), 1 / (float(data.scale) * scale))
+    return RateView(np.reshape(data, (-1, F)), 1 / scale)
+
+
+def _blockwise(y, function, batch_size):
+    '''function applied to the (P, F) spectra y in blocks of batch_size rows, results concatenated.'''
+    return np.concatenate([function(y[start:start + batch_size]) for start in range(0, len(y), batch_size)])
+
+
+def _binned_level(y, shape, batch_size):
+    '''2x2 binned float32 (ceil(M/2), ceil(N/2), F) level of the (M*N, F) spectra y of an (M, N) map,
+    read in blocks of an even number of map rows.'''
+    M, N = shape
+    step = max(2, 2 * (batch_size // (2 * N)))
+    return np.concatenate([bin_2x2(y[i*N:min(i + step, M)*N].reshape(min(i + step, M) - i, N, -1)) for i in range(0, M, step)])
+
+
+def _fit_seeded(y, freq, seeds, device, batch_size, max_iter, likelihood, rows=None):
+    '''Fits the (P, F) spectra y (or only its rows, if given) starting from the seeds, one per fitted pixel,
+    in batches. Returns the fit_batch_lm results of the fitted pixels.'''
+    results = {}
+    count = len(y) if rows is None else len(rows)
+    for start in range(0, count, batch_size):
+        batch_data = y[start:start + batch_size] if rows is None else y[rows[start:start + batch_size]]
+        batch = fit_batch_lm(batch_data, freq, seeds[start:start + batch_size], device, max_iter=max_iter, likelihood=likelihood)
+        for name, values in batch.items():
+            results.setdefault(name, []).append(values)
+    return {name: np.concatenate(values) for name, values in results.items()}
+
+
+def _params(results):
+    return np.stack([results[name] for name in param_names], axis=1)
+
+
+def _good(results, norm, error_threshold):
+    '''Pixels whose fit converged with a normalized mean squared error below the error threshold.'''
+    return results["converged"] & (results["mse"] / norm**2 <= error_threshold)
+
+
+def _tv_refine(y, freq, params, good, shape, tv_weight, device, batch_size, max_iter, likelihood, dtype=torch.float64):
+    '''One reweighted sweep of the total variation refinement: every pixel is refitted with the penalty
+    tv_weight * sum |p - p_neighbour| / step over width, f_center and f_delta of its good neighbours, which
+    are kept fixed during the sweep. The absolute value is approximated by reweighted least squares.
+    Returns the fit result of all pixels.'''
+    M, N = shape
+    step = np.min(np.abs(np.diff(freq)))
+    f_ref = 0.5 * (np.max(freq) + np.min(freq))
+    maps = params.reshape(M, N, -1)
+    neighbours, exists = neighbour_stack(maps[..., tv_params], good.reshape(M, N))
+    #(P, 4, 3) neighbour values and IRLS weights; missing neighbours get zero weight
+    targets = neighbours.transpose(1, 2, 0, 3).reshape(M*N, 4, len(tv_params))
+    exists = exists.transpose(1, 2, 0).reshape(M*N, 4)
+    own = params[:, None, tv_params]
+    penalty_weights = tv_weight / (step * np.maximum(np.abs(own - targets), 0.01*step)) * exists[..., None]
+    targets = np.where(exists[..., None], targets, own)
+    targets[..., 1] -= f_ref
+
+    K = 4 * len(tv_params)
+    selector = torch.zeros((K, len(param_names)), dtype=dtype, device=device)
+    selector[torch.arange(K), torch.tensor(tv_params * 4)] = 1
+    def func(f, p):
+        return torch.cat((_double_dip_model(f, p), p[:, tv_params].repeat(1, 4)), dim=1)
+    def jacobian(f, p):
+        return torch.cat((_double_dip_model_jacobian(f, p), selector.expand(len(p), K, -1)), dim=1)
+
+    f = torch.tensor(np.asarray(freq) - f_ref, dtype=dtype, device=device)
+    results = {}
+    for start in range(0, len(y), batch_size):
+        end = min(start + batch_size, len(y))
+        data = torch.tensor(y[start:end], dtype=dtype, device=device)
+        data_weights = 1 / torch.clamp(data, min=1) if likelihood == "wls" else torch.ones_like(data)
+        y_aug = torch.cat((data, torch.tensor(targets[start:end].reshape(-1, K), dtype=dtype, device=device)), dim=1)
+        weights = torch.cat((data_weights, torch.tensor(penalty_weights[start:end].reshape(-1, K), dtype=dtype, device=device)), dim=1)
+        p0 = torch.tensor(params[start:end], dtype=dtype, device=device)
+        p0[:, 3] -= f_ref
+        result = levenberg_marquardt(func, jacobian, f, y_aug, p0, weights=weights, max_iter=max_iter,
+                                     scale_covariance=(likelihood == "mse"))
+
+        fitted = result["params"].cpu().numpy()
+        errors = result["errors"].cpu().numpy()
+        fitted[:, 3] += f_ref
+        fitted[:, 2] = np.abs(fitted[:, 2])
+        fitted[:, 4] = np.abs(fitted[:, 4])
+        batch = {"converged": result["converged"].cpu().numpy(), "iterations": result["iterations"].cpu().numpy(),
+                 "mse": ((data - _double_dip_model(f, result["params"]))**2).mean(dim=1).cpu().numpy()}
+        for i, name in enumerate(param_names):
+            batch[name] = fitted[:, i]
+            batch[name + "_err"] = errors[:, i]
+        for name, values in batch.items():
+            results.setdefault(name, []).append(values)
+    return {name: np.concatenate(values) for name, values in results.items()}
+
+
+def fit_spatial(data, freq, bin_factor=4, tv_weight=0.0, tv_iterations=3, max_waves=None, tail=5, thresholds=[3, 5],
+                error_threshold=0.1, default_values=None, batch_size=300000, device=None, num_threads=None, max_iter=100,
+                verbose=True, likelihood="mse", exposure=1.0):
+    '''Fits the double Lorentzian to the (M, N, F) data with binned-parent seeding, wavefront refits and
+    an optional total variation penalty (see the module docstring).
+
+    Arguments as in double_dip_fitter.fit_double_lorentzian (always with method "lm"), and:
+    - bin_factor: size of the blocks of the coarsest level, a power of 2. 1 skips the coarse levels.
+    - tv_weight: weight of the total variation penalty, as the cost of a jump of one frequency step between
+      neighbours in units of the fit cost (sum of squared residuals). 0 disables the refinement.
+      Not available for the Poisson likelihood.
+    - tv_iterations: number of reweighted sweeps of the refinement
+    - max_waves: maximum number of wavefront refits (default: until no pixel improves)
+
+    Returns the same maps as fit_double_lorentzian with method "lm", where "iterations" counts the iterations
+    of all fits of a pixel, and "seed": 0 for pixels started from their own initial guess, 1 from their binned
+    parent and 2 from their neighbours.'''
+    M, N, F = data.shape
+    if tv_weight > 0 and likelihood == "poisson":
+        raise Exception("ERROR: the total variation penalty is not available for the Poisson likelihood!")
+    device = select_device(device, num_threads)
+    if verbose:
+        print("Spatially seeded fit on device:", device)
+    freq = np.asarray(freq, dtype=float)
+    batch_size = max(1, batch_size)
+    #The data stays as stored (e.g. integer counts); batches and pyramid blocks are read as float32
+    y = _spectra(data, F, exposure if likelihood != "mse" else 1.0)
+    #Normalization of the mse, so that the error threshold means the same as for normalized spectra
+    norm = _blockwise(y, lambda block: np.max(block, axis=1), batch_size) if likelihood != "mse" else np.ones(len(y))
+    norm = np.where(norm > 0, norm, 1)
+
+    num_levels = int(round(np.log2(bin_factor)))
+    if 2**num_levels != bin_factor:
+        raise Exception("ERROR: bin_factor must be a power of 2!")
+    pyramid = [y]
+    for level in range(num_levels):
+        pyramid.append(_binned_level(y, (M, N), batch_size) if level == 0 else bin_2x2(pyramid[-1]))
+
+    #Coarse to fine: every level starts from its parent in the level above
+    parent_params, parent_good = None, None
+    for level in range(num_levels, -1, -1):
+        shape = (M, N) if level == 0 else pyramid[level].shape[:2]
+        spectra = y if level == 0 else pyramid[level].reshape(-1, F)
+        seeds = _blockwise(spectra, lambda block: np.stack(estimate_initial_parameters(block[None], freq, tail, thresholds), axis=-1)[0], batch_size)
+        use_parent = np.zeros(len(seeds), dtype=bool)
+        if parent_params is not None:
+            use_parent = _seed_from_parent(seeds, parent_params, parent_good, shape)
+        if level == 0:
+            seed_source = use_parent.astype(np.int64)
+            break
+        level_fit = _fit_seeded(spectra, freq, seeds, device, batch_size, max_iter, likelihood)
+        level_norm = np.max(spectra, axis=1) if likelihood != "mse" else np.ones(len(spectra))
+        parent_good = _good(level_fit, np.where(level_norm > 0, level_norm, 1), error_threshold).reshape(shape)
+        parent_params = _params(level_fit).reshape(shape + (-1,))
+        if verbose:
+            print("Level {} ({}x binned): {} of {} pixels converged".format(level, 2**level, np.sum(parent_good), parent_good.size))
+
+    results = _fit_seeded(y, freq, seeds, device, batch_size, max_iter, likelihood)
+    good = _good(results, norm, error_threshold)
+    if verbose:
+        print("Seeded fit: {} of {} pixels converged".format(np.sum(good), M*N))
+
+    #Wavefronts: refit failed pixels from their good neighbours until nothing improves
+    wave = 0
+    tried = np.zeros(M*N, dtype=bool)
+    while max_waves is None or wave < max_waves:
+        params = _params(results).reshape(M, N, -1)
+        neighbours, exists = neighbour_stack(params, good.reshape(M, N))
+        candidates = ~good & ~tried & exists.any(axis=0).reshape(-1)
+        if not np.any(candidates):
+            break
+        neighbours = np.where(exists[..., None], neighbours, np.nan).reshape(4, M*N, -1)
+        neighbour_seeds = np.nanmedian(neighbours[:, candidates], axis=0)
+        indices = np.flatnonzero(candidates)
+        refit = _fit_seeded(y, freq, neighbour_seeds, device, batch_size, max_iter, likelihood, rows=indices)
+        better = refit["mse"] < results["mse"][indices]
+        results["iterations"][indices] += refit["iterations"]
+        for name in results:
+            if name != "iterations":
+                results[name][indices[better]] = refit[name][better]
+        seed_source[indices[better]] = 2
+        #A pixel is retried only when one of its neighbours became good in the meantime
+        tried[indices] = True
+        new_good = _good(results, norm, error_threshold) & ~good
+        tried[np.flatnonzero(neighbour_stack(new_good.reshape(M, N), np.ones((M, N), dtype=bool))[0].any(axis=0).reshape(-1))] = False
+        good |= new_good
+        wave += 1
+        if verbose:
+            print("Wave {}: {} of {} pixels improved, {} converged in total".format(wave, np.sum(better), len(indices), np.sum(good)))
+        if not np.any(new_good):
+            break
+
+    for sweep in range(tv_iterations if tv_weight > 0 else 0):
+        refined = _tv_refine(y, freq, _params(results), good, (M, N), tv_weight, device, batch_size, max_iter, likelihood)
+        refined["iterations"] = results["iterations"] + refined["iterations"]
+        for name in refined:
+            results[name] = refined[name]
+        if verbose:
+            print("Total variation sweep {} done".format(sweep + 1))
+
+    fitted_params = {name: values for name, values in results.items() if name != "chi2_red"}
+    fitted_params["r2"] = np.concatenate([r_squared(y[start:start + batch_size], results["mse"][start:start + batch_size])
+                                          for start in range(0, len(y), batch_size)])
+    if likelihood != "mse":
+        #Back to the scale of spectra normalized by their maximum, as fit_double_lorentzian does
+        for name in ["I0", "A", "I0_err", "A_err"]:
+            fitted_params[name] = fitted_params[name] / norm
+        fitted_params["mse"] = fitted_params["mse"] / norm**2
+    fitted_params["masked"] = np.zeros(M*N, dtype=bool)
+    fitted_params["seed"] = seed_source
+    for name in fitted_params:
+        fitted_params[name] = fitted_params[name].reshape(M, N)
+
+    if default_values is None:
+        default_values = {"I0": 1.0, "A": 0, "width": 1.0, "f_center": 2.87, "f_delta": 0.0}
+    failed_pixels = ~(fitted_params["mse"] <= error_threshold)
+    for name in param_names:
+        fitted_params[name][failed_pixels] = default_values[name]
+    return fitted_params
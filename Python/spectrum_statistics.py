@@ -0,0 +1,98 @@
+'''Whole-array per-pixel statistics of ODMR spectra.
+
+All functions work on (..., F) arrays, where the last axis is frequency, and are safe to
+use on memory-mapped input (np.load(..., mmap_mode="r")): the data are read in blocks
+of rows and the results are written to float32 arrays, so no float64 copy of the
+full cube is ever made.'''
+
+import numpy as np
+
+#Approximate size of the blocks in which input data are read
+block_bytes = 64 * 2**20
+
+
+def _row_blocks(data):
+    '''Yields slices along the first axis such that each block has about block_bytes.'''
+    row_bytes = max(1, data[0:1].nbytes)
+    rows = max(1, block_bytes // row_bytes)
+    for start in range(0, data.shape[0], rows):
+        yield slice(start, min(start + rows, data.shape[0]))
+
+
+def tail_values(block, tail):
+    '''First and last `tail` points of each spectrum, shape (..., 2*tail).'''
+    return np.concatenate((block[..., :tail], block[..., -tail:]), axis=-1)
+
+
+def normalization_values(block, method="max", tail=5, percentile=95):
+    '''Value that each spectrum of block is divided by during normalization.
+    method:
+    - "max": maximum of the spectrum (what was always used)
+    - "tail": baseline, mean of the first and last `tail` points
+    - "percentile": robust maximum, the given percentile of the spectrum'''
+    if(method == "max"):
+        return np.max(block, axis=-1)
+    elif(method == "tail"):
+        return np.mean(tail_values(block, tail), axis=-1)
+    elif(method == "percentile"):
+        return np.percentile(block, percentile, axis=-1)
+    raise Exception("ERROR: unknown normalization method " + str(method) + "!")
+
+
+def spectrum_snr(block, tail=5):
+    '''Depth of the deepest point below the baseline in units of the tail noise, for each spectrum of block.
+    0 where the tails have no noise.'''
+    tails = tail_values(block, tail)
+    noise_std = np.std(tails, axis=-1)
+    depth = np.mean(tails, axis=-1) - np.min(block, axis=-1)
+    snr = np.zeros(noise_std.shape, dtype=np.float32)
+    np.divide(depth, noise_std, out=snr, where=noise_std > 0)
+    return snr
+
+
+def snr_map(PL, tail=5):
+    '''(M, N) float32 SNR of the (M, N, F) spectra (see spectrum_snr), read in blocks of rows.
+    Cheap enough to screen out dark pixels before fitting.'''
+    snr = np.zeros(PL.shape[:-1], dtype=np.float32)
+    for rows in _row_blocks(PL):
+        snr[rows] = spectrum_snr(np.asarray(PL[rows]), tail)
+    return snr
+
+
+def pixel_maps(PL, method="max", tail=5, percentile=95):
+    '''Normalizes the (M, N, F) spectra in PL and computes the per-pixel maps in one pass.
+    Pixels whose normalization value is zero or not finite are masked: their normalized
+    spectrum, contrast and SNR are 0 and valid is False.
+
+    Returns a dictionary with
+    - "PL_normalized": (M, N, F) float32 normalized spectra
+    - "valid": (M, N) bool, False for masked pixels
+    - "mean_PL": (M, N) float32 mean PL over frequency
+    - "contrast_raw": (M, N) float32, max - min of the normalized spectrum (scale 0 to 1)
+    - "snr": (M, N) float32, depth of the deepest point below the baseline in units of the tail noise'''
+    spatial_shape = PL.shape[:-1]
+    maps = {
+        "PL_normalized": np.zeros(PL.shape, dtype=np.float32),
+        "valid": np.zeros(spatial_shape, dtype=bool),
+        "mean_PL": np.zeros(spatial_shape, dtype=np.float32),
+        "contrast_raw": np.zeros(spatial_shape, dtype=np.float32),
+        "snr": np.zeros(spatial_shape, dtype=np.float32),
+    }
+    for rows in _row_blocks(PL):
+        block = np.asarray(PL[rows])
+        norm = normalization_values(block, method, tail, percentile)
+        valid = np.isfinite(norm) & (norm != 0)
+        normalized = maps["PL_normalized"][rows]
+        np.divide(block, norm[..., None], out=normalized, where=valid[..., None])
+        maps["valid"][rows] = valid
+        maps["mean_PL"][rows] = np.mean(block, axis=-1)
+        maps["contrast_raw"][rows] = np.where(valid, np.max(normalized, axis=-1) - np.min(normalized, axis=-1), 0)
+
+        maps["snr"][rows] = np.where(valid, spectrum_snr(block, tail), 0)
+    return maps
+
+
+def normalize_spectra(PL, method="max", tail=5, percentile=95):
+    '''Returns (PL_normalized, valid). See pixel_maps.'''
+    maps = pixel_maps(PL, method, tail, percentile)
+    return maps["PL_normalized"], maps["valid"]
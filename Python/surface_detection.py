@@ -0,0 +1,191 @@
+'''Vectorized surface detection on 3D PL scans.
+
+A 3DPL scan is an (M, N, Z) cube of count rates. The top and back surface of the
+diamond are where the count rate first and last exceeds a threshold along z. This
+module finds those crossings for all pixels at once, fits (robust) planes through
+them and samples the PL on the fitted planes.'''
+
+import time
+import numpy as np
+
+
+def plane_z(xy, z0, ax, ay):
+    """xy format [x, y].
+    Or for fitting: [[x1, x2, x3, ...], [y1, y2, y3, ...]]"""
+    return z0 + ax*xy[0] + ay*xy[1]
+
+
+def first_crossing(cube, threshold):
+    '''Index of the first point along the last axis above threshold.
+    Returns (index, found). index is 0 where nothing is above threshold.'''
+    above = cube > threshold
+    return np.argmax(above, axis=-1), np.any(above, axis=-1)
+
+
+def last_crossing(cube, threshold):
+    '''Index of the last point along the last axis above threshold.
+    Returns (index, found). index is Z-1 where nothing is above threshold.'''
+    above = cube[..., ::-1] > threshold
+    return cube.shape[-1] - 1 - np.argmax(above, axis=-1), np.any(above, axis=-1)
+
+
+def _interpolate_crossing(cube, z, index, neighbour, threshold):
+    '''Linear interpolation of the threshold crossing between index and neighbour along z.'''
+    neighbour = np.clip(neighbour, 0, len(z) - 1)
+    I_in = np.take_along_axis(cube, index[..., None], axis=-1)[..., 0]
+    I_out = np.take_along_axis(cube, neighbour[..., None], axis=-1)[..., 0]
+    z_in = z[index]
+    z_out = z[neighbour]
+    denominator = I_in - I_out
+    fraction = np.divide(I_in - threshold, denominator, out=np.zeros(denominator.shape), where=denominator != 0)
+    return z_in + np.clip(fraction, 0, 1) * (z_out - z_in)
+
+
+def surface_heights(cube, z, threshold, interpolate=True, fill=np.nan):
+    '''Top (first crossing) and back (last crossing) surface height of every pixel.
+    cube: (..., Z) count rates, z: (Z,) positions.
+    interpolate: if True, the crossing is linearly interpolated between the z steps,
+    otherwise the z of the first point above threshold is returned.
+    Pixels that never cross the threshold get fill.
+    Returns (top, back).'''
+    z = np.asarray(z, dtype=float)
+    i_top, found = first_crossing(cube, threshold)
+    i_back, _ = last_crossing(cube, threshold)
+    if(interpolate):
+        top = _interpolate_crossing(cube, z, i_top, i_top - 1, threshold)
+        back = _interpolate_crossing(cube, z, i_back, i_back + 1, threshold)
+    else:
+        top = z[i_top]
+        back = z[i_back]
+    top = np.where(found, top, fill)
+    back = np.where(found, back, fill)
+    return top, back
+
+
+def fit_plane(x, y, z, method="lstsq", huber_k=1.345, ransac_iterations=200, ransac_tolerance=None, seed=0, iterations=20):
+    '''Fits z = z0 + ax*x + ay*y through the points (x, y, z) with linear least squares.
+    method:
+    - "lstsq": ordinary least squares
+    - "huber": Huber M-estimator by iteratively reweighted least squares
+    - "ransac": plane through the largest consensus set of random 3-point samples, refitted with least squares
+    ransac_tolerance: maximum residual of an inlier. Default is 3 times the MAD-based noise estimate of the least squares residuals.
+    Returns (z0, ax, ay).'''
+    x = np.ravel(x)
+    y = np.ravel(y)
+    z = np.ravel(z)
+    if(len(z) < 3):
+        raise Exception("ERROR: at least three points are needed to fit a plane!")
+    A = np.stack((np.ones(len(z)), x, y), axis=1)
+    popt = np.linalg.lstsq(A, z, rcond=None)[0]
+
+    if(method == "lstsq"):
+        pass
+    elif(method == "huber"):
+        for i in range(iterations):
+            residuals = z - A @ popt
+            scale = 1.4826 * np.median(np.abs(residuals - np.median(residuals)))
+            if(scale == 0):
+                break
+            r = np.abs(residuals) / (huber_k * scale)
+            weights = np.sqrt(np.where(r <= 1, 1, 1/np.maximum(r, 1)))
+            popt_new = np.linalg.lstsq(A * weights[:, None], z * weights, rcond=None)[0]
+            converged = np.allclose(popt_new, popt, rtol=1e-10, atol=1e-12)
+            popt = popt_new
+            if(converged):
+                break
+    elif(method == "ransac"):
+        if(ransac_tolerance == None):
+            residuals = z - A @ popt
+            ransac_tolerance = 3 * 1.4826 * np.median(np.abs(residuals - np.median(residuals)))
+        rng = np.random.default_rng(seed)
+        samples = np.array([rng.choice(len(z), 3, replace=False) for i in range(ransac_iterations)])
+        #Solve all 3-point planes at once. Degenerate (collinear) samples are skipped.
+        A_samples = A[samples]
+        determinants = np.linalg.det(A_samples)
+        usable = np.abs(determinants) > 1e-12 * np.max(np.abs(A))**2
+        if(np.any(usable)):
+            planes = np.linalg.solve(A_samples[usable], z[samples[usable]][..., None])[..., 0]
+            inliers = np.abs(z[None, :] - planes @ A.T) <= ransac_tolerance
+            best = inliers[np.argmax(np.sum(inliers, axis=1))]
+            if(np.sum(best) >= 3):
+                popt = np.linalg.lstsq(A[best], z[best], rcond=None)[0]
+    else:
+        raise Exception("ERROR: unknown plane fit method " + str(method) + "!")
+    return popt[0], popt[1], popt[2]
+
+
+def closest_z_index(z, z_target):
+    '''Index of the z step closest to each z_target, found with searchsorted (ties go to the lower index).
+    Returns (index, inside), where inside is False for targets outside the measured z range.'''
+    z = np.asarray(z, dtype=float)
+    order = np.argsort(z, kind="stable")
+    z_sorted = z[order]
+    i = np.clip(np.searchsorted(z_sorted, z_target), 1, len(z) - 1)
+    lower_closer = np.abs(z_sorted[i - 1] - z_target) <= np.abs(z_sorted[i] - z_target)
+    index = order[np.where(lower_closer, i - 1, i)]
+    inside = (z_target > z_sorted[0]) & (z_target < z_sorted[-1])
+    return index, inside
+
+
+def plane_slice(cube, z, z_plane, fill=0):
+    '''Samples the cube at the z step closest to z_plane[ix, iy] for every pixel.
+    Pixels where the plane lies outside the measured z range get fill.'''
+    index, inside = closest_z_index(z, z_plane)
+    values = np.take_along_axis(cube, index[..., None], axis=-1)[..., 0]
+    return np.where(inside, values, fill)
+
+
+def surface_maps(cube, x, y, z, threshold, diamond_threshold=None, fit_method="huber", interpolate=True, method="threshold"):
+    '''Full surface analysis of an (M, N, Z) 3DPL scan.
+    x, y, z: stage positions along the three axes. threshold is the count rate that marks a
+    surface crossing. Pixels with a z-averaged count rate above diamond_threshold (default:
+    threshold) are considered diamond and used for the plane fits.
+    method: "threshold" finds the surfaces at the threshold crossings, "peak" at the fitted PL peaks
+    (see z_profile.py, slower but with sub-step precision).
+    Returns a dictionary with the maps "top_surface", "back_surface", "thickness",
+    "PL_top_surface" and "PL_back_surface", the diamond mask "diamond" and the fitted
+    planes "top_plane" and "back_plane" as (z0, ax, ay).'''
+    if(method == "threshold"):
+        top_surface, back_surface = surface_heights(cube, z, threshold, interpolate)
+    elif(method == "peak"):
+        #Imported here, the threshold method does not need torch
+        from z_profile import fit_z_profiles
+        peaks = fit_z_profiles(cube, z)
+        top_surface, back_surface = peaks["top"], peaks["back"]
+    else:
+        raise Exception("ERROR: unknown surface method " + str(method) + "!")
+    if(diamond_threshold == None):
+        diamond_threshold = threshold
+    diamond = (np.mean(cube, axis=-1) > diamond_threshold) & np.isfinite(top_surface)
+    X, Y = np.meshgrid(x, y, indexing="ij")
+    results = {
+        "top_surface": top_surface,
+        "back_surface": back_surface,
+        "thickness": np.abs(top_surface - back_surface),
+        "diamond": diamond,
+    }
+    for name, surface in [("top", top_surface), ("back", back_surface)]:
+        plane = fit_plane(X[diamond], Y[diamond], surface[diamond], method=fit_method)
+        results[name + "_plane"] = plane
+        results["PL_" + name + "_surface"] = plane_slice(cube, z, plane_z([X, Y], *plane))
+    return results
+
+
+if __name__ == "__main__":
+    #Benchmark on a synthetic tilted slab
+    M, N, Z = 200, 200, 200
+    x = np.linspace(-2, -1.9, M)
+    y = np.linspace(3, 3.1, N)
+    z = np.linspace(0, 0.1, Z)
+    X, Y = np.meshgrid(x, y, indexing="ij")
+    z_top = 0.02 + 0.05*(X - x[0]) - 0.03*(Y - y[0])
+    z_back = z_top + 0.05
+    dz = z[None, None, :]
+    cube = 300 + 2e4 / (1 + ((dz - z_top[..., None]) / 0.004)**2) + 2e4 / (1 + ((dz - z_back[..., None]) / 0.004)**2)
+    cube += np.random.default_rng(0).normal(0, 100, cube.shape)
+
+    start = time.time()
+    results = surface_maps(cube, x, y, z, threshold=1e4, diamond_threshold=1000)
+    print("Processed {}x{}x{} cube in {:.3f} s".format(M, N, Z, time.time() - start))
+    print("Top plane (z0, ax, ay):", results["top_plane"])
+    print("Back plane (z0, ax, ay):", results["back_plane"])
@@ -0,0 +1,107 @@
+'''Shared fixtures of the test suite: synthetic NV maps, runtime budgets and the benchmark mode.
+
+Runtime budgets are wall-clock limits (s) for the accuracy tests, set a few times above what a
+laptop CPU needs. Multiply them with --budget-factor on slower machines.
+
+With --benchmark, the tests marked "benchmark" run (they are skipped otherwise). Every benchmark
+records its throughput (pixels/s) with a time stamp, commit and host name in a JSON lines history
+file, and fails when it is more than --benchmark-tolerance (relative) slower than the median of the
+earlier records of the same benchmark on the same host.'''
+
+import os
+import sys
+import json
+import time
+import socket
+import subprocess
+import numpy as np
+import matplotlib
+import pytest
+
+#The modules are flat scripts in Python/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+matplotlib.use("Agg")
+
+from synthetic_nv import nv_map
+
+default_history = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_history.jsonl")
+
+
+def pytest_addoption(parser):
+    parser.addoption("--benchmark", action="store_true", help="Run the throughput benchmarks and record them in the history file.")
+    parser.addoption("--benchmark-history", default=default_history, help="JSON lines file with the benchmark records.")
+    parser.addoption("--benchmark-tolerance", type=float, default=0.3, help="Largest accepted relative drop of the throughput below the median of earlier records.")
+    parser.addoption("--budget-factor", type=float, default=1.0, help="Multiplies all runtime budgets (for slow machines).")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "benchmark: throughput benchmark, only run with --benchmark")
+
+
+def pytest_collection_modifyitems(config, items):
+    if(config.getoption("--benchmark")):
+        return
+    skip = pytest.mark.skip(reason="benchmark, run with --benchmark")
+    for item in items:
+        if("benchmark" in item.keywords):
+            item.add_marker(skip)
+
+
+@pytest.fixture(scope="session")
+def odmr_map():
+    '''24 x 24 map of normalized spectra with 101 frequencies and 0.5% noise.'''
+    return nv_map(24, 24, 101, noise=0.005, seed=0)
+
+
+@pytest.fixture
+def budget(request):
+    '''budget(seconds): the runtime budget scaled by --budget-factor.'''
+    factor = request.config.getoption("--budget-factor")
+    return lambda seconds: seconds * factor
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=10,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def read_history(path):
+    if(not os.path.exists(path)):
+        return []
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+@pytest.fixture
+def benchmark(request):
+    '''benchmark(name, pixels, function, rounds=3, **info): runs function() rounds times after one warm-up run,
+    records pixels / (fastest time) in the history and checks it against earlier records.
+    Returns the record.'''
+    config = request.config
+    path = config.getoption("--benchmark-history")
+    tolerance = config.getoption("--benchmark-tolerance")
+
+    def run(name, pixels, function, rounds=3, **info):
+        function()
+        times = []
+        for r in range(rounds):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+        host = socket.gethostname()
+        record = {"name": name, "pixels_per_s": pixels / min(times), "time": min(times), "pixels": pixels,
+                  "date": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": _commit(), "host": host}
+        record.update(info)
+        earlier = [r["pixels_per_s"] for r in read_history(path) if r["name"] == name and r["host"] == host]
+        with open(path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        print("{}: {:.1f} pixels/s".format(name, record["pixels_per_s"]))
+        if(len(earlier) > 0):
+            reference = float(np.median(earlier))
+            assert record["pixels_per_s"] >= (1 - tolerance) * reference, \
+                "{} regressed: {:.1f} pixels/s against a median of {:.1f} over {} earlier runs".format(name, record["pixels_per_s"], reference, len(earlier))
+        return record
+    return run
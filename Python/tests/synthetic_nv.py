@@ -0,0 +1,94 @@
+'''Synthetic NV maps and scans for the test suite.
+
+nv_map() builds an (M, N, F) ODMR map from double_dip_func with smoothly varying strain
+(splitting and centre shift over the map), random line widths, a PL map with a diamond
+region on a dark substrate, and either Gaussian noise on the normalized spectra or Poisson
+noise on the photon counts. write_odmr_scan(), write_3dpl_scan() and write_z_scan() store such data with
+their settings like ODMR_2D.py does, so the processing scripts can run on them.'''
+
+import json
+import numpy as np
+
+from double_dip_fitter import double_dip_func
+
+param_keys = ["I0", "A", "width", "f_center", "f_delta"]
+
+
+def nv_map(M=24, N=24, num_freq=101, noise=0.005, seed=0, min_freq=2.85e9, max_freq=2.89e9, substrate=0.0, exposure=None, rate=2e5):
+    '''Synthetic ODMR map.
+    noise: standard deviation of the Gaussian noise on the normalized spectra (ignored with exposure)
+    substrate: fraction of the map (at high x) without diamond, with 1% of the PL and no dips
+    exposure: counting time (s) per point. Given: Poisson counts of rate (counts/s) times the spectrum.
+    Returns a dictionary with "freq" (Hz), "freq_GHz", "data" (normalized spectra, or counts with exposure),
+    "rate" (M, N, F counts/s), "diamond" (M, N) and "truth", the (M, N) maps of param_keys (GHz).'''
+    rng = np.random.default_rng(seed)
+    freq = np.linspace(min_freq, max_freq, num_freq)
+    freq_GHz = freq * 1e-9
+    X, Y = np.meshgrid(np.linspace(0, 1, M), np.linspace(0, 1, N), indexing="ij")
+    diamond = X <= 1 - substrate
+    truth = {
+        "I0": np.ones((M, N)),
+        "A": np.where(diamond, 0.12 + 0.03*Y, 0.0),
+        "width": rng.uniform(0.0015, 0.003, (M, N)),
+        "f_center": 2.87 + 0.001*(X - 0.5),
+        "f_delta": 0.004 + 0.006*X*Y,
+    }
+    spectra = double_dip_func(freq_GHz, *[truth[key][..., None] for key in param_keys])
+    rates = rate * np.where(diamond, 1.0, 0.01)[..., None] * spectra
+    if(exposure == None):
+        data = spectra + rng.normal(0, noise, spectra.shape)
+    else:
+        data = rng.poisson(rates * exposure).astype(np.uint32)
+    return {"freq": freq, "freq_GHz": freq_GHz, "data": data, "rate": rates, "diamond": diamond, "truth": truth}
+
+
+def base_settings(measurement_type, x_steps, y_steps, dwell_time=1e10):
+    return {"measurement_type": measurement_type, "x1": -0.01, "x2": 0.01, "y1": -0.01, "y2": 0.01,
+            "x_steps": x_steps, "y_steps": y_steps, "dwell_time": dwell_time, "data_unit": "counts"}
+
+
+def write_odmr_scan(directory, M=12, N=10, num_freq=61, seed=0, num_sweeps=2, dwell_time=1e10):
+    '''Stores a synthetic ODMR scan of photon counts summed over num_sweeps (dwell_time in ps) in directory.
+    Returns (path of the .npy file, nv_map result).'''
+    exposure = dwell_time * 1e-12 * num_sweeps
+    result = nv_map(M, N, num_freq, seed=seed, exposure=exposure)
+    settings = base_settings("ODMR", M, N, dwell_time)
+    settings.update(min_freq=float(result["freq"][0]), max_freq=float(result["freq"][-1]), num_measurements=num_freq, num_sweeps=num_sweeps)
+    return _write(directory, "2D_ODMR_scan_test", result["data"], settings), result
+
+
+def write_3dpl_scan(directory, M=10, N=8, z_steps=40, seed=0, dwell_time=1e10):
+    '''Stores a synthetic 3DPL scan of a slab with its top surface at 4.53 mm and 0.1 mm optical thickness
+    (Lorentzian focus peaks) in directory. Returns (path of the .npy file, dictionary with z, "top" and "back").'''
+    rng = np.random.default_rng(seed)
+    z = np.linspace(4.50, 4.66, z_steps)
+    top = np.full((M, N), 4.53)
+    back = top + 0.1
+    counts = rng.poisson(slab_rates(z, top[..., None], back[..., None]) * dwell_time * 1e-12).astype(np.uint32)
+    settings = base_settings("3DPL", M, N, dwell_time)
+    settings.update(z1=float(z[0]), z2=float(z[-1]), z_steps=z_steps)
+    return _write(directory, "3D_PL_scan_test", counts, settings), {"z": z, "top": top, "back": back}
+
+
+def write_z_scan(directory, z_steps=140, seed=0, dwell_time=1e10):
+    '''Stores a synthetic z scan of photon counts through the slab of write_3dpl_scan() in directory.
+    Returns (path of the .npy file, dictionary with z, "top" and "back").'''
+    rng = np.random.default_rng(seed)
+    z = np.linspace(4.50, 4.66, z_steps)
+    counts = rng.poisson(slab_rates(z, 4.53, 4.63) * dwell_time * 1e-12).astype(np.uint32)
+    settings = {"z1": float(z[0]), "z2": float(z[-1]), "z_steps": z_steps, "x0": 0.0, "y0": 0.0,
+                "dwell_time": dwell_time, "data_unit": "counts"}
+    return _write(directory, "z_scan_test", counts, settings), {"z": z, "top": 4.53, "back": 4.63}
+
+
+def slab_rates(z, top, back):
+    '''Count rate (counts/s) at stage positions z of a slab with Lorentzian focus peaks at its top and back surface.'''
+    return 300 + 2e5 / (1 + ((z - top) / 0.004)**2) + 1.5e5 / (1 + ((z - back) / 0.004)**2)
+
+
+def _write(directory, name, data, settings):
+    path = str(directory) + "/" + name
+    np.save(path + ".npy", data)
+    with open(path + ".json", "w") as f:
+        json.dump(settings, f)
+    return path + ".npy"
@@ -0,0 +1,58 @@
+'''Throughput benchmarks (pixels/s), run with --benchmark. See conftest.py for the history file
+and the regression check.'''
+
+import numpy as np
+import pytest
+import torch
+
+import double_dip
+from double_dip_fitter import fit_double_lorentzian
+from spectrum_statistics import pixel_maps
+from z_profile import fit_z_profiles
+from synthetic_nv import nv_map
+
+devices = ["cpu"] + (["cuda"] if torch.cuda.is_available() else [])
+
+
+@pytest.fixture(scope="module")
+def large_map():
+    return nv_map(64, 64, 101, seed=0)
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("device", devices)
+def test_lm_throughput(benchmark, large_map, device):
+    data = large_map["data"]
+    def run():
+        fit_double_lorentzian(data, large_map["freq_GHz"], method="lm", device=device, verbose=False)
+        if(device == "cuda"):
+            torch.cuda.synchronize()
+    benchmark("fit_double_lorentzian_lm_" + device, data.shape[0]*data.shape[1], run, device=device, shape=list(data.shape))
+
+
+@pytest.mark.benchmark
+def test_adam_throughput(benchmark, large_map):
+    data = large_map["data"][:16, :16]
+    benchmark("fit_double_lorentzian_adam_cpu", 256, lambda: fit_double_lorentzian(data, large_map["freq_GHz"], method="adam", epochs=1000, device="cpu", verbose=False),
+              rounds=1, shape=list(data.shape))
+
+
+@pytest.mark.benchmark
+def test_scipy_throughput(benchmark, large_map):
+    data = large_map["data"][:8]
+    benchmark("fit_double_dip_map_scipy", 8*data.shape[1], lambda: double_dip.fit_double_dip_map(data, large_map["freq_GHz"]),
+              rounds=1, shape=list(data.shape))
+
+
+@pytest.mark.benchmark
+def test_pixel_maps_throughput(benchmark):
+    rates = nv_map(256, 256, 101, exposure=0.01)["data"] / np.float32(0.01)
+    benchmark("pixel_maps", 256*256, lambda: pixel_maps(rates), shape=list(rates.shape))
+
+
+@pytest.mark.benchmark
+def test_z_profile_throughput(benchmark):
+    z = np.linspace(4.50, 4.66, 60)
+    rates = 300 + 2e5 / (1 + ((z - 4.53) / 0.004)**2) + 1.5e5 / (1 + ((z - 4.63) / 0.004)**2)
+    profiles = np.random.default_rng(0).poisson(np.broadcast_to(rates * 0.01, (100, 100, 60))) / 0.01
+    benchmark("fit_z_profiles_cpu", 100*100, lambda: fit_z_profiles(profiles, z, device="cpu", verbose=False), shape=list(profiles.shape))
@@ -0,0 +1,219 @@
+'''Fit accuracy and runtime budgets of the ODMR fitters on synthetic NV maps.'''
+
+import time
+import numpy as np
+import pytest
+
+import double_dip
+import torch
+from double_dip_fitter import (fit_double_lorentzian, synthetic_double_dip_map, fit_batch_adam, estimate_initial_parameters, select_device, param_names,
+                               auto_batch_size, min_batch_size, max_batch_size, available_memory, batch_memory)
+from odmr_models import fit_models
+from spatial_fit import fit_spatial
+from scan_data import RateView
+from synthetic_nv import nv_map
+
+
+def median_errors(fitted, truth, keys=["f_center", "f_delta", "width"]):
+    '''Median absolute error (MHz) of the fitted maps.'''
+    return {key: 1e3*float(np.median(np.abs(np.asarray(fitted[key]) - truth[key]))) for key in keys}
+
+
+def test_device_selection():
+    '''Without a device the fit runs on CUDA when available and on the CPU otherwise, with the requested threads.'''
+    expected = "cuda" if torch.cuda.is_available() else "cpu"
+    assert select_device().type == expected
+    threads = torch.get_num_threads()
+    try:
+        assert select_device("cpu", num_threads=1) == torch.device("cpu") and torch.get_num_threads() == 1
+    finally:
+        torch.set_num_threads(threads)
+    freq = np.linspace(2.85, 2.89, 81)
+    data, truth = synthetic_double_dip_map(4, 4, freq, seed=0)
+    fitted = fit_double_lorentzian(data, freq, method="lm", verbose=False)
+    assert np.median(np.abs(fitted["f_center"] - truth["f_center"])) < 1e-4
+
+
+def test_lm_accuracy(odmr_map, budget):
+    start = time.perf_counter()
+    fitted = fit_double_lorentzian(odmr_map["data"], odmr_map["freq_GHz"], method="lm", device="cpu", verbose=False)
+    elapsed = time.perf_counter() - start
+    errors = median_errors(fitted, odmr_map["truth"])
+    assert errors["f_center"] < 0.1
+    assert errors["f_delta"] < 0.3
+    assert errors["width"] < 0.3
+    assert np.mean(fitted["converged"]) > 0.9
+    assert elapsed < budget(5)
+
+
+def test_lm_reported_errors(odmr_map):
+    '''The standard errors of the Levenberg-Marquardt fit match the actual scatter of f_center
+    (median absolute pull 0.674 for Gaussian errors).'''
+    fitted = fit_double_lorentzian(odmr_map["data"], odmr_map["freq_GHz"], method="lm", device="cpu", verbose=False)
+    good = fitted["converged"] & (fitted["f_center_err"] > 0)
+    pulls = (fitted["f_center"] - odmr_map["truth"]["f_center"])[good] / fitted["f_center_err"][good]
+    assert 0.5 < np.median(np.abs(pulls)) / 0.674 < 2
+
+
+def test_batches_match_single_batch(odmr_map):
+    '''Batches reuse one staging buffer: the result must not depend on the batch size.'''
+    data = odmr_map["data"][:10].astype(np.float32)
+    whole = fit_double_lorentzian(data, odmr_map["freq_GHz"], method="lm", device="cpu", verbose=False)
+    batched = fit_double_lorentzian(data, odmr_map["freq_GHz"], method="lm", batch_size=37, device="cpu", verbose=False)
+    assert all(np.allclose(whole[key], batched[key], rtol=1e-9, atol=0, equal_nan=True) for key in whole)
+
+
+def test_automatic_batch_size(odmr_map):
+    '''Batches are sized from the free memory, smaller for longer spectra, and every batch is logged.'''
+    cpu = torch.device("cpu")
+    assert min_batch_size <= auto_batch_size(1000, cpu) <= auto_batch_size(100, cpu) <= max_batch_size
+    #Without a budget the CPU batches take a small part of the available memory
+    assert batch_memory(10**9, 100) <= max(0.25 * available_memory(), batch_memory(min_batch_size, 100))
+    batch_log = []
+    fitted = fit_double_lorentzian(odmr_map["data"], odmr_map["freq_GHz"], method="lm", device="cpu", verbose=False, batch_log=batch_log)
+    assert sum(entry["pixels"] for entry in batch_log) == fitted["I0"].size
+    assert all(entry["pixels_per_s"] > 0 for entry in batch_log)
+    #An explicit budget, as batch_process gives every worker, bounds the batches
+    budget = 2**20
+    assert auto_batch_size(101, cpu, memory_budget=budget) < auto_batch_size(101, cpu, memory_budget=64*budget)
+    batch_log = []
+    fit_double_lorentzian(odmr_map["data"], odmr_map["freq_GHz"], method="lm", device="cpu", verbose=False, memory_budget=budget, batch_log=batch_log)
+    assert max(entry["pixels"] for entry in batch_log) == auto_batch_size(101, cpu, memory_budget=budget) and len(batch_log) > 1
+
+
+def test_adam_accuracy(odmr_map, budget):
+    data = odmr_map["data"][:8, :8]
+    truth = {key: value[:8, :8] for key, value in odmr_map["truth"].items()}
+    start = time.perf_counter()
+    fitted = fit_double_lorentzian(data, odmr_map["freq_GHz"], method="adam", epochs=2000, device="cpu", verbose=False)
+    elapsed = time.perf_counter() - start
+    errors = median_errors(fitted, truth)
+    assert errors["f_center"] < 0.2
+    assert errors["f_delta"] < 1
+    assert elapsed < budget(30)
+
+
+def test_adam_does_not_freeze_rising_pixels():
+    '''With a learning rate that makes Adam oscillate, pixels whose error went up are not frozen as converged:
+    they end up as good as with a small learning rate.'''
+    result = nv_map(4, 4, 81, seed=0)
+    data = result["data"].reshape(-1, 81)
+    estimates = np.stack(estimate_initial_parameters(data[None], result["freq_GHz"]), axis=-1)[0]
+    mse = {}
+    for lr in [0.05, 0.5]:
+        fitted = fit_batch_adam(data, result["freq_GHz"], estimates, select_device("cpu"), lr=lr, epochs=300, check_interval=10, verbose=False)
+        mse[lr] = np.median(fitted["mse"][fitted["converged"]])
+    assert mse[0.5] < 1.05 * mse[0.05]
+
+
+def test_poisson_counts():
+    result = nv_map(16, 16, 81, exposure=0.02, seed=1)
+    fitted = fit_double_lorentzian(result["data"], result["freq_GHz"], method="lm", likelihood="poisson", device="cpu", verbose=False)
+    errors = median_errors(fitted, result["truth"])
+    assert errors["f_center"] < 0.2
+    assert errors["f_delta"] < 0.5
+    #I0 and A are returned relative to the maximum of every spectrum
+    assert np.all(np.abs(fitted["I0"] - 1) < 0.1)
+
+
+def test_failed_pixels_get_default_values():
+    result = nv_map(12, 12, 81, seed=2, substrate=0.25)
+    data = result["data"].copy()
+    #A pixel of pure noise does not fit a double dip
+    data[0, 0] = np.random.default_rng(0).uniform(0, 2, data.shape[-1])
+    fitted = fit_double_lorentzian(data, result["freq_GHz"], method="lm", device="cpu", verbose=False)
+    assert fitted["I0"][0, 0] == 1.0 and fitted["A"][0, 0] == 0
+    #Substrate pixels have no dips: a fitted contrast far below the diamond's
+    assert np.median(fitted["A"][~result["diamond"]]) < 0.05
+    assert set(param_names) <= set(fitted)
+    assert all(fitted[key].shape == (12, 12) for key in fitted)
+
+
+def test_scipy_fit_double_dip(odmr_map, budget):
+    '''The per-pixel scipy fitter of double_dip.py on one row of the map.'''
+    freq = odmr_map["freq_GHz"]
+    start = time.perf_counter()
+    popt = np.array([double_dip.fit_double_dip(freq, odmr_map["data"][0, j]) for j in range(odmr_map["data"].shape[1])])
+    elapsed = time.perf_counter() - start
+    truth = {key: value[0] for key, value in odmr_map["truth"].items()}
+    fitted = dict(zip(param_names, popt.T))
+    errors = median_errors(fitted, truth)
+    assert errors["f_center"] < 0.1
+    assert errors["f_delta"] < 0.3
+    assert elapsed < budget(5)
+
+
+def test_scipy_fit_double_dip_checks_input():
+    freq = np.linspace(2.85, 2.89, 8)
+    with pytest.raises(Exception):
+        double_dip.fit_double_dip(freq, np.ones(8))
+
+
+def test_scipy_map_fitter(odmr_map, capsys, budget):
+    '''The process pool fitter of double_dip.py: same maps as the torch fitter, status codes instead of
+    exceptions, nothing printed, and the same result for any number of processes.'''
+    data = odmr_map["data"][:8].copy()
+    data[0, 0] = np.nan
+    data[0, 1] = 1.0
+    start = time.perf_counter()
+    fitted = double_dip.fit_double_dip_map(data, odmr_map["freq_GHz"], processes=2, block_size=50)
+    elapsed = time.perf_counter() - start
+    assert capsys.readouterr().out == ""
+    reference = fit_double_lorentzian(odmr_map["data"][:2], odmr_map["freq_GHz"], method="lm", device="cpu", verbose=False)
+    assert set(reference) <= set(fitted)
+    assert fitted["status"][0, 0] == double_dip.INVALID and fitted["status"][0, 1] == double_dip.NO_DIP
+    assert fitted["masked"][0, :2].all() and fitted["I0"][0, 0] == 1.0
+    truth = {key: value[:8] for key, value in odmr_map["truth"].items()}
+    good = ~fitted["masked"]
+    assert median_errors({key: fitted[key][good] for key in param_names}, {key: truth[key][good] for key in param_names})["f_center"] < 0.1
+    serial = double_dip.fit_double_dip_map(data, odmr_map["freq_GHz"], processes=1)
+    assert all(np.array_equal(serial[key], fitted[key], equal_nan=True) for key in fitted)
+    assert elapsed < budget(10)
+
+
+def test_model_selection(odmr_map, budget):
+    data = odmr_map["data"][:12, :12]
+    start = time.perf_counter()
+    fitted = fit_models(data, odmr_map["freq_GHz"], ["single", "double_symmetric"], device="cpu", verbose=False)
+    elapsed = time.perf_counter() - start
+    #All splittings (4 to 10 MHz) are resolved at 1.5 to 3 MHz half width: the double model wins
+    assert np.mean(fitted["model"] == 1) > 0.9
+    assert median_errors(fitted, {key: value[:12, :12] for key, value in odmr_map["truth"].items()})["f_center"] < 0.1
+    assert elapsed < budget(10)
+
+
+def test_spatial_fit(odmr_map, budget):
+    start = time.perf_counter()
+    fitted = fit_spatial(odmr_map["data"], odmr_map["freq_GHz"], bin_factor=4, device="cpu", verbose=False)
+    elapsed = time.perf_counter() - start
+    errors = median_errors(fitted, odmr_map["truth"])
+    assert errors["f_center"] < 0.1
+    assert errors["f_delta"] < 0.3
+    assert elapsed < budget(10)
+
+
+def test_spatial_fit_penalty():
+    '''The total variation penalty pulls a noisy pixel towards its neighbours; pixels are seeded from their parents.'''
+    result = nv_map(8, 8, 81, seed=5)
+    data = result["data"].copy()
+    data[4, 4] += np.random.default_rng(1).normal(0, 0.1*data[4, 4].max(), 81)
+    errors = {}
+    for tv_weight in [0, 1]:
+        fitted = fit_spatial(data, result["freq_GHz"], bin_factor=2, tv_weight=tv_weight, device="cpu", verbose=False)
+        errors[tv_weight] = abs(fitted["f_delta"][4, 4] - result["truth"]["f_delta"][4, 4])
+        assert np.all(fitted["seed"] == 1)
+    assert errors[1] < 0.5e-3 and errors[1] < 0.1*errors[0]
+    assert np.all(fit_spatial(data, result["freq_GHz"], bin_factor=1, device="cpu", verbose=False)["seed"] == 0)
+    with pytest.raises(Exception, match="power of 2"):
+        fit_spatial(data, result["freq_GHz"], bin_factor=3, device="cpu", verbose=False)
+    with pytest.raises(Exception, match="Poisson"):
+        fit_spatial(data, result["freq_GHz"], tv_weight=1, likelihood="poisson", device="cpu", verbose=False)
+
+
+def test_spatial_fit_reads_counts_in_blocks():
+    '''Counts read through a RateView in small blocks give the same fit as the float32 rates.'''
+    result = nv_map(8, 6, 81, exposure=0.01, seed=3)
+    rates = result["data"].astype(np.float32) / np.float32(0.01)
+    fitted = fit_spatial(RateView(result["data"], 0.01), result["freq_GHz"], bin_factor=2, batch_size=10, device="cpu", verbose=False)
+    reference = fit_spatial(rates, result["freq_GHz"], bin_factor=2, device="cpu", verbose=False)
+    assert all(np.allclose(fitted[key], reference[key], equal_nan=True) for key in param_names)
@@ -0,0 +1,345 @@
+'''Processing stages on synthetic scans: spectrum maps, surfaces, z profiles, the fit cache,
+map pyramids, autofocus, focus tracking and the full process_scan run.'''
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+import pytest
+
+import fit_cache
+import figure_rendering
+from spectrum_statistics import pixel_maps
+from surface_detection import surface_maps, fit_plane, surface_heights, plane_slice
+from z_profile import fit_z_profiles
+from map_pyramid import bin_2x2, build_pyramid, read_region
+from scan_data import load_scan
+from autofocus import autofocus
+from focus_tracking import SurfaceModel, probe_focus, save_probes
+from instruments import SimulatedSample
+from ODMR_2D_process import add_processing_arguments, process_scan
+from live_fit import LiveFitter
+from scan_data import RateView
+from synthetic_nv import nv_map, write_odmr_scan, write_3dpl_scan, write_z_scan
+
+
+def processing_args(*options):
+    parser = argparse.ArgumentParser()
+    add_processing_arguments(parser)
+    return parser.parse_args(["--headless", "--processes", "1", "--device", "cpu"] + list(options))
+
+
+def test_pixel_maps():
+    result = nv_map(16, 12, 81, substrate=0.25, exposure=0.01)
+    rates = result["data"] / 0.01
+    rates[0, 0] = 0
+    maps = pixel_maps(rates, method="max")
+    assert not maps["valid"][0, 0] and maps["valid"][1:].all()
+    assert np.all(maps["PL_normalized"][0, 0] == 0)
+    assert np.nanmax(maps["PL_normalized"]) <= 1
+    #Dips of 2 x 12 to 15% contrast on the diamond
+    diamond = result["diamond"] & maps["valid"]
+    assert np.median(maps["contrast_raw"][diamond]) > 0.15
+    assert np.median(maps["snr"][diamond]) > 3 * np.median(maps["snr"][~result["diamond"]])
+
+
+@pytest.mark.parametrize("method", ["threshold", "peak"])
+def test_surface_maps(tmp_path, method):
+    path, truth = write_3dpl_scan(tmp_path)
+    with open(path[:-4] + ".json") as f:
+        settings = json.load(f)
+    PL = np.asarray(load_scan(path, settings)[1])
+    x = np.linspace(settings["x1"], settings["x2"], settings["x_steps"])
+    y = np.linspace(settings["y1"], settings["y2"], settings["y_steps"])
+    surfaces = surface_maps(PL, x, y, truth["z"], 5e4, diamond_threshold=1000, method=method)
+    step = truth["z"][1] - truth["z"][0]
+    assert surfaces["diamond"].all()
+    #Threshold crossings lie on the flanks of the focus peaks, the fitted peaks on their maxima
+    tolerance = 4*step if method == "threshold" else 0.2*step
+    assert np.median(np.abs(surfaces["thickness"] - 0.1)) < tolerance
+    if(method == "peak"):
+        assert np.median(np.abs(surfaces["top_surface"] - truth["top"])) < tolerance
+    assert abs(surfaces["top_plane"][1]) < 0.1 and abs(surfaces["top_plane"][2]) < 0.1
+
+
+def test_surface_heights_match_a_pixel_loop():
+    '''The vectorized threshold crossings equal the per-pixel search with linear interpolation that they replaced;
+    pixels that never cross the threshold are NaN.'''
+    rng = np.random.default_rng(0)
+    z = np.linspace(4.50, 4.66, 30)
+    cube = rng.uniform(0, 2000, (6, 5, 30))
+    cube[0, 0] = 10
+    top, back = surface_heights(cube, z, 1000)
+    for ix in range(6):
+        for iy in range(5):
+            above = np.flatnonzero(cube[ix, iy] > 1000)
+            if(len(above) == 0):
+                assert np.isnan(top[ix, iy]) and np.isnan(back[ix, iy])
+                continue
+            expected = []
+            for i, j in [(above[0], above[0] - 1), (above[-1], above[-1] + 1)]:
+                j = min(max(j, 0), len(z) - 1)
+                I_in, I_out = cube[ix, iy, i], cube[ix, iy, j]
+                fraction = 0 if I_in == I_out else np.clip((I_in - 1000) / (I_in - I_out), 0, 1)
+                expected.append(z[i] + fraction * (z[j] - z[i]))
+            assert np.allclose([top[ix, iy], back[ix, iy]], expected)
+    #The PL on a plane is taken at the closest z step, and outside the z range it is the fill value
+    z_plane = np.full((6, 5), z[7] + 0.4*(z[8] - z[7]))
+    z_plane[0, 0] = 5.0
+    sliced = plane_slice(cube, z, z_plane, fill=-1)
+    assert sliced[0, 0] == -1 and np.array_equal(sliced.ravel()[1:], cube[..., 7].ravel()[1:])
+
+
+def test_fit_plane_is_robust():
+    rng = np.random.default_rng(0)
+    x, y = rng.uniform(-1, 1, (2, 200))
+    z = 4.5 + 0.01*x - 0.02*y + rng.normal(0, 1e-4, 200)
+    z[:20] += 0.05
+    for method in ["huber", "ransac"]:
+        z0, ax, ay = fit_plane(x, y, z, method=method)
+        assert abs(ax - 0.01) < 1e-3 and abs(ay + 0.02) < 1e-3
+
+
+def test_z_profiles(budget):
+    z = np.linspace(4.50, 4.66, 60)
+    top = 4.53 + np.linspace(0, 0.01, 400)
+    rates = 300 + 2e5 / (1 + ((z - top[:, None]) / 0.004)**2) + 1.5e5 / (1 + ((z - top[:, None] - 0.1) / 0.004)**2)
+    profiles = np.random.default_rng(0).poisson(rates * 0.01) / 0.01
+    start = time.perf_counter()
+    peaks = fit_z_profiles(profiles.reshape(20, 20, 60), z, device="cpu", verbose=False)
+    elapsed = time.perf_counter() - start
+    assert peaks["top"].shape == (20, 20)
+    errors = (peaks["top"].ravel() - top) / peaks["top_err"].ravel()
+    assert np.sqrt(np.mean((peaks["top"].ravel() - top)**2)) < 2e-4
+    assert 0.5 < np.sqrt(np.mean(errors**2)) < 2
+    assert np.median(np.abs(peaks["thickness"] - 0.1)) < 2e-4
+    assert elapsed < budget(10)
+
+
+def test_z_profile_without_back_surface():
+    z = np.linspace(4.50, 4.66, 60)
+    rates = 300 + 2e5 / (1 + ((z - 4.55) / 0.004)**2)
+    peaks = fit_z_profiles(np.random.default_rng(0).poisson(rates * 0.01) / 0.01, z, device="cpu", verbose=False)
+    found = np.array([peaks["top"], peaks["back"]])
+    assert np.sum(np.isfinite(found)) == 1
+    assert abs(np.nanmax(found) - 4.55) < 1e-3
+    assert np.isnan(peaks["thickness"])
+
+
+def test_fit_cache_refits_changed_rows(tmp_path):
+    data = np.random.default_rng(0).random((32, 4, 10))
+    freq = np.arange(10.0)
+    calls = []
+    def fit(subset):
+        calls.append(len(subset))
+        return {"mean": np.asarray(subset).mean(axis=-1)}
+    cache_dir = str(tmp_path / "cache")
+    first = fit_cache.cached_fit(data, freq, fit, {"a": 1}, cache_dir)
+    again = fit_cache.cached_fit(data, freq, fit, {"a": 1}, cache_dir)
+    assert calls == [32]
+    assert np.array_equal(first["mean"], again["mean"])
+    data[-1] += 1
+    changed = fit_cache.cached_fit(data, freq, fit, {"a": 1}, cache_dir)
+    assert calls == [32, fit_cache.rows_per_block]
+    assert np.allclose(changed["mean"], data.mean(axis=-1))
+
+
+def test_fit_cache_with_other_maps(tmp_path):
+    '''An entry stored with other maps than the fit function returns (e.g. by the live fit) is fitted again
+    as a whole when rows changed; a changed configuration does not use it at all.'''
+    data = np.random.default_rng(0).random((32, 4, 10))
+    freq = np.arange(10.0)
+    calls = []
+    def fit(subset):
+        calls.append(len(subset))
+        return {"mean": np.asarray(subset).mean(axis=-1)}
+    cache_dir = str(tmp_path / "cache")
+    fit_cache.store(data, freq, {"mean": data.mean(axis=-1), "live": np.ones((32, 4))}, {"a": 1}, cache_dir)
+    assert set(fit_cache.cached_fit(data, freq, fit, {"a": 1}, cache_dir)) == {"mean", "live"}
+    assert calls == []
+    data[-1] += 1
+    refitted = fit_cache.cached_fit(data, freq, fit, {"a": 1}, cache_dir)
+    assert calls == [fit_cache.rows_per_block, 32] and set(refitted) == {"mean"}
+    fit_cache.cached_fit(data, freq, fit, {"a": 2}, cache_dir)
+    assert calls[-1] == 32
+
+
+def test_map_pyramid(tmp_path):
+    data = np.arange(40*30, dtype=float).reshape(40, 30)
+    assert np.allclose(bin_2x2(data)[0, 0], np.mean(data[:2, :2]))
+    settings = {"x1": 0.0, "x2": 4.0, "y1": 0.0, "y2": 3.0}
+    build_pyramid({"PL": data}, settings, str(tmp_path / "scan"), smallest=4)
+    full, extent, level = read_region(str(tmp_path / "scan"), "PL")
+    assert level == 0 and np.array_equal(full, data)
+    block, extent, level = read_region(str(tmp_path / "scan"), "PL", x_range=(1.0, 2.0), y_range=(0.0, 1.0))
+    assert np.array_equal(block, data[10:20, 0:10])
+    coarse, extent, level = read_region(str(tmp_path / "scan"), "PL", max_pixels=10)
+    assert level > 0 and max(coarse.shape) <= 10
+    #Odd sizes: the coarse edge blocks end at the scan edge
+    build_pyramid({"PL": data[:39, :29]}, settings, str(tmp_path / "odd"), smallest=4)
+    coarse, extent, level = read_region(str(tmp_path / "odd"), "PL", max_pixels=10)
+    assert level > 0 and np.allclose(extent, [0.0, 4.0, 0.0, 3.0])
+
+
+def test_bin_2x2_ignores_nan(monkeypatch):
+    data = np.ones((5, 3, 2))
+    data[0, 0] = 3.0
+    data[1, 1] = np.nan
+    data[4, 2] = np.nan
+    binned = bin_2x2(data)
+    assert binned.shape == (3, 2, 2) and binned.dtype == np.float32
+    assert np.allclose(binned[0, 0], 5/3) and np.allclose(binned[2, 0], 1.0)
+    assert np.all(np.isnan(binned[2, 1]))
+    #Maps above max_plot_pixels are binned before plotting
+    drawn = []
+    monkeypatch.setattr(figure_rendering, "plot_map", lambda data, *args, **kwargs: drawn.append(data.shape))
+    figure_rendering.render(figure_rendering.map_spec(np.ones((2*figure_rendering.max_plot_pixels + 1, 10)), "PL"), {}, "")
+    assert drawn == [(figure_rendering.max_plot_pixels // 2 + 1, 3)]
+
+
+def test_autofocus_finds_both_surfaces():
+    sample = SimulatedSample()
+    rng = np.random.default_rng(0)
+    result = autofocus(lambda z: rng.poisson(sample.rate(0, 0, z) * 0.2), 4.520, 4.660, 0.2)
+    assert result["dwells"] < 30
+    expected = np.array([sample.z_top, sample.z_top + sample.thickness])
+    assert np.all(np.abs(np.array(result["z"]) - expected) < 5*np.array(result["z_err"]) + 1e-4)
+
+
+def test_focus_tracking_follows_a_warped_surface():
+    sample = SimulatedSample(tilt=(-0.0009, 0.1), warp=10.0)
+    rng = np.random.default_rng(0)
+    model = SurfaceModel(sample.z_top, -0.0009, 0.0)
+    xs = np.linspace(-0.03, 0.03, 40)
+    errors = []
+    for i, (x, y) in enumerate((x, y) for y in xs for x in xs):
+        if(i % 37 == 0):
+            model.add(x, y, probe_focus(lambda z: rng.poisson(sample.rate(x, y, z) * 0.05) / 0.05, model.z(x, y))[0])
+        errors.append(model.z(x, y) - sample.surface(x, y))
+    fixed = sample.z_top - 0.0009*xs[:, None] - sample.surface(xs[:, None], xs[None, :])
+    assert np.sqrt(np.mean(np.square(errors))) < 0.5*np.sqrt(np.mean(np.square(fixed)))
+
+
+def test_surface_model_stages(tmp_path):
+    '''Hand-entered plane, then the tilt along the first row, a robust plane and the thin-plate spline.'''
+    def surface(x, y, warp=0.002):
+        return 4.6 + 0.03*x - 0.02*y + warp*np.sin(np.pi*x/0.03)*np.cos(np.pi*y/0.03)
+    model = SurfaceModel(4.6, 0.01, -0.02)
+    assert model.z(0.01, 0.02) == model.prior_z(0.01, 0.02)
+    assert not model.add(0.0, 0.0, None) and not model.add(0.0, 0.0, 4.7)
+    #First row: fitted along x, the hand-entered tilt along y is kept
+    for x in [-0.02, 0.0, 0.02]:
+        assert model.add(x, 0.0, surface(x, 0.0, warp=0))
+    assert abs(model.z(0.03, 0.01) - surface(0.03, 0.01, warp=0)) < 1e-9
+    #Robust plane: one bad probe hardly moves it
+    plane = SurfaceModel(4.6, 0.0, 0.0, model="plane")
+    grid = [(x, y) for x in np.linspace(-0.03, 0.03, 5) for y in np.linspace(-0.03, 0.03, 5)]
+    for i, (x, y) in enumerate(grid):
+        plane.add(x, y, surface(x, y, warp=0) + (0.01 if i == 7 else 0))
+    assert abs(plane.z(0.01, -0.01) - surface(0.01, -0.01, warp=0)) < 1e-4
+    #Warped surface: the thin-plate spline follows it, the plane does not
+    xs = np.linspace(-0.03, 0.03, 21)[:, None]
+    errors = {}
+    for kind in ["plane", "thin_plate"]:
+        model = SurfaceModel(4.6, 0.0, 0.0, model=kind)
+        for x, y in grid:
+            model.add(x, y, surface(x, y))
+        errors[kind] = np.sqrt(np.mean(np.square(model.z(xs, xs.T) - surface(xs, xs.T))))
+    assert errors["thin_plate"] < 0.3*errors["plane"]
+    save_probes(str(tmp_path / "scan_focus.npz"), model)
+    probes = np.load(str(tmp_path / "scan_focus.npz"))
+    assert len(probes["z"]) == len(grid) and np.all(probes["accepted"])
+    #Off the diamond there is no maximum
+    assert probe_focus(lambda z: 1000.0, 4.6)[0] == None
+
+
+def test_process_z_scan(tmp_path):
+    '''The surface fit of a z scan goes into its settings file and the summary.'''
+    path, truth = write_z_scan(tmp_path)
+    summary = process_scan(path, processing_args())
+    with open(path[:-4] + ".json") as f:
+        fit = json.load(f)["z_profile_fit"]
+    assert summary["measurement_type"] == "z" and summary["thickness"] == fit["thickness"]
+    assert abs(fit["top"] - truth["top"]) < 1e-3 and abs(fit["thickness"] - (truth["back"] - truth["top"])) < 1e-3
+    assert fit["thickness_err"] < 1e-3
+
+
+def test_process_odmr_scan(tmp_path, budget):
+    path, result = write_odmr_scan(tmp_path)
+    start = time.perf_counter()
+    summary = process_scan(path, processing_args())
+    elapsed = time.perf_counter() - start
+    assert summary["measurement_type"] == "ODMR" and summary["shape"] == [12, 10, 61]
+    assert abs(summary["mean_splitting"] - np.mean(result["truth"]["f_delta"])) < 5e-4
+    assert os.path.exists(path[:-4] + "plot_peak_splitting.png")
+    assert os.path.isdir(path[:-4] + "_fitcache")
+    #Second run from the cache gives the same result
+    assert process_scan(path, processing_args()) == summary
+    assert elapsed < budget(30)
+
+
+def test_process_skips_unmeasured_pixels(tmp_path):
+    '''Pixels that an adaptive scan skipped hold zeros: they are not fitted and not in the summary.'''
+    path, result = write_odmr_scan(tmp_path)
+    data = np.load(path)
+    progress = np.ones(data.shape[:2], dtype=np.uint8)
+    progress[:4] = 0
+    data[:4] = 0
+    np.save(path, data)
+    np.save(path[:-4] + "_progress.npy", progress)
+    summary = process_scan(path, processing_args("--no-cache"))
+    rates = data[4:] / (1e10 * 1e-12 * 2)
+    assert np.isclose(summary["mean_PL"], np.mean(rates), rtol=1e-5)
+    assert abs(summary["mean_splitting"] - np.mean(result["truth"]["f_delta"][4:])) < 5e-4
+
+
+def run_live_fit(path, skipped_rows=4, submitted_rows=8):
+    '''Runs a LiveFitter over the synthetic ODMR scan at path as ODMR_2D does: the first skipped_rows rows
+    are not measured (zeros, progress 0), the next rows up to submitted_rows are handed over during the scan
+    and the rest are left for finish(). Returns the live maps of finish().'''
+    data = np.load(path)
+    with open(path[:-4] + ".json") as f:
+        settings = json.load(f)
+    exposure = settings["dwell_time"] * 1e-12 * settings["num_sweeps"]
+    data[:skipped_rows] = 0
+    np.save(path, data)
+    progress = np.ones(data.shape[:2], dtype=np.uint8)
+    progress[:skipped_rows] = 0
+    np.save(path[:-4] + "_progress.npy", progress)
+    freq = np.linspace(settings["min_freq"], settings["max_freq"], settings["num_measurements"]) * 1e-9
+    fitter = LiveFitter(data.shape[:2], freq, path[:-4], batch_size=16)
+    for ix in range(skipped_rows, submitted_rows):
+        for iy in range(data.shape[1]):
+            fitter.submit(ix, iy, data[ix, iy] / exposure)
+    return fitter.finish(RateView(data, exposure))
+
+
+def test_live_fit(tmp_path):
+    '''Submitted and remaining measured pixels are fitted and saved; skipped pixels are not fitted.'''
+    path, result = write_odmr_scan(tmp_path)
+    maps = run_live_fit(path)
+    assert not maps["fitted"][:4].any() and maps["fitted"][4:].all()
+    saved = np.load(path[:-4] + "_live_fit.npz")
+    assert np.array_equal(saved["fitted"], maps["fitted"])
+    splitting = saved["splitting"][4:]
+    assert np.median(np.abs(splitting - result["truth"]["f_delta"][4:])) < 3e-4
+    assert os.path.isdir(path[:-4] + "_fitcache")
+
+
+def test_processing_uses_the_live_fit(tmp_path, monkeypatch):
+    '''Processing after a live fit takes the measured pixels from its cache entry instead of fitting them again.'''
+    path, result = write_odmr_scan(tmp_path)
+    run_live_fit(path)
+    def fit(*args, **kwargs):
+        raise AssertionError("the scan was fitted again")
+    monkeypatch.setattr("ODMR_2D_process.fit_double_lorentzian", fit)
+    summary = process_scan(path, processing_args())
+    assert abs(summary["mean_splitting"] - np.mean(result["truth"]["f_delta"][4:])) < 5e-4
+
+
+def test_process_3dpl_scan(tmp_path):
+    path, truth = write_3dpl_scan(tmp_path)
+    summary = process_scan(path, processing_args("--surfaces", "peak"))
+    assert abs(summary["thickness"] - 0.1) < 1e-3
+    assert os.path.exists(path[:-4] + "plot_3DPL_thickness.png")
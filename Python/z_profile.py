@@ -0,0 +1,182 @@
+'''Top and back surface peaks of z profiles.
+
+A z profile (count rate against stage z) of the diamond has a peak where the focus crosses the top
+surface and one at the back surface. fit_z_profiles() fits background + two peaks (Lorentzian or
+Gaussian) to any number of profiles at once with the batched Levenberg-Marquardt solver, so the same
+code serves a single z scan and every pixel of a 3DPL cube. The peak positions come with sub-step
+precision and standard errors; their difference is the optical thickness: the z distance the stage
+travels between the two surfaces, which is shorter than the physical thickness because of refraction.'''
+
+import time
+import numpy as np
+import torch
+
+from lm_solver import levenberg_marquardt
+from double_dip_fitter import select_device
+
+param_names = ["background", "top_amplitude", "top", "top_width", "back_amplitude", "back", "back_width"]
+shapes = ["lorentzian", "gaussian"]
+
+
+def _peak(t, shape):
+    '''Peak shape with height 1 and half width at half maximum 1, and its derivative to t.'''
+    if(shape == "lorentzian"):
+        value = 1 / (1 + t**2)
+        return value, -2*t*value**2
+    value = torch.exp(-np.log(2) * t**2)
+    return value, -2*np.log(2)*t*value
+
+
+def _model(shape):
+    '''func and jacobian of background + two peaks for the solver, parameters in the order of param_names
+    with half widths.'''
+    def func(z, p):
+        result = p[:, 0:1].expand(-1, len(z)).clone()
+        for k in [1, 4]:
+            result = result + p[:, k:k + 1] * _peak((z[None, :] - p[:, k + 1:k + 2]) / p[:, k + 2:k + 3], shape)[0]
+        return result
+
+    def jacobian(z, p):
+        J = torch.zeros(p.shape[0], len(z), p.shape[1], dtype=p.dtype, device=p.device)
+        J[:, :, 0] = 1
+        for k in [1, 4]:
+            width = p[:, k + 2:k + 3]
+            t = (z[None, :] - p[:, k + 1:k + 2]) / width
+            value, derivative = _peak(t, shape)
+            J[:, :, k] = value
+            J[:, :, k + 1] = -p[:, k:k + 1] * derivative / width
+            J[:, :, k + 2] = -p[:, k:k + 1] * derivative * t / width
+        return J
+    return func, jacobian
+
+
+def profile_curve(z, result, index=(), shape="lorentzian"):
+    '''Fitted profile of fit_z_profiles result[...][index] at the positions z.'''
+    p = torch.tensor([[result[name][index] if name not in ["top_width", "back_width"] else 0.5*result[name][index]
+                       for name in param_names]], dtype=torch.float64)
+    p = torch.nan_to_num(p)
+    p[:, [3, 6]] = torch.clamp(p[:, [3, 6]], min=1e-12)
+    return _model(shape)[0](torch.tensor(np.asarray(z, dtype=float)), p)[0].numpy()
+
+
+def initial_estimates(y, z, min_separation):
+    '''(B, 7) initial parameters for the (B, F) profiles y at sorted positions z: the two highest maxima at least
+    min_separation apart, widths from the number of points above half maximum.'''
+    background = np.min(y, axis=1)
+    step = np.median(np.diff(z))
+    i1 = np.argmax(y, axis=1)
+    far = np.abs(z[None, :] - z[i1][:, None]) > min_separation
+    i2 = np.argmax(np.where(far, y, -np.inf), axis=1)
+    i2 = np.where(far.any(axis=1), i2, i1)
+    rows = np.arange(len(y))
+    estimates = np.zeros((len(y), 7))
+    estimates[:, 0] = background
+    closer_to_1 = np.abs(z[None, :] - z[i1][:, None]) <= np.abs(z[None, :] - z[i2][:, None])
+    for k, i, region in [(1, i1, closer_to_1), (4, i2, ~closer_to_1)]:
+        amplitude = np.maximum(y[rows, i] - background, 1e-12)
+        above = (y - background[:, None] > 0.5*amplitude[:, None]) & region
+        estimates[:, k] = amplitude
+        estimates[:, k + 1] = z[i]
+        estimates[:, k + 2] = np.maximum(0.5*step*np.sum(above, axis=1), 0.5*step)
+    return estimates
+
+
+def fit_z_profiles(profiles, z, shape="lorentzian", min_separation=None, min_contrast=0.5, poisson_weights=True,
+                   batch_size=100000, device=None, num_threads=None, max_iter=100, verbose=True):
+    '''Fits background + top and back surface peaks to the (..., Z) profiles at stage positions z (mm).
+    shape: "lorentzian" or "gaussian"
+    min_separation: smallest distance (mm) between the peaks for the initial guess. Default: 10% of the z range.
+    min_contrast: peaks lower than this fraction of the background, below 3 standard errors, or narrower than a z step
+    are taken as absent (NaN position)
+    poisson_weights: weight every point by 1/rate, as for photon counts. The errors are scaled by the residuals,
+    so the exposure time is not needed.
+    Returns a dictionary of (...) arrays: the parameters "background", "top", "back" (mm), "top_width",
+    "back_width" (FWHM, mm), "top_amplitude", "back_amplitude" (same unit as profiles), their standard
+    errors (key + "_err"), the optical "thickness" back - top with "thickness_err", "converged" and "mse".
+    "top" is the peak at the lower z.'''
+    if(shape not in shapes):
+        raise Exception("ERROR: unknown peak shape " + str(shape) + "!")
+    start_time = time.time()
+    device = select_device(device, num_threads)
+    profiles = np.asarray(profiles)
+    out_shape = profiles.shape[:-1]
+    z = np.asarray(z, dtype=float)
+    order = np.argsort(z)
+    z = z[order]
+    y_all = profiles.reshape(-1, len(z))[:, order]
+    if(min_separation == None):
+        min_separation = 0.1 * (z[-1] - z[0])
+    #Positions relative to the middle of the range, so that the problem is well conditioned
+    z_ref = 0.5 * (z[0] + z[-1])
+    zt = torch.tensor(z - z_ref, dtype=torch.float64, device=device)
+    span = z[-1] - z[0]
+    step = np.median(np.diff(z))
+    lower = [-np.inf, 0, z[0] - z_ref, 0.05*step, 0, z[0] - z_ref, 0.05*step]
+    upper = [np.inf, np.inf, z[-1] - z_ref, span, np.inf, z[-1] - z_ref, span]
+    func, jacobian = _model(shape)
+
+    B = len(y_all)
+    params = np.zeros((B, 7))
+    errors = np.zeros((B, 7))
+    thickness_err = np.zeros(B)
+    converged = np.zeros(B, dtype=bool)
+    mse = np.zeros(B)
+    for b0 in range(0, B, batch_size):
+        y_np = np.asarray(y_all[b0:b0 + batch_size], dtype=float)
+        estimates = initial_estimates(y_np, z, min_separation)
+        estimates[:, [2, 5]] -= z_ref
+        y = torch.tensor(y_np, dtype=torch.float64, device=device)
+        p0 = torch.tensor(estimates, dtype=torch.float64, device=device)
+        weights = 1 / torch.clamp(y, min=1) if poisson_weights else None
+        result = levenberg_marquardt(func, jacobian, zt, y, p0, weights=weights, lower=lower, upper=upper, max_iter=max_iter)
+        p = result["params"]
+        covariance = result["covariance"]
+        #Top is the peak at the lower z
+        swap = (p[:, 5] < p[:, 2])
+        permutation = torch.tensor([0, 4, 5, 6, 1, 2, 3], device=device)
+        p = torch.where(swap[:, None], p[:, permutation], p)
+        errors_batch = torch.where(swap[:, None], result["errors"][:, permutation], result["errors"])
+        var = covariance[:, 2, 2] + covariance[:, 5, 5] - 2*covariance[:, 2, 5]
+        params[b0:b0 + batch_size] = p.cpu().numpy()
+        errors[b0:b0 + batch_size] = errors_batch.cpu().numpy()
+        thickness_err[b0:b0 + batch_size] = torch.sqrt(torch.clamp(var, min=0)).cpu().numpy()
+        converged[b0:b0 + batch_size] = result["converged"].cpu().numpy()
+        mse[b0:b0 + batch_size] = ((y - func(zt, result["params"]))**2).mean(dim=1).cpu().numpy()
+
+    params[:, [2, 5]] += z_ref
+    #FWHM instead of half widths
+    params[:, [3, 6]] *= 2
+    errors[:, [3, 6]] *= 2
+    results = {}
+    for i, name in enumerate(param_names):
+        results[name] = params[:, i]
+        results[name + "_err"] = errors[:, i]
+    for name in ["top", "back"]:
+        #Too low, not significant, or narrower than a step (a single noisy point)
+        amplitude = results[name + "_amplitude"]
+        absent = (amplitude < min_contrast * np.maximum(results["background"], 0)) | (amplitude < 3*results[name + "_amplitude_err"]) | (results[name + "_width"] < step)
+        for key in [name, name + "_err", name + "_width", name + "_width_err"]:
+            results[key] = np.where(absent, np.nan, results[key])
+    results["thickness"] = results["back"] - results["top"]
+    results["thickness_err"] = np.where(np.isfinite(results["thickness"]), thickness_err, np.nan)
+    results["converged"] = converged
+    results["mse"] = mse
+    if(verbose):
+        print("Fitted {} z profiles in {:.3f} s".format(B, time.time() - start_time))
+    return {key: value.reshape(out_shape) for key, value in results.items()}
+
+
+if __name__ == "__main__":
+    #Synthetic 3DPL cube with a tilted slab: recovered surfaces and thickness against the truth
+    M, N, Z = 100, 100, 60
+    z = np.linspace(4.50, 4.66, Z)
+    X, Y = np.meshgrid(np.linspace(0, 1, M), np.linspace(0, 1, N), indexing="ij")
+    z_top = 4.53 + 0.01*X - 0.005*Y
+    thickness = 0.1 + 0.002*Y
+    dz = z[None, None, :]
+    cube = 300 + 2e5 / (1 + ((dz - z_top[..., None]) / 0.004)**2) + 1.5e5 / (1 + ((dz - (z_top + thickness)[..., None]) / 0.004)**2)
+    cube = np.random.default_rng(0).poisson(cube * 0.01) / 0.01
+    results = fit_z_profiles(cube, z, device="cpu")
+    print("Step {:.2f} um. Top surface error: RMS {:.3f} um (reported {:.3f} um). Thickness error: RMS {:.3f} um".format(
+        1e3*(z[1] - z[0]), 1e3*np.sqrt(np.mean((results["top"] - z_top)**2)), 1e3*np.mean(results["top_err"]),
+        1e3*np.sqrt(np.mean((results["thickness"] - thickness)**2))))
@@ -9,11 +9,7 @@ import matplotlib.pyplot as plt
 #import zhinst.utils
 #import Pyro5.api
 #import TimeTagger as TT
-# convenience import for all LabOne Q software functionality
-from laboneq.simple import *
-from laboneq.controller.util import *
 from time import sleep
-import TimeTagger
 from scipy.optimize import curve_fit
 import time
 from datetime import date, datetime
@@ -29,6 +25,9 @@ import sys
 #from rtcs.measurements.esr_scan import triple_dip_esr_fit as triple_fit
 import json
 
+from instrument_broker import connect_instruments
+from autofocus import autofocus, summary
+
 plt.rcParams.update({'font.size': 24,})
 
 def main() -> int:
@@ -40,8 +39,13 @@ def main() -> int:
         "y0": 0.0,
         "z1": 4.520,
         "z2": 4.660,
+        "method": "autofocus", #"autofocus": coarse scan and peak refinement (about 14 dwells, see autofocus.py). "linear": all z_steps positions.
+        "coarse_steps": 8, #Only used for autofocus
+        "refine_rounds": 1, #Only used for autofocus
         "laser_power": 2.9, #mW
-        "sample": "Bonded EDP (100)"
+        "sample": "Bonded EDP (100)",
+        "use_broker": True, #Use the connections of a running instrument_broker.py if there is one
+        "simulate": False, #Use simulated instruments (only when connecting directly)
     }
 
     settings_file = None
@@ -58,9 +62,16 @@ def main() -> int:
     z2 = settings["z2"]
     x0 = settings["x0"]
     y0 = settings["y0"]
+    method = settings.get("method", "linear")
 
     #Time estimation
-    total_time = z_steps * (dwell_time*1e-12 + 0.2) #0.2 seconds is the overhead time for movement of the piezo stack
+    if(method == "autofocus"):
+        num_dwells = settings["coarse_steps"] + 2 * 3 * settings["refine_rounds"] #Two surfaces
+    elif(method == "linear"):
+        num_dwells = z_steps
+    else:
+        raise Exception("ERROR: unknown z scan method " + str(method) + "!")
+    total_time = num_dwells * (dwell_time*1e-12 + 0.2) #0.2 seconds is the overhead time for movement of the piezo stack
     print("Estimated time: " + str(total_time/3600) + " hours")
     estimated_finish = time.time() + total_time
     local_time = time.ctime(estimated_finish)
@@ -75,43 +86,35 @@ def main() -> int:
     settings["Start time"] = str(current_time)
     #settings_file_path = settings["save_folder"] + "2D ODMR scan settings" + timestamp + ".json"
 
-    # Create a TimeTagger instance to control your hardware
-    tagger = TimeTagger.createTimeTagger()
-    countrate = TimeTagger.Countrate(tagger=tagger, channels=[1])   # 1 is 1
-
-
-    #Setup piezo-stack
-    from rtcs.devices.physikinstrumente.pi_E873_controller import Pistage_controller
-    pi_x = Pistage_controller("type=tcp;host=192.168.20.21;port=50000") #x axis
-    pi_y = Pistage_controller("type=tcp;host=192.168.20.22;port=50000") #x axis
-    pi_z = Pistage_controller("type=tcp;host=192.168.20.23;port=50000") #x axis
-
-    pi_x.open()
-    pi_y.open()
+    # Connect to time tagger and piezo stack (through the broker if it runs)
+    instruments = connect_instruments(settings.get("use_broker", True), settings.get("simulate", False))
+    pi_x = instruments.stage("x")
+    pi_y = instruments.stage("y")
+    pi_z = instruments.stage("z")
 
     #Move to the right spot
     pi_x.move(x0)
     pi_y.move(y0)
     time.sleep(1)
 
-    pi_x.close()
-    pi_y.close()
-
-    pi_z.open()
-
-    #Set velocities of piezo stack
-    pi_z.send_command("VEL 1 5")
-
-    zmove = np.linspace(z1, z2, z_steps)
-    PL = np.zeros(z_steps)
-
-    for iz in range(z_steps):
-        pi_z.move(zmove[iz])
+    def measure_counts(z):
+        pi_z.move(z)
         pi_z.wait_on_target()
-        countrate.startFor(dwell_time)
-        countrate.waitUntilFinished()
-        rate = countrate.getData()[0]
-        PL[iz] = rate
+        return instruments.photon_counts(dwell_time)
+
+    if(method == "autofocus"):
+        result = autofocus(measure_counts, z1, z2, dwell_time*1e-12, 2, settings["coarse_steps"], settings["refine_rounds"])
+        #The profile is irregular, its positions are stored with the settings
+        PL = result["profile_rate"]
+        settings["z_positions"] = [float(z) for z in result["profile_z"]]
+        settings["autofocus"] = summary(result)
+        for z, z_err in zip(result["z"], result["z_err"]):
+            print("Surface at z = {:.5f} +- {:.5f} mm".format(z, z_err))
+    else:
+        zmove = np.linspace(z1, z2, z_steps)
+        PL = np.zeros(z_steps)
+        for iz in range(z_steps):
+            PL[iz] = measure_counts(zmove[iz]) / (dwell_time*1e-12)
 
     np.save(savePath + ".npy", PL)
     np.savetxt(savePath + ".txt", PL)
@@ -124,7 +127,7 @@ def main() -> int:
     
     print("Measurement complete!\nFile saved as: " + savePath + ".npy")
 
-    pi_z.close()
+    instruments.close()
 
 
 if __name__ == "__main__":